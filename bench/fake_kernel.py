@@ -0,0 +1,135 @@
+"""A scripted kernel that speaks the Jupyter messaging protocol over ZMQ, for benchmarking molten's
+ZMQ path without a real kernel. See bench/scripted.py for what it does with the code it gets.
+
+    python bench/fake_kernel.py /tmp/fake.json
+
+writes a connection file for `:MoltenInit /tmp/fake.json` and serves until it's killed. Needs
+pyzmq and jupyter_client (both come with molten's python dependencies).
+"""
+
+import argparse
+import json
+import os
+import threading
+from typing import Any, Dict, List
+
+import zmq
+from jupyter_client.session import Session, new_id_bytes
+
+from scripted import ScriptedKernel
+
+
+class FakeKernel:
+    def __init__(self, connection_file: str, kernel_name: str, ip: str = "127.0.0.1"):
+        self.context = zmq.Context()
+        self.session = Session(key=new_id_bytes(), signature_scheme="hmac-sha256")
+        self.kernel = ScriptedKernel()
+
+        self.shell = self.context.socket(zmq.ROUTER)
+        self.control = self.context.socket(zmq.ROUTER)
+        self.stdin = self.context.socket(zmq.ROUTER)
+        self.iopub = self.context.socket(zmq.PUB)
+        self.hb = self.context.socket(zmq.REP)
+        url = f"tcp://{ip}"
+        ports = {
+            f"{name}_port": socket.bind_to_random_port(url)
+            for name, socket in (
+                ("shell", self.shell),
+                ("control", self.control),
+                ("stdin", self.stdin),
+                ("iopub", self.iopub),
+                ("hb", self.hb),
+            )
+        }
+
+        with open(connection_file, "w") as file:
+            json.dump(
+                {
+                    **ports,
+                    "ip": ip,
+                    "transport": "tcp",
+                    "key": self.session.key.decode(),
+                    "signature_scheme": "hmac-sha256",
+                    # molten looks up the kernel spec by this name, ie. for the language on export
+                    "kernel_name": kernel_name,
+                },
+                file,
+                indent=2,
+            )
+
+    def serve(self) -> None:
+        # each socket is only ever used by one thread
+        threading.Thread(target=self._serve_hb, daemon=True).start()
+        threading.Thread(target=self._serve_control, daemon=True).start()
+        self._publish_status("starting", None)
+        while True:
+            idents, msg = self._recv(self.shell)
+            self._publish_status("busy", msg)
+            msg_type = msg["header"]["msg_type"]
+            if msg_type == "kernel_info_request":
+                info = self.kernel.kernel_info()
+                self._reply(self.shell, idents, msg, "kernel_info_reply", info)
+            elif msg_type == "execute_request":
+                reply = self.kernel.execute(
+                    msg["content"], lambda t, content: self._publish(t, content, msg)
+                )
+                self._reply(self.shell, idents, msg, "execute_reply", reply)
+            elif msg_type.endswith("_request"):
+                reply_type = msg_type[: -len("_request")] + "_reply"
+                self._reply(self.shell, idents, msg, reply_type, {"status": "ok"})
+            self._publish_status("idle", msg)
+
+    def _serve_control(self) -> None:
+        """Interrupts and pings. Status messages of control requests aren't published, the
+        iopub socket belongs to the shell thread."""
+        while True:
+            idents, msg = self._recv(self.control)
+            msg_type = msg["header"]["msg_type"]
+            if msg_type == "kernel_info_request":
+                info = self.kernel.kernel_info()
+                self._reply(self.control, idents, msg, "kernel_info_reply", info)
+            elif msg_type == "interrupt_request":
+                self.kernel.interrupt()
+                self._reply(self.control, idents, msg, "interrupt_reply", {"status": "ok"})
+            elif msg_type == "shutdown_request":
+                self._reply(self.control, idents, msg, "shutdown_reply", msg["content"])
+                os._exit(0)
+
+    def _serve_hb(self) -> None:
+        while True:
+            self.hb.send(self.hb.recv())
+
+    def _recv(self, socket: zmq.Socket) -> Any:
+        idents, frames = self.session.feed_identities(socket.recv_multipart())
+        return idents, self.session.deserialize(frames)
+
+    def _reply(
+        self,
+        socket: zmq.Socket,
+        idents: List[bytes],
+        parent: Dict[str, Any],
+        msg_type: str,
+        content: Dict[str, Any],
+    ) -> None:
+        self.session.send(socket, msg_type, content, parent=parent, ident=idents)
+
+    def _publish(self, msg_type: str, content: Dict[str, Any], parent: Any) -> None:
+        self.session.send(self.iopub, msg_type, content, parent=parent)
+
+    def _publish_status(self, state: str, parent: Any) -> None:
+        self._publish("status", {"execution_state": state}, parent)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("connection_file", help="where to write the connection file")
+    parser.add_argument("--kernel-name", default="python3", help="kernel name in the file")
+    args = parser.parse_args()
+
+    kernel = FakeKernel(args.connection_file, args.kernel_name)
+    print(f"connect with :MoltenInit {os.path.abspath(args.connection_file)}", flush=True)
+    kernel.serve()
+
+
+if __name__ == "__main__":
+    main()
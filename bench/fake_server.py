@@ -0,0 +1,276 @@
+"""A minimal stand-in for a Jupyter server, for benchmarking molten's Jupyter server path without a
+real kernel. It has the REST endpoints molten uses and the kernel channels websocket (both the
+v1.kernel.websocket.jupyter.org binary protocol and plain json), and its kernels are the scripted
+ones from bench/scripted.py.
+
+    python bench/fake_server.py --port 8899 --token bench
+
+and connect with `:MoltenInit http://127.0.0.1:8899?token=bench`. GET /bench/stats returns the
+number of TCP connections and requests the server got so far. Needs tornado (a dependency of
+jupyter_client).
+"""
+
+import argparse
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import Application, HTTPError, RequestHandler
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from scripted import ScriptedKernel
+
+KERNEL_WS_PROTOCOL = "v1.kernel.websocket.jupyter.org"
+
+
+def serialize_v1(msg: Dict[str, Any]) -> bytes:
+    parts = [msg["channel"].encode()] + [
+        json.dumps(msg[key]).encode()
+        for key in ("header", "parent_header", "metadata", "content")
+    ]
+    offsets = [8 * (len(parts) + 2)]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    head = len(offsets).to_bytes(8, "little") + b"".join(o.to_bytes(8, "little") for o in offsets)
+    return head + b"".join(parts)
+
+
+def deserialize_v1(data: bytes) -> Dict[str, Any]:
+    count = int.from_bytes(data[:8], "little")
+    offsets = [int.from_bytes(data[8 * (i + 1) : 8 * (i + 2)], "little") for i in range(count)]
+    parts = [data[offsets[i] : offsets[i + 1]] for i in range(count - 1)]
+    msg = {
+        key: json.loads(part)
+        for key, part in zip(("header", "parent_header", "metadata", "content"), parts[1:5])
+    }
+    msg["channel"] = parts[0].decode()
+    return msg
+
+
+class Stats:
+    connections = 0
+    requests = 0
+
+
+class CountingHTTPServer(HTTPServer):
+    def handle_stream(self, stream: Any, address: Any) -> None:
+        Stats.connections += 1
+        super().handle_stream(stream, address)
+
+
+class Kernel:
+    def __init__(self, name: str):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.scripted = ScriptedKernel()
+        # cells run one at a time and off the event loop, like a kernel's shell channel
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.sockets: Set["ChannelsHandler"] = set()
+        self.execution_state = "idle"
+
+    def model(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "last_activity": datetime.now(timezone.utc).isoformat(),
+            "execution_state": self.execution_state,
+            "connections": len(self.sockets),
+        }
+
+
+kernels: Dict[str, Kernel] = {}
+
+
+class BaseHandler(RequestHandler):
+    def prepare(self) -> None:
+        Stats.requests += 1
+        token = self.settings["token"]
+        if token is None:
+            return
+        given = self.request.headers.get("Authorization", "").removeprefix("token ")
+        if token not in (given, self.get_argument("token", None)):
+            raise HTTPError(403)
+
+    def kernel(self, kernel_id: str) -> Kernel:
+        if kernel_id not in kernels:
+            raise HTTPError(404)
+        return kernels[kernel_id]
+
+    def write_json(self, obj: Any, status: int = 200) -> None:
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(obj))
+
+
+class KernelsHandler(BaseHandler):
+    def get(self) -> None:
+        self.write_json([kernel.model() for kernel in kernels.values()])
+
+    def post(self) -> None:
+        body = json.loads(self.request.body or b"{}")
+        kernel = Kernel(body.get("name", "python3"))
+        kernels[kernel.id] = kernel
+        self.write_json(kernel.model(), 201)
+
+
+class KernelHandler(BaseHandler):
+    def get(self, kernel_id: str) -> None:
+        self.write_json(self.kernel(kernel_id).model())
+
+    def delete(self, kernel_id: str) -> None:
+        kernel = kernels.pop(self.kernel(kernel_id).id)
+        kernel.scripted.interrupt()
+        kernel.executor.shutdown(wait=False)
+        for socket in list(kernel.sockets):
+            socket.close()
+        self.set_status(204)
+        self.finish()
+
+
+class KernelActionHandler(BaseHandler):
+    def post(self, kernel_id: str, action: str) -> None:
+        kernel = self.kernel(kernel_id)
+        kernel.scripted.interrupt()
+        if action == "restart":
+            kernel.scripted.execution_count = 0
+            for socket in list(kernel.sockets):
+                socket.send("iopub", "status", {"execution_state": "restarting"}, {})
+            self.write_json(kernel.model())
+        else:
+            self.set_status(204)
+            self.finish()
+
+
+class SessionsHandler(BaseHandler):
+    def get(self) -> None:
+        self.write_json([])
+
+
+class StatsHandler(BaseHandler):
+    def get(self) -> None:
+        self.write_json({"connections": Stats.connections, "requests": Stats.requests})
+
+
+class ChannelsHandler(BaseHandler, WebSocketHandler):
+    kernel_: Kernel
+    # only asked for when the client offers subprotocols
+    binary = False
+
+    def select_subprotocol(self, subprotocols: List[str]) -> Optional[str]:
+        self.binary = KERNEL_WS_PROTOCOL in subprotocols
+        return KERNEL_WS_PROTOCOL if self.binary else None
+
+    def open(self, kernel_id: str) -> None:
+        self.kernel_ = self.kernel(kernel_id)
+        self.kernel_.sockets.add(self)
+        self.loop = IOLoop.current()
+
+    def on_close(self) -> None:
+        self.kernel_.sockets.discard(self)
+
+    def on_message(self, message: Any) -> None:
+        msg = deserialize_v1(message) if isinstance(message, bytes) else json.loads(message)
+        channel = msg.get("channel", "shell")
+        msg_type = msg["header"]["msg_type"]
+        scripted = self.kernel_.scripted
+
+        if channel == "control":
+            if msg_type == "interrupt_request":
+                scripted.interrupt()
+                self.send("control", "interrupt_reply", {"status": "ok"}, msg["header"])
+            elif msg_type == "kernel_info_request":
+                self.send("control", "kernel_info_reply", scripted.kernel_info(), msg["header"])
+            return
+        if channel == "shell":
+            self.kernel_.executor.submit(self._run, msg)
+
+    def _run(self, msg: Dict[str, Any]) -> None:
+        """Handle a shell request on the kernel's thread"""
+        parent = msg["header"]
+        msg_type = parent["msg_type"]
+        self._broadcast_status("busy", parent)
+        if msg_type == "kernel_info_request":
+            info = self.kernel_.scripted.kernel_info()
+            self.send_threadsafe("shell", "kernel_info_reply", info, parent)
+        elif msg_type == "execute_request":
+            reply = self.kernel_.scripted.execute(
+                msg["content"],
+                lambda t, content: self._broadcast("iopub", t, content, parent),
+            )
+            self.send_threadsafe("shell", "execute_reply", reply, parent)
+        elif msg_type.endswith("_request"):
+            reply_type = msg_type[: -len("_request")] + "_reply"
+            self.send_threadsafe("shell", reply_type, {"status": "ok"}, parent)
+        self._broadcast_status("idle", parent)
+
+    def _broadcast_status(self, state: str, parent: Dict[str, Any]) -> None:
+        self.kernel_.execution_state = state
+        self._broadcast("iopub", "status", {"execution_state": state}, parent)
+
+    def _broadcast(self, channel: str, msg_type: str, content: Any, parent: Any) -> None:
+        for socket in list(self.kernel_.sockets):
+            socket.send_threadsafe(channel, msg_type, content, parent)
+
+    def send_threadsafe(self, channel: str, msg_type: str, content: Any, parent: Any) -> None:
+        self.loop.add_callback(self.send, channel, msg_type, content, parent)
+
+    def send(self, channel: str, msg_type: str, content: Any, parent: Any) -> None:
+        msg = {
+            "channel": channel,
+            "header": {
+                "msg_id": uuid.uuid4().hex,
+                "msg_type": msg_type,
+                "session": self.kernel_.id,
+                "username": "kernel",
+                "date": datetime.now(timezone.utc).isoformat(),
+                "version": "5.3",
+            },
+            "parent_header": parent,
+            "metadata": {},
+            "content": content,
+        }
+        try:
+            if self.binary:
+                self.write_message(serialize_v1(msg), binary=True)
+            else:
+                self.write_message(json.dumps(msg))
+        except WebSocketClosedError:
+            pass
+
+
+def make_app(token: Optional[str]) -> Application:
+    kernel = r"/api/kernels/([^/]+)"
+    return Application(
+        [
+            (r"/api/kernels", KernelsHandler),
+            (kernel, KernelHandler),
+            (kernel + r"/(restart|interrupt)", KernelActionHandler),
+            (kernel + r"/channels", ChannelsHandler),
+            (r"/api/sessions", SessionsHandler),
+            (r"/bench/stats", StatsHandler),
+        ],
+        token=token,
+        websocket_max_message_size=100 * 1024 * 1024,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--token", help="require this token, like jupyter server does")
+    args = parser.parse_args()
+
+    server = CountingHTTPServer(make_app(args.token))
+    server.listen(args.port, args.ip)
+    query = f"?token={args.token}" if args.token else ""
+    print(f"connect with :MoltenInit http://{args.ip}:{args.port}{query}", flush=True)
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
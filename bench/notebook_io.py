@@ -0,0 +1,315 @@
+"""Time molten's notebook I/O on a generated corpus.
+
+Generates notebooks with a mix of text, html and image outputs (and the matching percent format
+source files), then drives a headless Neovim with molten loaded through:
+
+- :MoltenImportOutput
+- :MoltenExportOutput, to a copy, and then in place after changing one output in the notebook
+- :MoltenSave
+- :MoltenLoad, into a fresh buffer
+
+and reports the wall time of each step, the peak memory of the python remote plugin host and the
+number of temp files molten wrote. Pass a previous run's results with --baseline to fail when a
+step got slower or wrote more files than the tolerance allows.
+
+Needs nvim, pynvim, nbformat and a python3 kernel (ipykernel). Run it from the repo root:
+
+    python bench/notebook_io.py --out bench-results.json
+    python bench/notebook_io.py --baseline bench-results.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import nbformat
+import pynvim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INIT_LUA = """
+vim.opt.rtp:prepend({repo!r})
+vim.g.molten_image_provider = "none"
+vim.g.molten_auto_open_output = false
+_G.bench_messages = {{}}
+vim.notify = function(msg, level)
+    table.insert(_G.bench_messages, {{ msg = msg, level = level or vim.log.levels.INFO }})
+end
+vim.api.nvim_create_autocmd("User", {{
+    pattern = "MoltenKernelReady",
+    callback = function() vim.g.bench_kernel_ready = true end,
+}})
+"""
+
+# (name, cells, text lines per stream output, every nth cell has an image, image size in KB,
+#  every nth cell has an html result)
+CORPUS = [
+    ("small", 50, 5, 10, 20, 7),
+    ("text-heavy", 1000, 200, 0, 0, 0),
+    ("image-heavy", 200, 2, 1, 500, 0),
+    ("mixed", 2000, 20, 10, 200, 7),
+]
+
+
+def generate(
+    directory: str,
+    name: str,
+    cells: int,
+    lines: int,
+    image_every: int,
+    image_kb: int,
+    html_every: int,
+) -> str:
+    """Write <name>.ipynb and <name>.py (percent format) to directory, return the .py path"""
+    # not a real image, just a big payload
+    png = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+    nb_cells = []
+    source = []
+    for i in range(cells):
+        code = f"x{i} = {i}\nprint(x{i})"
+        outputs = [nbformat.v4.new_output("stream", text=f"line {i}\n" * lines)]
+        if image_every and i % image_every == 0:
+            outputs.append(nbformat.v4.new_output("display_data", {"image/png": png}))
+        if html_every and i % html_every == 0:
+            outputs.append(
+                nbformat.v4.new_output(
+                    "execute_result",
+                    {"text/html": "<b>x</b>" * 100, "text/plain": "x"},
+                    execution_count=i + 1,
+                )
+            )
+        nb_cells.append(nbformat.v4.new_code_cell(code, outputs=outputs, execution_count=i + 1))
+        source.append("# %%\n" + code + "\n")
+
+    notebook = nbformat.v4.new_notebook(cells=nb_cells)
+    notebook.metadata["kernelspec"] = {
+        "name": "python3",
+        "display_name": "Python 3",
+        "language": "python",
+    }
+    nbformat.write(notebook, os.path.join(directory, name + ".ipynb"))
+    path = os.path.join(directory, name + ".py")
+    with open(path, "w") as file:
+        file.write("\n".join(source))
+    return path
+
+
+class Session:
+    """A headless nvim with molten loaded, with its own data and temp dirs"""
+
+    def __init__(self, workdir: str, timeout: float):
+        self.timeout = timeout
+        self.tmpdir = os.path.join(workdir, "tmp")
+        os.makedirs(self.tmpdir, exist_ok=True)
+        init = os.path.join(workdir, "init.lua")
+        with open(init, "w") as file:
+            file.write(INIT_LUA.format(repo=REPO))
+
+        env = dict(
+            os.environ,
+            XDG_DATA_HOME=os.path.join(workdir, "data"),
+            XDG_STATE_HOME=os.path.join(workdir, "state"),
+            TMPDIR=self.tmpdir,
+        )
+        argv = ["nvim", "--headless", "-i", "NONE", "-u", init]
+        # the remote plugin manifest has to exist before the nvim that uses it starts
+        subprocess.run(
+            argv + ["+UpdateRemotePlugins", "+qa!"],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        # pynvim starts the child with our environment
+        os.environ.update(env)
+        self.nvim = pynvim.attach("child", argv=argv + ["--embed"])
+
+    def close(self) -> None:
+        self.nvim.command("qa!", async_=True)
+
+    def temp_files(self) -> int:
+        return sum(len(files) for _, _, files in os.walk(self.tmpdir))
+
+    def host_peak_kb(self) -> Optional[int]:
+        """VmHWM of the python remote plugin host, None where /proc isn't available"""
+        pid = self.nvim.exec_lua(
+            """
+            for _, chan in ipairs(vim.api.nvim_list_chans()) do
+                local name = chan.client and chan.client.name or ""
+                if chan.stream == "job" and name:find("rplugin%-host") then
+                    return vim.fn.jobpid(chan.id)
+                end
+            end
+            return nil
+            """
+        )
+        try:
+            with open(f"/proc/{pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except (OSError, TypeError):
+            pass
+        return None
+
+    def wait_for(self, check: str, what: str) -> None:
+        deadline = time.monotonic() + self.timeout
+        while not self.nvim.exec_lua(check):
+            errors = self.nvim.exec_lua(
+                "return vim.tbl_filter(function(m) return m.level >= vim.log.levels.ERROR end,"
+                " _G.bench_messages)"
+            )
+            if errors:
+                raise RuntimeError(f"{what}: {errors[0]['msg']}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"timed out waiting for {what}")
+            time.sleep(0.01)
+
+    def wait_for_message(self, prefix: str) -> None:
+        """Wait for a molten notification that starts with prefix (after the [Molten] tag)"""
+        self.wait_for(
+            "for _, m in ipairs(_G.bench_messages) do "
+            f"if vim.startswith(m.msg, {json.dumps('[Molten] ' + prefix)}) then return true end "
+            "end return false",
+            prefix,
+        )
+
+    def clear_messages(self) -> None:
+        self.nvim.exec_lua("_G.bench_messages = {}")
+
+    def init_kernel(self) -> None:
+        self.nvim.command("let g:bench_kernel_ready = v:false")
+        self.nvim.command("MoltenInit python3")
+        self.wait_for("return vim.g.bench_kernel_ready", "the kernel to start")
+
+
+def timed(session: Session, results: Dict[str, Any], step: str, run) -> None:
+    session.clear_messages()
+    files = session.temp_files()
+    start = time.perf_counter()
+    run()
+    results[step] = {
+        "seconds": round(time.perf_counter() - start, 4),
+        "temp_files": session.temp_files() - files,
+    }
+
+
+def bench(name: str, source: str, workdir: str, timeout: float) -> Dict[str, Any]:
+    session = Session(os.path.join(workdir, "nvim-" + name), timeout)
+    notebook = source[: -len(".py")] + ".ipynb"
+    save_file = os.path.join(workdir, name + ".molten")
+    results: Dict[str, Any] = {}
+    try:
+        session.nvim.command(f"edit {source}")
+        session.init_kernel()
+
+        def run_import() -> None:
+            session.nvim.command(f"MoltenImportOutput {notebook} python3")
+            session.wait_for_message("Successfully loaded")
+
+        def run_export_copy() -> None:
+            session.nvim.command(f"MoltenExportOutput {notebook} python3")
+            session.wait_for_message("Exported")
+
+        def run_export_in_place() -> None:
+            session.nvim.command(f"MoltenExportOutput! {notebook} python3")
+            session.wait_for_message("Exported")
+
+        def run_save() -> None:
+            session.nvim.command(f"MoltenSave {save_file} python3")
+            session.wait_for_message("Saved kernel")
+
+        def run_load() -> None:
+            # outputs are read lazily, this times finding the cells, not rendering them
+            session.nvim.command(f"MoltenLoad {save_file}")
+
+        timed(session, results, "import", run_import)
+        timed(session, results, "export", run_export_copy)
+        # change one output in the notebook, only that cell should be serialized again
+        edited = nbformat.read(notebook, as_version=4)
+        edited.cells[0].outputs = []
+        nbformat.write(edited, notebook)
+        timed(session, results, "export_one_changed", run_export_in_place)
+        timed(session, results, "save", run_save)
+        session.nvim.command("MoltenDeinit")
+        timed(session, results, "load", run_load)
+        results["host_peak_kb"] = session.host_peak_kb()
+    finally:
+        session.close()
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for name, steps in results.items():
+        for step, now in steps.items():
+            before = baseline.get(name, {}).get(step)
+            if before is None or now is None:
+                continue
+            if step == "host_peak_kb":
+                if now > before * tolerance:
+                    regressions.append(f"{name} peak memory: {before} -> {now} KB")
+                continue
+            if now["seconds"] > before["seconds"] * tolerance:
+                regressions.append(
+                    f"{name} {step}: {before['seconds']:.3f}s -> {now['seconds']:.3f}s"
+                )
+            if now["temp_files"] > before["temp_files"]:
+                regressions.append(
+                    f"{name} {step} temp files: {before['temp_files']} -> {now['temp_files']}"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="*", help="corpus entries to run (default: all)")
+    parser.add_argument("--out", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="fail when a step takes longer than baseline * tolerance",
+    )
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait per step")
+    parser.add_argument("--keep", action="store_true", help="keep the generated corpus")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="molten-bench-")
+    results: Dict[str, Any] = {}
+    try:
+        for name, *params in CORPUS:
+            if args.only and name not in args.only:
+                continue
+            source = generate(workdir, name, *params)
+            results[name] = bench(name, source, workdir, args.timeout)
+            print(name, json.dumps(results[name]), flush=True)
+    finally:
+        if args.keep:
+            print(f"corpus kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("regression:", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""The kernel behind bench/fake_kernel.py and bench/fake_server.py. Instead of running code, it
+plays a scripted stream of outputs for each cell. Each line of a cell is one step:
+
+    text N [RATE]       N stream messages of one line each
+    progress N [RATE]   a tqdm style progress bar, N updates of a single line
+    images N [RATE]     N display_data messages with a small png
+    html N [RATE]       N execute_result messages with an html table and a text/plain fallback
+    sleep SECONDS
+
+RATE is in messages per second, 0 (the default) sends them as fast as possible. Anything else,
+like the code molten sends on its own, runs without output. Interrupting stops the current cell.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+# a 1x1 png
+PNG = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGA"
+    "WjR9awAAAABJRU5ErkJggg=="
+)
+
+LANGUAGE_INFO = {
+    "name": "python",
+    "version": "3",
+    "mimetype": "text/x-python",
+    "file_extension": ".py",
+}
+
+Publish = Callable[[str, Dict[str, Any]], None]
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ScriptedKernel:
+    def __init__(self) -> None:
+        self.execution_count = 0
+        self.interrupted = threading.Event()
+
+    def kernel_info(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "protocol_version": "5.3",
+            "implementation": "molten-bench",
+            "implementation_version": "0",
+            "language_info": LANGUAGE_INFO,
+            "banner": "scripted kernel for molten benchmarks",
+            "help_links": [],
+        }
+
+    def interrupt(self) -> None:
+        self.interrupted.set()
+
+    def execute(self, content: Dict[str, Any], publish: Publish) -> Dict[str, Any]:
+        """Play the cell's script through publish(msg_type, content) on iopub, and return the
+        content of the execute_reply"""
+        self.interrupted.clear()
+        silent = content.get("silent", False)
+        if not silent and content.get("store_history", True):
+            self.execution_count += 1
+        if not silent:
+            publish(
+                "execute_input",
+                {"code": content.get("code", ""), "execution_count": self.execution_count},
+            )
+
+        try:
+            for line in content.get("code", "").splitlines():
+                self._step(line.split(), publish)
+        except Interrupted:
+            error = {
+                "ename": "KeyboardInterrupt",
+                "evalue": "",
+                "traceback": ["KeyboardInterrupt"],
+            }
+            publish("error", error)
+            return {"status": "error", "execution_count": self.execution_count, **error}
+
+        return {
+            "status": "ok",
+            "execution_count": self.execution_count,
+            # nothing is evaluated, ie. molten's fetch of a governed output gets an error
+            "user_expressions": {
+                name: {
+                    "status": "error",
+                    "ename": "NameError",
+                    "evalue": "the scripted kernel doesn't evaluate expressions",
+                    "traceback": [],
+                }
+                for name in content.get("user_expressions", {})
+            },
+            "payload": [],
+        }
+
+    def _step(self, words: List[str], publish: Publish) -> None:
+        if len(words) == 0:
+            return
+        if words[0] == "sleep" and len(words) == 2:
+            self._sleep(float(words[1]))
+            return
+        if words[0] not in ("text", "progress", "images", "html") or len(words) not in (2, 3):
+            return
+
+        count = int(words[1])
+        rate = float(words[2]) if len(words) == 3 else 0.0
+        start = time.monotonic()
+        for i in range(count):
+            if self.interrupted.is_set():
+                raise Interrupted
+            publish(*self._message(words[0], i, count))
+            if rate > 0:
+                self._sleep(start + (i + 1) / rate - time.monotonic())
+
+    def _message(self, kind: str, i: int, count: int) -> Tuple[str, Dict[str, Any]]:
+        if kind == "text":
+            return "stream", {"name": "stdout", "text": f"line {i}: " + "x" * 80 + "\n"}
+        if kind == "progress":
+            bar = "#" * (40 * (i + 1) // count)
+            return "stream", {"name": "stderr", "text": f"\r{i + 1}/{count} [{bar:<40}]"}
+        if kind == "images":
+            return "display_data", {
+                "data": {"image/png": PNG, "text/plain": "<IPython.core.display.Image object>"},
+                "metadata": {},
+                "transient": {},
+            }
+        rows = "".join(f"<tr><td>{i}</td><td>{j}</td></tr>" for j in range(20))
+        return "execute_result", {
+            "data": {"text/html": f"<table>{rows}</table>", "text/plain": f"table {i}"},
+            "metadata": {},
+            "execution_count": self.execution_count,
+        }
+
+    def _sleep(self, seconds: float) -> None:
+        if seconds > 0 and self.interrupted.wait(seconds):
+            raise Interrupted
@@ -0,0 +1,121 @@
+"""Count the TCP connections and time the REST requests molten makes to a Jupyter server, with one
+new connection per request (the module level requests functions) and with the pooled session
+molten uses. Runs against bench/fake_server.py, started on a free port for the run.
+
+    python bench/server_connections.py --requests 200
+
+Needs requests and tornado, and molten's python dependencies (it imports molten from
+rplugin/python3).
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict
+
+import requests
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH), "rplugin", "python3"))
+
+from molten.jupyter_server_api import get_server  # noqa: E402
+
+TOKEN = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def stats(base_url: str) -> Dict[str, int]:
+    # on a connection of its own, which is subtracted from the counts
+    response = requests.get(
+        f"{base_url}/bench/stats",
+        headers={"Authorization": f"token {TOKEN}", "Connection": "close"},
+        timeout=5,
+    )
+    return response.json()
+
+
+def measure(base_url: str, count: int, request: Callable[[str, str], Any]) -> Dict[str, float]:
+    """Like a session of interrupts and status polls: a GET and a POST per round"""
+    before = stats(base_url)
+    kernel = request("POST", "/api/kernels")["id"]
+    times = []
+    for _ in range(count // 2):
+        for method, path in (
+            ("GET", "/api/kernels"),
+            ("POST", f"/api/kernels/{kernel}/interrupt"),
+        ):
+            start = time.perf_counter()
+            request(method, path)
+            times.append(time.perf_counter() - start)
+    request("DELETE", f"/api/kernels/{kernel}")
+    after = stats(base_url)
+    return {
+        # minus the stats request itself
+        "connections": after["connections"] - before["connections"] - 1,
+        "requests": after["requests"] - before["requests"] - 1,
+        "mean_ms": statistics.mean(times) * 1000,
+        "p95_ms": statistics.quantiles(times, n=20)[-1] * 1000,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per measurement")
+    args = parser.parse_args()
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH, "fake_server.py"),
+            "--port",
+            str(port),
+            "--token",
+            TOKEN,
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                stats(base_url)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        headers = {"Authorization": f"token {TOKEN}"}
+
+        def one_shot(method: str, path: str) -> Any:
+            # what every call did before the pool
+            response = requests.request(method, base_url + path, headers=headers, timeout=10)
+            return response.json() if response.text else None
+
+        pooled = get_server(f"{base_url}?token={TOKEN}").request
+
+        for name, request in (("new connection per request", one_shot), ("pooled", pooled)):
+            result = measure(base_url, args.requests, request)
+            print(
+                f"{name:>28}: {result['connections']} connection(s) for {result['requests']} "
+                f"requests, mean {result['mean_ms']:.2f}ms, p95 {result['p95_ms']:.2f}ms"
+            )
+    finally:
+        server.terminate()
+        server.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
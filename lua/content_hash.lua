@@ -0,0 +1,146 @@
+local M = {}
+
+-- per buffer line hashes, `false` marks a line that changed since it was last hashed
+---@type table<integer, (string|false)[]>
+local line_cache = {}
+-- per buffer { changedtick, checksum }
+---@type table<integer, { tick: integer, sum: string }>
+local checksum_cache = {}
+
+---@param line string
+---@return string
+local function hash(line)
+  return vim.fn.sha256(line):sub(1, 16)
+end
+
+---@param buf integer
+---@return (string|false)[]
+local function dirty_lines(buf)
+  local hashes = {}
+  for i = 1, vim.api.nvim_buf_line_count(buf) do
+    hashes[i] = false
+  end
+  return hashes
+end
+
+---start tracking a buffer, edits invalidate the hashes of the lines they touch
+---@param buf integer
+---@return (string|false)[]
+local function attach(buf)
+  line_cache[buf] = dirty_lines(buf)
+  vim.api.nvim_buf_attach(buf, false, {
+    on_lines = function(_, b, _, first, last_old, last_new)
+      local hashes = line_cache[b]
+      if hashes == nil then
+        return true
+      end
+      checksum_cache[b] = nil
+
+      -- shift the lines after the edit, then mark the edited lines dirty
+      local n = #hashes
+      local delta = last_new - last_old
+      if delta > 0 then
+        for i = n, last_old + 1, -1 do
+          hashes[i + delta] = hashes[i]
+        end
+      elseif delta < 0 then
+        for i = last_old + 1, n do
+          hashes[i + delta] = hashes[i]
+        end
+        for i = n + delta + 1, n do
+          hashes[i] = nil
+        end
+      end
+      for i = first + 1, last_new do
+        hashes[i] = false
+      end
+    end,
+    on_reload = function(_, b)
+      line_cache[b] = dirty_lines(b)
+      checksum_cache[b] = nil
+    end,
+    on_detach = function(_, b)
+      line_cache[b] = nil
+      checksum_cache[b] = nil
+    end,
+  })
+  return line_cache[buf]
+end
+
+---hash the lines in [first, last) that changed since they were last hashed
+---@param buf integer
+---@param first integer 0-indexed
+---@param last integer 0-indexed, exclusive
+---@return string[]
+local function refresh(buf, first, last)
+  local hashes = line_cache[buf] or attach(buf)
+  if #hashes ~= vim.api.nvim_buf_line_count(buf) then
+    -- shouldn't happen, but never hand out hashes of the wrong lines
+    hashes = dirty_lines(buf)
+    line_cache[buf] = hashes
+  end
+
+  local i = first + 1
+  while i <= last do
+    if hashes[i] == false then
+      -- fetch runs of dirty lines at once
+      local j = i
+      while j < last and hashes[j + 1] == false do
+        j = j + 1
+      end
+      for k, line in ipairs(vim.api.nvim_buf_get_lines(buf, i - 1, j, true)) do
+        hashes[i + k - 1] = hash(line)
+      end
+      i = j + 1
+    else
+      i = i + 1
+    end
+  end
+  return hashes
+end
+
+---@param buf integer
+---@return integer
+local function resolve(buf)
+  if buf == 0 then
+    return vim.api.nvim_get_current_buf()
+  end
+  return buf
+end
+
+---hashes of the lines in each [first, last) range of the buffer, same as sha256(line)[:16] in
+---python. `first` and `last` are 0-indexed, `last` is exclusive, and -1 for the end of the buffer
+---@param buf integer 0 for the current buffer
+---@param ranges integer[][] list of { first, last }
+---@return string[][]
+M.line_hashes = function(buf, ranges)
+  buf = resolve(buf)
+  local count = vim.api.nvim_buf_line_count(buf)
+  local result = {}
+  for _, range in ipairs(ranges) do
+    local first, last = range[1], range[2]
+    if last < 0 then
+      last = count
+    end
+    table.insert(result, vim.list_slice(refresh(buf, first, last), first + 1, last))
+  end
+  return result
+end
+
+---checksum of the content of the buffer. Only lines changed since the last call are hashed again
+---@param buf integer 0 for the current buffer
+---@return string
+M.checksum = function(buf)
+  buf = resolve(buf)
+  local tick = vim.api.nvim_buf_get_changedtick(buf)
+  local cached = checksum_cache[buf]
+  if cached and cached.tick == tick then
+    return cached.sum
+  end
+  local hashes = refresh(buf, 0, vim.api.nvim_buf_line_count(buf))
+  local sum = vim.fn.sha256(table.concat(hashes, "\n"))
+  checksum_cache[buf] = { tick = tick, sum = sum }
+  return sum
+end
+
+return M
@@ -12,11 +12,16 @@ local image_api = {}
 local images = {}
 
 image_api.from_file = function(path, opts)
+  opts = opts or {}
   if opts.window and opts.window == vim.NIL then
     opts.window = nil
   end
-  images[path] = image.from_file(path, opts or {})
-  return path
+  local identifier = opts.id or path
+  -- reuse the already decoded image when it's loaded again with the same identifier
+  if images[identifier] == nil then
+    images[identifier] = image.from_file(path, opts)
+  end
+  return identifier
 end
 
 image_api.render = function(identifier, geometry)
@@ -42,7 +47,15 @@ image_api.render = function(identifier, geometry)
 end
 
 image_api.clear = function(identifier)
-  images[identifier]:clear()
+  if images[identifier] then
+    images[identifier]:clear()
+  end
+end
+
+---clear the image and drop our handle to it, it will have to be loaded again to be shown
+image_api.delete = function(identifier)
+  image_api.clear(identifier)
+  images[identifier] = nil
 end
 
 image_api.clear_all = function()
@@ -55,6 +68,19 @@ image_api.move = function(identifier, x, y)
   images[identifier]:move(x, y)
 end
 
+---place an already loaded image somewhere else, it's drawn there on the next render
+image_api.place = function(identifier, opts)
+  local img = images[identifier]
+  if not img then
+    return
+  end
+  img:clear()
+  img.buffer = opts.buffer
+  img.window = opts.window ~= vim.NIL and opts.window or nil
+  img.geometry.x = opts.x
+  img.geometry.y = opts.y
+end
+
 ---returns the max height this image can be displayed at considering the image size and user's max
 ---width/height settings. Does not consider max width/height percent values.
 image_api.image_size = function(identifier)
@@ -75,4 +101,51 @@ image_api.image_size = function(identifier)
   return { width = math.ceil(width), height = math.ceil(height) }
 end
 
+---a string that changes whenever the values `image_size` depends on change: the terminal cell size
+---and the user's max width/height settings
+local size_epoch = function()
+  local term_size = require("image.utils.term").get_size()
+  local gopts = {}
+  local _, img = next(images)
+  if img then
+    gopts = img.global_state.options
+  end
+  return table.concat({
+    term_size.cell_width,
+    term_size.cell_height,
+    tostring(gopts.max_width),
+    tostring(gopts.max_height),
+  }, ":")
+end
+
+---run a list of queued operations in a single call, so that the python side only pays for one RPC
+---per redraw instead of one per image.
+---@param ops table[] list of `{ op = "add", path, opts }`, `{ op = "move", id, opts }`,
+---`{ op = "clear", id }`, `{ op = "delete", id }`, `{ op = "render", id }` or `{ op = "size", id }`,
+---run in order
+---@return table `sizes` of every image that was added or queried, keyed by identifier, and the
+---`epoch` those sizes are valid for
+image_api.batch = function(ops)
+  local sizes = {}
+  for _, op in ipairs(ops) do
+    if op.op == "add" then
+      local identifier = image_api.from_file(op.path, op.opts)
+      sizes[identifier] = image_api.image_size(identifier)
+    elseif op.op == "move" then
+      image_api.place(op.id, op.opts)
+    elseif op.op == "clear" then
+      image_api.clear(op.id)
+    elseif op.op == "delete" then
+      image_api.delete(op.id)
+    elseif op.op == "render" then
+      if images[op.id] then
+        image_api.render(op.id, sizes[op.id] or image_api.image_size(op.id))
+      end
+    elseif op.op == "size" then
+      sizes[op.id] = image_api.image_size(op.id)
+    end
+  end
+  return { sizes = sizes, epoch = size_epoch() }
+end
+
 return { image_api = image_api }
@@ -19,16 +19,20 @@ snacks_api.from_file = function(path, opts)
     max_height = snacks.config.image.doc and  snacks.config.image.doc.max_height or 40,
   }
   opts.placement = nil
+  opts.path = path
 
-  images[path] = opts
-  return path
+  local identifier = opts.id or path
+  if images[identifier] == nil then
+    images[identifier] = opts
+  end
+  return identifier
 end
 
 snacks_api.render = function(identifier)
   local img = images[identifier]
 
   if img.placement == nil then
-    img.placement = Snacks.image.placement.new(img.buffer, identifier, img.opts)
+    img.placement = Snacks.image.placement.new(img.buffer, img.path, img.opts)
   end
 end
 
@@ -40,9 +44,26 @@ snacks_api.clear = function(identifier)
   end
 end
 
+---place an already loaded image somewhere else, it's drawn there on the next render
+snacks_api.move = function(identifier, opts)
+  local img = images[identifier]
+  if not img then
+    return
+  end
+  snacks_api.clear(identifier)
+  img.buffer = opts.buffer
+  img.opts.pos = { opts.y, opts.x }
+end
+
+---close the image and drop our handle to it, it will have to be loaded again to be shown
+snacks_api.delete = function(identifier)
+  snacks_api.clear(identifier)
+  images[identifier] = nil
+end
+
 snacks_api.clear_all = function()
-  for _, img in pairs(images) do
-    snacks_api.clear(img)
+  for identifier, _ in pairs(images) do
+    snacks_api.clear(identifier)
   end
 end
 
@@ -50,8 +71,51 @@ end
 snacks_api.image_size = function(identifier)
   local img = images[identifier]
   local size =
-    snacks.image.util.fit(identifier, { width = img.opts.max_width, height = img.opts.max_height })
+    snacks.image.util.fit(img.path, { width = img.opts.max_width, height = img.opts.max_height })
   return size
 end
 
+---a string that changes whenever the values `image_size` depends on change: the terminal cell size
+---and the max width/height from the snacks config
+local size_epoch = function()
+  local ok, term = pcall(snacks.image.terminal.size)
+  local doc = snacks.config.image.doc or {}
+  return table.concat({
+    ok and term.cell_width or "",
+    ok and term.cell_height or "",
+    tostring(doc.max_width),
+    tostring(doc.max_height),
+  }, ":")
+end
+
+---run a list of queued operations in a single call, so that the python side only pays for one RPC
+---per redraw instead of one per image.
+---@param ops table[] list of `{ op = "add", path, opts }`, `{ op = "move", id, opts }`,
+---`{ op = "clear", id }`, `{ op = "delete", id }`, `{ op = "render", id }` or `{ op = "size", id }`,
+---run in order
+---@return table `sizes` of every image that was added or queried, keyed by identifier, and the
+---`epoch` those sizes are valid for
+snacks_api.batch = function(ops)
+  local sizes = {}
+  for _, op in ipairs(ops) do
+    if op.op == "add" then
+      local identifier = snacks_api.from_file(op.path, op.opts)
+      sizes[identifier] = snacks_api.image_size(identifier)
+    elseif op.op == "move" then
+      snacks_api.move(op.id, op.opts)
+    elseif op.op == "clear" then
+      snacks_api.clear(op.id)
+    elseif op.op == "delete" then
+      snacks_api.delete(op.id)
+    elseif op.op == "render" then
+      if images[op.id] then
+        snacks_api.render(op.id)
+      end
+    elseif op.op == "size" then
+      sizes[op.id] = snacks_api.image_size(op.id)
+    end
+  end
+  return { sizes = sizes, epoch = size_epoch() }
+end
+
 return { snacks_api = snacks_api }
@@ -46,6 +46,7 @@ M.check = function()
   py_mod_check("pyperclip", "pyperclip", false)
   py_mod_check("nbformat", "nbformat", false)
   py_mod_check("PIL", "pillow", false)
+  py_mod_check("orjson", "orjson", false)
 end
 
 return M
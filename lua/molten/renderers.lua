@@ -0,0 +1,37 @@
+-- Renderers for output mimetypes, written in lua. See "Output Chunks" in the README
+local M = {}
+
+local renderers = {}
+-- whether the python plugin knows about the renderers yet, see `attach`
+local attached = false
+
+---Render `mimetype` (or every mimetype matching a glob like "image/*") with `fn`, replacing the
+---built in renderer for it. The mimetype also has to be in `g:molten_renderer_order`.
+---@param mimetype string
+---@param fn fun(data: any, mimetype: string): string|{ image: string }|nil the text to show, the
+---path of an image to show, or nil to fall back to the next mimetype in `g:molten_renderer_order`
+M.register = function(mimetype, fn)
+  renderers[mimetype] = fn
+  if attached then
+    vim.fn.MoltenRegisterRenderer(mimetype)
+  end
+end
+
+---Give renderers that were skipped for going over their `g:molten_renderer_budgets` another chance
+M.reset = function()
+  vim.fn.MoltenResetRenderers()
+end
+
+---Called by the python plugin when it's initialized
+---@return string[] the mimetypes registered so far
+M.attach = function()
+  attached = true
+  return vim.tbl_keys(renderers)
+end
+
+---Called by the python plugin to render an output
+M.render = function(key, mimetype, data)
+  return renderers[key](data, mimetype)
+end
+
+return M
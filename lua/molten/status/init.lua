@@ -20,4 +20,11 @@ M.all_kernels = function()
   return vim.fn.MoltenStatusLineKernels()
 end
 
+---Display the latest heartbeat round trip time (or "dead") of the kernels attached to the current
+---buffer
+---@return string
+M.latency = function()
+  return vim.fn.MoltenStatusLineLatency(true)
+end
+
 return M
@@ -86,6 +86,27 @@ M.select_and_run = function(kernels, prompt, command)
   end)()
 end
 
+---show the kernels running on a Jupyter server, and initialize the selected one
+---@param choices table<table> list of tuples of (description, MoltenInit arguments)
+---@param prompt string
+M.prompt_server_kernel = function(choices, prompt)
+  vim.schedule_wrap(function()
+    vim.ui.select(choices, {
+      prompt = prompt,
+      format_item = function(item)
+        return item[1]
+      end,
+    }, function(choice)
+      if choice == nil then
+        return
+      end
+      vim.schedule_wrap(function()
+        vim.cmd("MoltenInit " .. choice[2])
+      end)()
+    end)
+  end)()
+end
+
 M.prompt_stdin = function(kernel_id, prompt)
   vim.ui.input({ prompt = prompt }, function(input)
     vim.schedule(function()
@@ -1,11 +1,28 @@
 local M = {}
 
+-- parsed comment queries by language, false when the language has no comment query
+---@type table<string, vim.treesitter.Query|false>
+local queries = {}
+
+---@param lang string
+---@return vim.treesitter.Query|false
+local function comment_query(lang)
+  if queries[lang] == nil then
+    local ok, query = pcall(vim.treesitter.query.parse, lang, [[((comment) @c (#offset! @c 0 0 0 -1))]])
+    queries[lang] = ok and query or false
+  end
+  return queries[lang]
+end
 
 ---remove comments from the given string of code using treesitter
 ---@param str string code to remove comments from
 ---@param lang string language of the code
 ---@return string
 M.remove_comments = function(str, lang)
+  local query = comment_query(lang)
+  if not query then
+    return str
+  end
   local parser = vim.treesitter.get_string_parser(str, lang)
   local tree = parser:parse()
   if not tree then
@@ -13,8 +30,6 @@ M.remove_comments = function(str, lang)
     return str
   end
   local root = tree[1]:root()
-  -- create comment query
-  local query = vim.treesitter.query.parse(lang, [[((comment) @c (#offset! @c 0 0 0 -1))]])
   -- split content lines
   local lines = vim.split(str, '\n')
   -- iterate over query match metadata
@@ -34,4 +49,29 @@ M.remove_comments = function(str, lang)
   return result
 end
 
+-- results of remove_comments_batch by language and code, cells rarely change between exports
+---@type table<string, string>
+local results = {}
+local result_count = 0
+local MAX_RESULTS = 10000
+
+---remove comments from each of the given strings of code, in one call
+---@param strs string[] code to remove comments from
+---@param lang string language of the code
+---@return string[]
+M.remove_comments_batch = function(strs, lang)
+  return vim.tbl_map(function(str)
+    local key = lang .. '\0' .. str
+    if results[key] == nil then
+      if result_count >= MAX_RESULTS then
+        results = {}
+        result_count = 0
+      end
+      results[key] = M.remove_comments(str, lang)
+      result_count = result_count + 1
+    end
+    return results[key]
+  end, strs)
+end
+
 return M
@@ -1,19 +1,41 @@
-import json
 import os
 from typing import Any, Dict, List, Optional, Tuple
 from itertools import chain
 
 import pynvim
 from pynvim.api import Buffer
+from molten.autosave import Journal
+from molten.background import BackgroundTask
 from molten.code_cell import CodeCell
 from molten.images import Canvas, get_canvas_given_provider, WeztermCanvas
 from molten.info_window import create_info_window
-from molten.ipynb import export_outputs, get_default_import_export_file, import_outputs
-from molten.save_load import MoltenIOError, get_default_save_file, load, save
+from molten.ipynb import (
+    export_outputs,
+    get_default_import_export_file,
+    import_outputs,
+    open_notebook,
+    write_notebook,
+)
+from molten.notebook import NotebookDocument
+from molten.save_load import (
+    MoltenIOError,
+    get_blob_dir,
+    get_default_save_file,
+    get_journal_file,
+    load,
+    load_v2,
+    read_header,
+    replay_journal,
+    save,
+)
+from molten.heartbeat import format_latency
+from molten.jupyter_server_api import parse_server_url, server_kernel_choices
 from molten.moltenbuffer import MoltenKernel
 from molten.options import MoltenOptions
 from molten.outputbuffer import OutputBuffer
+from molten.outputchunks import RENDERERS, lua_renderer
 from molten.position import DynamicPosition, Position
+from molten.recording import MessageRecorder, MessageReplay
 from molten.runtime import get_available_kernels
 from molten.utils import MoltenException, notify_error, notify_info, notify_warn, nvimui
 from pynvim import Nvim
@@ -46,6 +68,12 @@ class Molten:
     # list of kernel names to the MoltenKernel object that handles that kernel
     # duplicate names are sufixed with (n)
     molten_kernels: Dict[str, MoltenKernel]
+    # nvim buf numbers to the autosave journal of that buffer
+    journals: Dict[int, Journal]
+    # notebook imports and exports running in the background
+    tasks: List[BackgroundTask]
+    # nvim buf numbers to the notebook opened in that buffer with MoltenOpenNotebook
+    notebooks: Dict[int, NotebookDocument]
 
     def __init__(self, nvim: Nvim):
         self.nvim = nvim
@@ -56,6 +84,9 @@ class Molten:
         self.timer = None
         self.input_timer = None
         self.molten_kernels = {}
+        self.journals = {}
+        self.tasks = []
+        self.notebooks = {}
 
     def _initialize(self) -> None:
         assert not self.initialized
@@ -82,6 +113,12 @@ class Molten:
         self.nvim.exec_lua("_prompt_init = require('prompt').prompt_init")
         self.nvim.exec_lua("_select_and_run = require('prompt').select_and_run")
         self.nvim.exec_lua("_prompt_init_and_run = require('prompt').prompt_init_and_run")
+        self.nvim.exec_lua("_prompt_server_kernel = require('prompt').prompt_server_kernel")
+        self.nvim.exec_lua("_content_hash = require('content_hash')")
+
+        # renderers registered from lua before molten was initialized
+        for key in self.nvim.exec_lua("return require('molten.renderers').attach()"):
+            RENDERERS.register(key, lua_renderer(key))
 
         self.initialized = True
 
@@ -102,6 +139,11 @@ class Molten:
         hl_utils.set_default_highlights(self.options.hl.defaults)
 
     def _deinitialize(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        for journal in self.journals.values():
+            journal.close()
+        self.journals = {}
         for molten_kernels in self.buffers.values():
             for molten_kernel in molten_kernels:
                 molten_kernel.deinit()
@@ -209,6 +251,8 @@ class Molten:
             )
 
             self.add_kernel(self.nvim.current.buffer, kernel_id, molten)
+            if self.options.autosave:
+                molten.output_done_callbacks.append(self._autosave_cell)
             molten._doautocmd("MoltenInitPost")
             if isinstance(self.canvas, WeztermCanvas):
                 self.canvas.wezterm_split()
@@ -219,6 +263,28 @@ class Molten:
                 self.nvim, f"Could not initialize kernel named '{kernel_name}'.\nCaused By: {e}"
             )
 
+    def _autosave_cell(self, molten: MoltenKernel, span: CodeCell) -> None:
+        journal = self.journals.get(span.bufno)
+        if journal is None:
+            try:
+                path = get_default_save_file(self.options, self.nvim.buffers[span.bufno])
+            except MoltenException:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            journal = Journal(
+                self.nvim, path, molten.runtime.kernel_name, self.options.save_compress
+            )
+            self.journals[span.bufno] = journal
+        elif journal.kernel_name != molten.runtime.kernel_name:
+            # save files only hold one kernel
+            return
+        journal.append(molten, span)
+
+    def _close_journal(self, bufnr: int, timeout: Optional[float] = 2.0) -> None:
+        journal = self.journals.pop(bufnr, None)
+        if journal is not None:
+            journal.close(timeout)
+
     def add_kernel(self, buffer: Buffer, kernel_id: str, kernel: MoltenKernel):
         """Add a new MoltenKernel to be tracked by Molten.
         - Adds the new kernel to the buffer list for the given buffer
@@ -243,6 +309,8 @@ class Molten:
 
         if len(args) > 0:
             kernel_name = args[0]
+            if not shared and self._prompt_server_kernel(kernel_name):
+                return
             self._initialize_buffer(kernel_name, shared=shared)
         else:
             PROMPT = "Select the kernel to launch:"
@@ -262,6 +330,26 @@ class Molten:
 
             self.nvim.lua._prompt_init(kernels, PROMPT)
 
+    def _prompt_server_kernel(self, url: str) -> bool:
+        """When url points at a Jupyter server that already runs kernels and doesn't say which one
+        to use, prompt the user to attach to one of them or start a new one.
+        Returns: whether the user was prompted"""
+        if not (url.startswith("http://") or url.startswith("https://")):
+            return False
+        if parse_server_url(url)[2] is not None:
+            return False
+        try:
+            choices = server_kernel_choices(
+                url, self.options.server_timeout, self.options.server_retries
+            )
+        except Exception:
+            # starting the kernel reports the problem
+            return False
+        if len(choices) == 0:
+            return False
+        self.nvim.lua._prompt_server_kernel(choices, "Select a kernel on the server:")
+        return True
+
     def _deinit_buffer(self, molten_kernels: List[MoltenKernel]) -> None:
         # Have to copy this to get around reference issues
         for kernel in [x for x in molten_kernels]:
@@ -271,6 +359,8 @@ class Molten:
                 if len(self.buffers[buf.number]) == 0:
                     del self.buffers[buf.number]
             del self.molten_kernels[kernel.kernel_id]
+        for bufnr in [bufnr for bufnr in self.journals if bufnr not in self.buffers]:
+            self._close_journal(bufnr)
 
     def _do_evaluate_expr(self, kernel_name: str, expr):
         self._initialize_if_necessary()
@@ -351,6 +441,17 @@ class Molten:
 
         kernel.run_code(code, span)
 
+    @pynvim.function("MoltenRegisterRenderer", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def function_register_renderer(self, args) -> None:
+        # called by require('molten.renderers').register once molten is initialized
+        RENDERERS.register(args[0], lua_renderer(args[0]))
+
+    @pynvim.function("MoltenResetRenderers", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def function_reset_renderers(self, _: List[Any]) -> None:
+        RENDERERS.reset()
+
     @pynvim.function("MoltenUpdateOption", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def function_update_option(self, args) -> None:
@@ -387,6 +488,26 @@ class Molten:
         kernels = self.function_list_running_kernels(args)
         return " ".join(kernels)
 
+    @pynvim.function("MoltenStatusLineLatency", sync=True)  # type: ignore
+    def function_status_line_latency(self, args) -> str:
+        if not self.initialized:
+            return ""
+        if len(args) > 0 and args[0]:
+            kernels = self.buffers.get(self.nvim.current.buffer.number, [])
+        else:
+            kernels = list(self.molten_kernels.values())
+        latencies = []
+        for kernel in kernels:
+            if kernel.heartbeat is None:
+                continue
+            if not kernel.heartbeat.alive:
+                latencies.append(f"{kernel.kernel_id} dead")
+                continue
+            latency = kernel.heartbeat.last_latency()
+            if latency is not None:
+                latencies.append(f"{kernel.kernel_id} {format_latency(latency)}")
+        return " ".join(latencies)
+
     @pynvim.function("MoltenStatusLineInit", sync=True)  # type: ignore
     def function_status_line_init(self, _) -> str:
         if self.initialized:
@@ -498,6 +619,19 @@ class Molten:
             if kernel.open_image_popup():
                 return
 
+    @pynvim.command("MoltenFetchFullOutput", nargs=0, sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def command_fetch_full_output(self) -> None:
+        molten_kernels = self._get_current_buf_kernels(True)
+        assert molten_kernels is not None
+
+        # we can do this iff we ensure that different kernels don't contain code cells that overlap
+        for kernel in molten_kernels:
+            if kernel.fetch_full_output():
+                return
+
+        notify_error(self.nvim, "Not in a cell")
+
     @pynvim.command("MoltenEvaluateArgument", nargs="*", sync=True)  # type: ignore
     @nvimui
     def commnand_molten_evaluate_argument(self, args: List[str]) -> None:
@@ -591,6 +725,74 @@ class Molten:
         else:
             self.kernel_check("MoltenEvaluateLine %k", self.nvim.current.buffer)
 
+    @pynvim.command("MoltenRecordStart", nargs="+", sync=True, complete="file")  # type: ignore
+    @nvimui  # type: ignore
+    def command_record_start(self, args: List[str]) -> None:
+        molten_kernels = self._get_current_buf_kernels(True)
+        assert molten_kernels is not None
+
+        if len(args) < 2 or args[0] not in [k.kernel_id for k in molten_kernels]:
+            self.kernel_check(f"MoltenRecordStart %k {' '.join(args)}", self.nvim.current.buffer)
+            return
+
+        molten = self.molten_kernels[args[0]]
+        path = os.path.abspath(os.path.expanduser(args[1]))
+        if molten.runtime.recorder is not None:
+            molten.runtime.recorder.close()
+            molten.runtime.recorder = None
+        try:
+            molten.runtime.recorder = MessageRecorder(path, molten.runtime.kernel_name)
+        except OSError as err:
+            raise MoltenException(f"Couldn't write recording to {path}: {err}")
+        notify_info(self.nvim, f"Recording the messages of kernel {molten.kernel_id} to {path}")
+
+    @pynvim.command("MoltenRecordStop", nargs=0, sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def command_record_stop(self) -> None:
+        molten_kernels = self._get_current_buf_kernels(True)
+        assert molten_kernels is not None
+
+        for molten in molten_kernels:
+            recorder = molten.runtime.recorder
+            if recorder is not None:
+                recorder.close()
+                molten.runtime.recorder = None
+                notify_info(self.nvim, f"Saved recording to {recorder.path}")
+
+    @pynvim.command("MoltenReplay", nargs="+", sync=True, complete="file")  # type: ignore
+    @nvimui  # type: ignore
+    def command_replay(self, args: List[str]) -> None:
+        molten_kernels = self._get_current_buf_kernels(True)
+        assert molten_kernels is not None
+
+        if len(args) < 2 or args[0] not in [k.kernel_id for k in molten_kernels]:
+            self.kernel_check(f"MoltenReplay %k {' '.join(args)}", self.nvim.current.buffer)
+            return
+
+        kernel = self.molten_kernels[args[0]]
+        path = os.path.abspath(os.path.expanduser(args[1]))
+        try:
+            speed = float(args[2]) if len(args) > 2 else 1.0
+        except ValueError:
+            raise MoltenException(f"Invalid replay speed: {args[2]}")
+        replay = MessageReplay(path, speed)
+
+        _, lineno, _, _, _ = self.nvim.funcs.getcurpos()
+        bufno = self.nvim.current.buffer.number
+        span = CodeCell(
+            self.nvim,
+            DynamicPosition(self.nvim, self.extmark_namespace, bufno, lineno - 1, 0),
+            DynamicPosition(
+                self.nvim, self.extmark_namespace, bufno, lineno - 1, -1, right_gravity=True
+            ),
+        )
+        for k in molten_kernels:
+            if k.kernel_id != kernel.kernel_id:
+                if not k.try_delete_overlapping_cells(span):
+                    return
+
+        kernel.replay(replay, span)
+
     def kernel_check(self, command: str, buffer: Buffer) -> None:
         """Figure out if there is more than one kernel attached to the given buffer. If there is,
         prompt the user for the kernel name, and run the given command with the new kernel subbed in
@@ -754,7 +956,7 @@ class Molten:
         assert kernels is not None
         for molten in kernels:
             if molten.kernel_id == kernel:
-                import_outputs(self.nvim, molten, path)
+                import_outputs(self.nvim, molten, path, self._new_task("MoltenImportOutput"))
                 break
 
     @pynvim.command("MoltenExportOutput", nargs="*", sync=True, bang=True)  # type: ignore
@@ -778,9 +980,60 @@ class Molten:
 
         for molten in kernels:
             if molten.kernel_id == kernel:
-                export_outputs(self.nvim, molten, path, bang)
+                export_outputs(
+                    self.nvim, molten, path, bang, self._new_task("MoltenExportOutput")
+                )
                 break
 
+    def _new_task(self, name: str) -> BackgroundTask:
+        self.tasks = [task for task in self.tasks if task.running > 0]
+        task = BackgroundTask(self.nvim, name)
+        self.tasks.append(task)
+        return task
+
+    @pynvim.command("MoltenCancelIO", nargs=0, sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def command_cancel_io(self) -> None:
+        running = [task for task in self.tasks if task.running > 0]
+        if len(running) == 0:
+            notify_info(self.nvim, "No imports or exports running")
+            return
+        for task in running:
+            task.cancel()
+
+    @pynvim.command("MoltenOpenNotebook", nargs="?", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def command_open_notebook(self, args: List[str]) -> None:
+        self._initialize_if_necessary()
+
+        buf = self.nvim.current.buffer
+        if not buf.name.endswith(".ipynb"):
+            raise MoltenException("MoltenOpenNotebook only works in .ipynb buffers")
+        if buf.number in self.buffers:
+            raise MoltenException(
+                "Molten is already initialized for this buffer; "
+                "MoltenOpenNotebook initializes Molten."
+            )
+
+        document = NotebookDocument.open(buf.name)
+        document.ensure_ids()
+        kernel_name = args[0] if len(args) > 0 else document.kernel_name()
+        if kernel_name is None:
+            raise MoltenException(
+                "The notebook doesn't name its kernel, pass one to MoltenOpenNotebook"
+            )
+
+        molten = self._initialize_buffer(kernel_name)
+        if molten is None:
+            return
+        open_notebook(self.nvim, molten, buf, document)
+        self.notebooks[buf.number] = document
+
+        self.nvim.command("augroup molten_notebook")
+        self.nvim.command(f"autocmd! * <buffer={buf.number}>")
+        self.nvim.command(f"autocmd BufWriteCmd <buffer={buf.number}> call MoltenNotebookWrite()")
+        self.nvim.command("augroup END")
+
     @pynvim.command("MoltenSave", nargs="*", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def command_save(self, args) -> None:
@@ -804,10 +1057,16 @@ class Molten:
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
+        # the save supersedes the journal, fold it in first so it can't overwrite the save later
+        self._close_journal(buf.number, timeout=None)
+
         for molten in kernels:
             if molten.kernel_id == kernel:
-                with open(path, "w") as file:
-                    json.dump(save(molten, buf.number), file)
+                save(molten, buf.number, path, self.options.save_compress)
+                # a journal that couldn't be folded into the old save file is outdated now
+                journal_path = get_journal_file(path)
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
                 break
         notify_info(self.nvim, f"Saved kernel `{kernel}` to: {path}")
 
@@ -832,32 +1091,63 @@ class Molten:
                 "Molten is already initialized for this buffer; MoltenLoad initializes Molten."
             )
 
-        with open(path) as file:
-            data = json.load(file)
-
         molten = None
+        journal_path = get_journal_file(path)
 
         try:
             notify_info(self.nvim, f"Attempting to load from: {path}")
 
-            MoltenIOError.assert_has_key(data, "version", int)
-            if (version := data["version"]) != 1:
-                raise MoltenIOError(f"Bad version: {version}")
+            if not os.path.exists(path) and os.path.exists(journal_path):
+                # crashed before anything was ever saved, there is only the journal
+                with open(journal_path) as file:
+                    data = read_header(file)
+                MoltenIOError.assert_has_key(data, "kernel", str)
+                molten = self._initialize_buffer(data["kernel"], shared=shared)
+                if molten:
+                    self._replay_journal(molten, journal_path, get_blob_dir(path))
+                    self._update_interface()
+                return
+
+            with open(path) as file:
+                data = read_header(file)
 
-            MoltenIOError.assert_has_key(data, "kernel", str)
-            kernel_name = data["kernel"]
+                MoltenIOError.assert_has_key(data, "version", int)
+                if (version := data["version"]) not in (1, 2):
+                    raise MoltenIOError(f"Bad version: {version}")
 
-            molten = self._initialize_buffer(kernel_name, shared=shared)
-            if molten:
-                load(self.nvim, molten, self.nvim.current.buffer, data)
+                MoltenIOError.assert_has_key(data, "kernel", str)
+                kernel_name = data["kernel"]
 
-                self._update_interface()
+                molten = self._initialize_buffer(kernel_name, shared=shared)
+                if molten:
+                    if version == 1:
+                        load(self.nvim, molten, self.nvim.current.buffer, data)
+                    else:
+                        load_v2(
+                            self.nvim,
+                            molten,
+                            self.nvim.current.buffer,
+                            data,
+                            file,
+                            get_blob_dir(path),
+                        )
+                    if os.path.exists(journal_path):
+                        self._replay_journal(molten, journal_path, get_blob_dir(path))
+
+                    self._update_interface()
         except MoltenIOError as err:
             if molten is not None:
                 self._deinit_buffer([molten])
 
             raise MoltenException("Error while doing Molten IO: " + str(err))
 
+    def _replay_journal(self, molten: MoltenKernel, journal_path: str, blob_dir: str) -> None:
+        restored = replay_journal(
+            self.nvim, molten, self.nvim.current.buffer, journal_path, blob_dir
+        )
+        if restored > 0:
+            notify_info(self.nvim, f"Restored {restored} autosaved output(s)")
+
     # Internal functions which are exposed to VimScript
 
     @pynvim.function("MoltenBufLeave", sync=True)  # type: ignore
@@ -871,6 +1161,7 @@ class Molten:
         abuf_str = self.nvim.funcs.expand("<abuf>")
         if not abuf_str:
             return
+        self.notebooks.pop(int(abuf_str), None)
 
         molten = self.buffers.get(int(abuf_str))
         if molten is None:
@@ -878,6 +1169,20 @@ class Molten:
 
         self._deinit_buffer(molten)
 
+    @pynvim.function("MoltenNotebookWrite", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def function_notebook_write(self, _: Any) -> None:
+        bufnr = int(self.nvim.funcs.expand("<abuf>"))
+        path = self.nvim.funcs.expand("<afile>:p")
+        document = self.notebooks.get(bufnr)
+        if document is None:
+            raise MoltenException("This buffer wasn't opened with MoltenOpenNotebook")
+
+        changed = write_notebook(
+            self.nvim, self.buffers.get(bufnr, []), self.nvim.buffers[bufnr], document, path
+        )
+        notify_info(self.nvim, f"Wrote {path} ({changed} cell(s) changed)")
+
     @pynvim.function("MoltenOnExitPre", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def function_on_exit_pre(self, _: Any) -> None:
@@ -0,0 +1,95 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import hashlib
+
+
+def line_hash(line: str) -> str:
+    """Same as the line hashes cached in nvim by lua/content_hash.lua"""
+    return hashlib.sha256(line.encode("utf-8")).hexdigest()[:16]
+
+
+class LineIndex:
+    """Index of the lines of a buffer by their hash. Used to find where a block of lines ended up
+    after the buffer was edited, without comparing the block against every buffer position."""
+
+    hashes: List[str]
+    positions: Dict[str, List[int]]
+
+    def __init__(self, hashes: List[str]):
+        self.hashes = hashes
+        self.positions = {}
+        for lineno, hash in enumerate(hashes):
+            self.positions.setdefault(hash, []).append(lineno)
+
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> "LineIndex":
+        return cls([line_hash(line) for line in lines])
+
+    def matches_at(self, block: List[str], start: int) -> bool:
+        return self.hashes[start : start + len(block)] == block
+
+    def find(
+        self,
+        block: List[str],
+        min_start: int = 0,
+        expected: Optional[int] = None,
+        max_candidates: int = 64,
+    ) -> Optional[int]:
+        """Find the line the given block of line hashes starts at. Only starts at or after
+        `min_start` are considered, and the one closest to `expected` wins. At most
+        `max_candidates` positions are verified, so common first lines (blank lines, comments)
+        don't make this quadratic.
+        Returns: the start line, or None if the block isn't in the buffer"""
+        if len(block) == 0:
+            return None
+        candidates = self.positions.get(block[0], [])
+        first = bisect_left(candidates, min_start)
+        if expected is None or expected < min_start:
+            expected = min_start
+
+        # walk outwards from the candidate closest to the expected position
+        hi = bisect_left(candidates, expected, lo=first)
+        lo = hi - 1
+        for _ in range(max_candidates):
+            take_hi = hi < len(candidates) and (
+                lo < first or candidates[hi] - expected <= expected - candidates[lo]
+            )
+            if take_hi:
+                start = candidates[hi]
+                hi += 1
+            elif lo >= first:
+                start = candidates[lo]
+                lo -= 1
+            else:
+                return None
+            if self.matches_at(block, start):
+                return start
+        return None
+
+
+def _normalize(line: str) -> str:
+    return " ".join(line.split())
+
+
+class LooseLineIndex:
+    """LineIndex that doesn't care about whitespace: runs of whitespace are collapsed and blank
+    lines are skipped, both in the buffer and in the blocks that are looked up"""
+
+    linenos: List[int]
+    index: LineIndex
+
+    def __init__(self, lines: List[str]):
+        self.linenos = [lineno for lineno, line in enumerate(lines) if line.strip() != ""]
+        self.index = LineIndex.from_lines([_normalize(lines[lineno]) for lineno in self.linenos])
+
+    @staticmethod
+    def block(lines: List[str]) -> List[str]:
+        return [line_hash(_normalize(line)) for line in lines if line.strip() != ""]
+
+    def find(self, block: List[str], min_start: int = 0) -> Optional[Tuple[int, int]]:
+        """Find the first and last line of the first match of block that starts at or after
+        `min_start`. Returns: the (first, last) line, or None if the block isn't in the buffer"""
+        start = self.index.find(block, bisect_left(self.linenos, min_start))
+        if start is None:
+            return None
+        return self.linenos[start], self.linenos[start + len(block) - 1]
@@ -0,0 +1,131 @@
+from queue import Queue
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import os
+
+from pynvim import Nvim
+
+from molten.code_cell import CodeCell
+from molten.moltenbuffer import MoltenKernel
+from molten.save_load import (
+    compact_journal,
+    get_blob_dir,
+    get_journal_file,
+    store_lock,
+    write_blob,
+)
+from molten.utils import notify_error, notify_warn
+
+# number of cells appended to a journal before it's folded into the save file
+COMPACT_EVERY = 32
+
+# a finished cell: the cell (without its chunks), and the (data, metadata) of its chunks
+JournalEntry = Tuple[Dict[str, Any], List[Tuple[Dict[str, Any], Dict[str, Any]]]]
+
+
+class Journal:
+    """Append only log of the cells of a buffer that finished running, kept next to the buffer's
+    save file so outputs survive a crash. Serializing outputs and writing them happens on a
+    background thread, the editor only hands over the finished cells."""
+
+    nvim: Nvim
+    path: str
+    kernel_name: str
+    compress: bool
+
+    queue: "Queue[Optional[JournalEntry]]"
+    thread: Thread
+    appended: int
+    # false once the save file turned out to be one the journal can't be folded into
+    compactable: bool
+
+    def __init__(self, nvim: Nvim, path: str, kernel_name: str, compress: bool):
+        self.nvim = nvim
+        self.path = path
+        self.kernel_name = kernel_name
+        self.compress = compress
+
+        self.queue = Queue()
+        self.appended = 0
+        self.compactable = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, molten_kernel: MoltenKernel, span: CodeCell) -> None:
+        """Queue the output of span to be written to the journal. Must be called from the nvim
+        thread"""
+        output = molten_kernel.outputs[span].output
+        begin = span.begin.lineno
+        end = span.end.lineno
+        cell = {
+            "span": {
+                "begin": {"lineno": begin, "colno": span.begin.colno},
+                "end": {"lineno": end, "colno": span.end.colno},
+            },
+            "execution_count": output.execution_count,
+            "status": output.status.value,
+            "success": output.success,
+            "line_hashes": molten_kernel.get_line_hashes(span.bufno, [(begin, end + 1)])[0],
+        }
+        payloads = [
+            (chunk.jupyter_data, chunk.jupyter_metadata)
+            for chunk in output.chunks
+            if chunk.jupyter_data is not None and chunk.jupyter_metadata is not None
+        ]
+        self.queue.put((cell, payloads))
+
+    def close(self, timeout: Optional[float] = 2.0) -> None:
+        """Write the queued cells, fold the journal into the save file, and stop the thread. With
+        a timeout of None, this waits until that's done"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            entry = self.queue.get()
+            try:
+                with store_lock:
+                    if entry is None:
+                        if self.appended > 0:
+                            self._compact()
+                        return
+                    self._write(entry)
+                    if self.appended >= COMPACT_EVERY:
+                        self._compact()
+            except Exception as err:
+                self.nvim.async_call(notify_error, self.nvim, f"Autosave failed: {err}")
+
+    def _compact(self) -> None:
+        if not self.compactable:
+            return
+        if compact_journal(self.path):
+            self.appended = 0
+            return
+        self.compactable = False
+        self.nvim.async_call(
+            notify_warn,
+            self.nvim,
+            f"Autosave: {self.path} is an older save or belongs to another kernel, it won't be "
+            "replaced. Outputs are kept in the journal next to it until you :MoltenSave",
+        )
+
+    def _write(self, entry: JournalEntry) -> None:
+        cell, payloads = entry
+        blob_dir = get_blob_dir(self.path)
+        os.makedirs(blob_dir, exist_ok=True)
+
+        cell["chunks"] = [
+            {"blob": write_blob(blob_dir, data, self.compress), "metadata": metadata}
+            for data, metadata in payloads
+        ]
+
+        journal_path = get_journal_file(self.path)
+        new = not os.path.exists(journal_path)
+        with open(journal_path, "a") as file:
+            if new:
+                file.write(json.dumps({"journal": 1, "kernel": self.kernel_name}) + "\n")
+            file.write(json.dumps(cell) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.appended += 1
@@ -0,0 +1,79 @@
+from threading import Event, Thread
+from typing import Any, Callable, Optional
+
+from pynvim import Nvim
+
+from molten.utils import MoltenException, notify_error, notify_info
+
+
+class Cancelled(Exception):
+    pass
+
+
+class BackgroundTask:
+    """A job that does its heavy lifting off the nvim thread. Work runs on a worker thread, and
+    its result is handed back to the nvim thread, where it's safe to touch the editor again. Steps
+    can be chained by calling `run` again from the nvim side of a step."""
+
+    nvim: Nvim
+    name: str
+    cancelled: Event
+    running: int
+
+    def __init__(self, nvim: Nvim, name: str):
+        self.nvim = nvim
+        self.name = name
+        self.cancelled = Event()
+        self.running = 0
+
+    def run(self, work: Callable[[], Any], then: Optional[Callable[[Any], None]] = None) -> None:
+        """Run `work` on a worker thread, then call `then` with its result on the nvim thread.
+        Neither may call into nvim from the worker thread, use `progress` to report progress."""
+        self.running += 1
+
+        def target() -> None:
+            try:
+                result = work()
+            except Cancelled:
+                self.nvim.async_call(self._finish, None, None)
+                return
+            except Exception as err:
+                self.nvim.async_call(self._fail, err)
+                return
+            self.nvim.async_call(self._finish, then, result)
+
+        Thread(target=target, daemon=True).start()
+
+    def progress(self, msg: str) -> None:
+        """Report progress, can be called from any thread"""
+        self.nvim.async_call(notify_info, self.nvim, f"{self.name}: {msg}")
+
+    def check(self) -> None:
+        """Raise Cancelled if the task was cancelled. Call this between units of work"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def _finish(self, then: Optional[Callable[[Any], None]], result: Any) -> None:
+        self.running -= 1
+        if self.cancelled.is_set():
+            notify_info(self.nvim, f"{self.name}: cancelled")
+            return
+        if then is None:
+            return
+        try:
+            then(result)
+        except Exception as err:
+            self._report(err)
+
+    def _fail(self, err: Exception) -> None:
+        self.running -= 1
+        self._report(err)
+
+    def _report(self, err: Exception) -> None:
+        if isinstance(err, MoltenException):
+            notify_error(self.nvim, f"{self.name}: {err}")
+        else:
+            notify_error(self.nvim, f"{self.name} failed: {type(err).__name__}: {err}")
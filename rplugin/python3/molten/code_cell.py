@@ -60,7 +60,13 @@ class CodeCell:
         lines: List[str] = nvim.funcs.nvim_buf_get_lines(
             self.bufno, self.begin.lineno, self.end.lineno + 1, False
         )
+        return self._text_of(lines)
 
+    def get_text_from(self, buffer_lines: List[str]) -> str:
+        """Like get_text, but takes the text from the already fetched lines of the buffer"""
+        return self._text_of(buffer_lines[self.begin.lineno : self.end.lineno + 1])
+
+    def _text_of(self, lines: List[str]) -> str:
         if len(lines) == 0:
             return "" # apparently this can happen...
         if len(lines) == 1:
@@ -0,0 +1,144 @@
+import json
+from typing import Any, Dict, Optional
+
+DEFAULT_GOVERNOR_CONFIG: Dict[str, Any] = {
+    # text outputs (including reprs and html) longer than this are cut
+    "max_text_chars": 100_000,
+    # images larger than this (in bytes) that can't be down-sampled below it are dropped
+    "max_image_bytes": 2_000_000,
+    # images with a side longer than this (in pixels) are down-sampled, requires PIL in the kernel
+    "max_image_px": 2000,
+    # mimetypes that molten never renders, dropped when there is a text/plain alternative
+    "drop_mimetypes": ["text/html", "application/javascript"],
+    # number of full payloads the kernel keeps around for :MoltenFetchFullOutput
+    "keep_full": 32,
+}
+
+# Code run in python kernels to install the governor. It wraps the display formatter so that both
+# `display()` calls and execute results go through it. Whenever a payload is changed, the original
+# is kept in the kernel, and the key to get it back is stored in the `molten` output metadata.
+GOVERNOR_SNIPPET = '''
+def _molten_install_governor(config):
+    import base64
+    import io
+    from collections import OrderedDict
+
+    ip = get_ipython()
+    if ip is None:
+        return
+
+    formatter = ip.display_formatter
+    original = getattr(formatter, "_molten_original_format", formatter.format)
+    state = {"full": OrderedDict(), "next": 0, "bypass": False}
+
+    class Payload:
+        def __init__(self, data, metadata):
+            self.data = data
+            self.metadata = metadata
+
+        def _repr_mimebundle_(self, include=None, exclude=None):
+            return self.data, self.metadata
+
+    def fetch(key):
+        data, metadata = state["full"][key]
+        state["bypass"] = True
+        return Payload(data, metadata)
+
+    def shrink_image(value):
+        raw = value if isinstance(value, bytes) else base64.b64decode(value)
+        try:
+            from PIL import Image
+
+            img = Image.open(io.BytesIO(raw))
+            if max(img.size) > config["max_image_px"]:
+                image_format = img.format or "PNG"
+                img.thumbnail((config["max_image_px"], config["max_image_px"]))
+                out = io.BytesIO()
+                img.save(out, format=image_format)
+                raw = out.getvalue()
+        except Exception:
+            pass
+        if len(raw) > config["max_image_bytes"]:
+            return None
+        if isinstance(value, bytes):
+            return raw
+        return base64.b64encode(raw).decode("ascii")
+
+    def govern(data, metadata):
+        governed = dict(data)
+        if "text/plain" in governed:
+            for mimetype in config["drop_mimetypes"]:
+                governed.pop(mimetype, None)
+        for mimetype, value in list(governed.items()):
+            if mimetype.startswith("image/") and mimetype != "image/svg+xml":
+                small = shrink_image(value)
+                if small is None:
+                    del governed[mimetype]
+                else:
+                    governed[mimetype] = small
+            elif isinstance(value, str) and len(value) > config["max_text_chars"]:
+                cut = len(value) - config["max_text_chars"]
+                governed[mimetype] = (
+                    value[: config["max_text_chars"]]
+                    + f"\\n... {cut} more chars, run :MoltenFetchFullOutput to see them"
+                )
+        if governed == data:
+            return data, metadata
+        if len(governed) == 0:
+            governed["text/plain"] = "<output too large, run :MoltenFetchFullOutput to see it>"
+
+        key = str(state["next"])
+        state["next"] += 1
+        state["full"][key] = (data, metadata)
+        while len(state["full"]) > config["keep_full"]:
+            state["full"].popitem(last=False)
+        metadata = dict(metadata)
+        metadata["molten"] = {"governed": key}
+        return governed, metadata
+
+    def format(obj, include=None, exclude=None):
+        data, metadata = original(obj, include=include, exclude=exclude)
+        if state["bypass"]:
+            state["bypass"] = False
+            return data, metadata
+        try:
+            return govern(data, metadata)
+        except Exception:
+            return data, metadata
+
+    formatter._molten_original_format = original
+    formatter.format = format
+    ip._molten_fetch = fetch
+'''
+
+
+def governor_config(option: Any, kernel_name: str) -> Optional[Dict[str, Any]]:
+    """Resolve the `molten_output_governor` option for the given kernel.
+    Returns: the governor config, or None when the governor is disabled for this kernel"""
+    if not option:
+        return None
+
+    config = dict(DEFAULT_GOVERNOR_CONFIG)
+    if isinstance(option, dict):
+        config.update({k: v for k, v in option.items() if k != "kernels"})
+        overrides = option.get("kernels", {})
+        if kernel_name in overrides:
+            if not overrides[kernel_name]:
+                return None
+            if isinstance(overrides[kernel_name], dict):
+                config.update(overrides[kernel_name])
+    return config
+
+
+def governor_code(config: Dict[str, Any]) -> str:
+    """The code to run in a python kernel to install the governor with the given config"""
+    return (
+        GOVERNOR_SNIPPET
+        + f"_molten_install_governor(__import__('json').loads({json.dumps(json.dumps(config))}))\n"
+        + "del _molten_install_governor\n"
+    )
+
+
+def fetch_expression(key: str) -> str:
+    """The user expression that evaluates to the full payload the governor kept for `key`"""
+    return f"get_ipython()._molten_fetch({key!r})"
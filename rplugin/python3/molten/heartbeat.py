@@ -0,0 +1,163 @@
+from collections import deque
+from threading import Event, Thread
+from typing import Any, Callable, Deque, List, Optional, Tuple
+import time
+
+from pynvim import Nvim
+
+from molten.jupyter_server_api import JupyterAPIClient
+
+# consecutive pings without a reply before the kernel is considered dead
+HEARTBEAT_MISSES = 2
+# number of round trips the latency stats are computed over
+LATENCY_WINDOW = 100
+# upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = [0.001, 0.01, 0.1, 1.0]
+
+
+def format_latency(seconds: float) -> str:
+    if seconds < 0.001:
+        return "<1ms"
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    return f"{seconds:.1f}s"
+
+
+class _ZMQPinger:
+    """Pings the heartbeat channel of a ZMQ kernel, which echoes whatever it's sent"""
+
+    def __init__(self, kernel_client: Any):
+        import zmq
+
+        info = kernel_client.get_connection_info()
+        if info["transport"] == "tcp":
+            self.url = f"tcp://{info['ip']}:{info['hb_port']}"
+        else:
+            self.url = f"{info['transport']}://{info['ip']}-{info['hb_port']}"
+        self.context = zmq.Context.instance()
+        self.socket = None
+
+    def ping(self, timeout: float) -> Optional[float]:
+        import zmq
+
+        if self.socket is None:
+            self.socket = self.context.socket(zmq.REQ)
+            self.socket.linger = 0
+            self.socket.connect(self.url)
+
+        start = time.monotonic()
+        self.socket.send(b"ping")
+        if self.socket.poll(timeout * 1000) == 0:
+            # a REQ socket can't send again before it gets its reply, start over with a new one
+            self.close()
+            return None
+        self.socket.recv()
+        return time.monotonic() - start
+
+    def close(self) -> None:
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class HeartbeatMonitor:
+    """Pings a kernel every `interval` seconds from a background thread, and keeps the latest
+    round trip times. ZMQ kernels are pinged on their heartbeat channel, Jupyter server kernels
+    with a kernel_info_request on the control channel (the heartbeat channel isn't exposed by the
+    server). `on_change` is called on the nvim thread with False when the kernel stops answering,
+    and with True once it answers again."""
+
+    nvim: Nvim
+    interval: float
+    timeout: float
+    on_change: Callable[[bool], None]
+
+    latencies: Deque[float]
+    misses: int
+    alive: bool
+
+    def __init__(
+        self,
+        nvim: Nvim,
+        kernel_client: Any,
+        interval: float,
+        timeout: float,
+        on_change: Callable[[bool], None],
+    ):
+        self.nvim = nvim
+        self.interval = interval
+        self.timeout = timeout
+        self.on_change = on_change
+
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.misses = 0
+        self.alive = True
+
+        if isinstance(kernel_client, JupyterAPIClient):
+            self._ping: Callable[[float], Optional[float]] = kernel_client.ping
+            self._close: Callable[[], None] = lambda: None
+        else:
+            pinger = _ZMQPinger(kernel_client)
+            self._ping = pinger.ping
+            self._close = pinger.close
+
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(1.0)
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    latency = self._ping(self.timeout)
+                except Exception:
+                    latency = None
+
+                if latency is None:
+                    self.misses += 1
+                    if self.alive and self.misses >= HEARTBEAT_MISSES:
+                        self.alive = False
+                        self.nvim.async_call(self.on_change, False)
+                else:
+                    self.misses = 0
+                    self.latencies.append(latency)
+                    if not self.alive:
+                        self.alive = True
+                        self.nvim.async_call(self.on_change, True)
+        finally:
+            self._close()
+
+    def last_latency(self) -> Optional[float]:
+        return self.latencies[-1] if len(self.latencies) > 0 else None
+
+    def histogram(self) -> List[Tuple[str, int]]:
+        """Number of recent round trips in each latency bucket"""
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in self.latencies:
+            i = 0
+            while i < len(LATENCY_BUCKETS) and latency >= LATENCY_BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+        labels = [f"<{format_latency(bound)}" for bound in LATENCY_BUCKETS]
+        labels.append(f">={format_latency(LATENCY_BUCKETS[-1])}")
+        return list(zip(labels, counts))
+
+    def describe(self) -> str:
+        """ie. `3ms (p50 2ms, p95 5ms, max 9ms over 100 pings)`"""
+        if not self.alive:
+            return f"not responding (missed the last {self.misses} pings)"
+        if len(self.latencies) == 0:
+            return "waiting for the first reply"
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> str:
+            return format_latency(latencies[min(len(latencies) - 1, int(p * len(latencies)))])
+
+        return (
+            f"{format_latency(self.latencies[-1])} (p50 {percentile(0.5)}, p95 {percentile(0.95)}, "
+            f"max {format_latency(latencies[-1])} over {len(latencies)} pings)"
+        )
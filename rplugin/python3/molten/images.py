@@ -1,5 +1,6 @@
-from typing import Dict, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 from pynvim import Nvim
 from molten.options import MoltenOptions
@@ -35,10 +36,23 @@ class Canvas(ABC):
         to reduce flickering.
         """
 
+    @abstractmethod
+    def flush(self) -> None:
+        """
+        Send every queued `add_image`, `remove_image` and size query to the
+        image provider in a single call, and cache the image sizes it returns.
+
+        `present` flushes implicitly, this only needs to be called when sizes
+        are needed before the images are drawn.
+        """
+
     @abstractmethod
     def img_size(self, identifier: str) -> Dict[str, int]:
         """
         Get the height of an image in terminal rows.
+
+        Sizes are answered from the cache filled by `flush`, an image that is
+        not in the cache yet is queued and flushed on its own.
         """
 
     @abstractmethod
@@ -53,7 +67,8 @@ class Canvas(ABC):
     ) -> str:
         """
         Add an image to the canvas.
-        Takes effect after a call to present()
+        This only queues the image, it is sent to the provider on the next
+        flush() and drawn after a call to present()
 
         Parameters
         - path: str
@@ -96,6 +111,9 @@ class NoCanvas(Canvas):
     def present(self) -> None:
         pass
 
+    def flush(self) -> None:
+        pass
+
     def img_size(self, _indentifier: str) -> Dict[str, int]:
         return {"height": 0, "width": 0}
 
@@ -114,27 +132,49 @@ class NoCanvas(Canvas):
         pass
 
 
-class ImageNvimCanvas(Canvas):
+class LuaBatchCanvas(Canvas):
+    """Shared logic for canvases backed by a lua image api that exposes a `batch` function.
+
+    Images are kept loaded on the lua side, keyed by their identifier, so that hiding and
+    showing an output only toggles the visibility of an existing image, and showing it somewhere
+    else only moves it. At most `max_resident` images are kept loaded, the least recently used
+    ones that aren't on screen are unloaded first.
+    """
+
     nvim: Nvim
+    api: Any
     to_make_visible: Set[str]
     to_make_invisible: Set[str]
     visible: Set[str]
-
-    def __init__(self, nvim: Nvim):
+    # operations waiting to be sent to lua in a single batch
+    pending: List[Dict[str, Any]]
+    # images currently loaded on the lua side, in least recently used order
+    resident: "OrderedDict[str, None]"
+    # where each resident image is placed: x, y, bufnr, winnr
+    geometry: Dict[str, Tuple[int, int, int, Optional[int]]]
+    sizes: Dict[str, Dict[str, int]]
+    size_epoch: Optional[str]
+    max_resident: int
+
+    def __init__(self, nvim: Nvim, max_resident: int):
         self.nvim = nvim
+        self.max_resident = max_resident
         self.visible = set()
         self.to_make_visible = set()
         self.to_make_invisible = set()
+        self.pending = []
+        self.resident = OrderedDict()
+        self.geometry = {}
+        self.sizes = {}
+        self.size_epoch = None
         self.next_id = 0
 
-    def init(self) -> None:
-        self.nvim.exec_lua("_image = require('load_image_nvim').image_api")
-        self.nvim.exec_lua("_image_utils = require('load_image_nvim').image_utils")
-        self.image_api = self.nvim.lua._image
-        self.image_utils = self.nvim.lua._image_utils
+    @abstractmethod
+    def image_opts(self, key: str, x: int, y: int, bufnr: int, winnr: int | None) -> Dict[str, Any]:
+        """The options the lua side needs to load the image with the given key"""
 
     def deinit(self) -> None:
-        self.image_api.clear_all()
+        self.api.clear_all()
 
     def present(self) -> None:
         # images to both show and hide should be ignored
@@ -143,18 +183,36 @@ class ImageNvimCanvas(Canvas):
         )
         self.to_make_invisible.difference_update(self.to_make_visible)
         for identifier in self.to_make_invisible:
-            self.image_api.clear(identifier)
+            self.pending.append({"op": "clear", "id": identifier})
 
         for identifier in to_work_on:
-            size = self.img_size(identifier)
-            self.image_api.render(identifier, size)
+            self.pending.append({"op": "render", "id": identifier})
 
+        self.flush()
+
+        self.visible.difference_update(self.to_make_invisible)
         self.visible.update(self.to_make_visible)
         self.to_make_invisible.clear()
         self.to_make_visible.clear()
 
+    def flush(self) -> None:
+        if len(self.pending) == 0:
+            return
+        result = self.api.batch(self.pending)
+        self.pending = []
+        if result["epoch"] != self.size_epoch:
+            # the terminal cell size or the max image size changed, every cached size is stale
+            self.sizes = {}
+            self.size_epoch = result["epoch"]
+        # lua turns an empty table into a list
+        if result["sizes"]:
+            self.sizes.update(result["sizes"])
+
     def img_size(self, identifier: str) -> Dict[str, int]:
-        return self.image_api.image_size(identifier)
+        if identifier not in self.sizes:
+            self.pending.append({"op": "size", "id": identifier})
+            self.flush()
+        return self.sizes[identifier]
 
     def add_image(
         self,
@@ -165,23 +223,62 @@ class ImageNvimCanvas(Canvas):
         bufnr: int,
         winnr: int | None = None,
     ) -> str:
-        img = self.image_api.from_file(
-            path,
-            {
-                "id": identifier,
-                "buffer": bufnr,
-                "with_virtual_padding": True,
-                "x": x,
-                "y": y,
-                "window": winnr,
-            },
-        )
-        self.to_make_visible.add(img)
-        return img
+        key = identifier
+        geometry = (x, y, bufnr, winnr)
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            if self.geometry[key] != geometry:
+                # the lua side clears the image before moving it, so it has to be drawn again
+                # even if it was also removed since the last present
+                self.pending.append(
+                    {"op": "move", "id": key, "opts": self.image_opts(key, x, y, bufnr, winnr)}
+                )
+                self.to_make_invisible.discard(key)
+        else:
+            self.pending.append(
+                {"op": "add", "path": path, "opts": self.image_opts(key, x, y, bufnr, winnr)}
+            )
+            self.resident[key] = None
+        self.geometry[key] = geometry
+        self.to_make_visible.add(key)
+        self._evict()
+        return key
 
     def remove_image(self, identifier: str) -> None:
         self.to_make_invisible.add(identifier)
 
+    def _evict(self) -> None:
+        """Unload the least recently used images until we're under the resident image limit.
+        Images that are on screen, or about to be shown, are never unloaded."""
+        for key in list(self.resident.keys()):
+            if len(self.resident) <= self.max_resident:
+                return
+            if key in self.to_make_visible or key in self.visible:
+                continue
+            del self.resident[key]
+            del self.geometry[key]
+            self.sizes.pop(key, None)
+            self.to_make_invisible.discard(key)
+            self.pending.append({"op": "delete", "id": key})
+
+
+class ImageNvimCanvas(LuaBatchCanvas):
+    def init(self) -> None:
+        self.nvim.exec_lua("_image = require('load_image_nvim').image_api")
+        self.nvim.exec_lua("_image_utils = require('load_image_nvim').image_utils")
+        self.api = self.nvim.lua._image
+        self.image_utils = self.nvim.lua._image_utils
+
+    def image_opts(self, key: str, x: int, y: int, bufnr: int, winnr: int | None) -> Dict[str, Any]:
+        return {
+            "id": key,
+            "buffer": bufnr,
+            "with_virtual_padding": True,
+            "x": x,
+            "y": y,
+            "window": winnr,
+        }
+
 
 class WeztermCanvas(Canvas):
     """A canvas for using Wezterm's imgcat functionality to render images/plots"""
@@ -229,6 +326,9 @@ class WeztermCanvas(Canvas):
         self.to_make_invisible.clear()
         self.to_make_visible.clear()
 
+    def flush(self) -> None:
+        pass
+
     def img_size(self, _indentifier: str) -> Dict[str, int]:
         return {"height": 0, "width": 0}
 
@@ -259,68 +359,20 @@ class WeztermCanvas(Canvas):
         )
 
 
-class SnacksCanvas(Canvas):
-    nvim: Nvim
-    to_make_visible: Set[str]
-    to_make_invisible: Set[str]
-    visible: Set[str]
-
-    def __init__(self, nvim: Nvim):
-        self.nvim = nvim
-        self.visible = set()
-        self.to_make_visible = set()
-        self.to_make_invisible = set()
-        self.next_id = 0
-
+class SnacksCanvas(LuaBatchCanvas):
     def init(self) -> None:
         self.nvim.exec_lua("_snacks = require('load_snacks_nvim').snacks_api")
-        self.snacks_api = self.nvim.lua._snacks
-
-    def deinit(self) -> None:
-        self.snacks_api.clear_all()
-
-    def present(self) -> None:
-        # images to both show and hide should be ignored
-        to_work_on = self.to_make_visible.difference(
-            self.to_make_visible.intersection(self.to_make_invisible)
-        )
-        self.to_make_invisible.difference_update(self.to_make_visible)
-        for identifier in self.to_make_invisible:
-            self.snacks_api.clear(identifier)
-
-        for identifier in to_work_on:
-            self.snacks_api.render(identifier)
-
-        self.visible.update(self.to_make_visible)
-        self.to_make_invisible.clear()
-        self.to_make_visible.clear()
-
-    def img_size(self, identifier: str) -> Dict[str, int]:
-        return self.snacks_api.image_size(identifier)
-
-    def add_image(
-        self,
-        path: str,
-        identifier: str,
-        x: int,
-        y: int,
-        bufnr: int,
-        winnr: int | None = None,
-    ) -> str:
-        img = self.snacks_api.from_file(
-            path,
-            {
-                "id": identifier,
-                "buffer": bufnr,
-                "x": x,
-                "y": y + 1,
-            },
-        )
-        self.to_make_visible.add(img)
-        return img
+        self.api = self.nvim.lua._snacks
 
-    def remove_image(self, identifier: str) -> None:
-        self.to_make_invisible.add(identifier)
+    def image_opts(
+        self, key: str, x: int, y: int, bufnr: int, _winnr: int | None
+    ) -> Dict[str, Any]:
+        return {
+            "id": key,
+            "buffer": bufnr,
+            "x": x,
+            "y": y + 1,
+        }
 
 
 def get_canvas_given_provider(nvim: Nvim, options: MoltenOptions) -> Canvas:
@@ -329,9 +381,9 @@ def get_canvas_given_provider(nvim: Nvim, options: MoltenOptions) -> Canvas:
     if name == "none":
         return NoCanvas()
     elif name == "image.nvim":
-        return ImageNvimCanvas(nvim)
+        return ImageNvimCanvas(nvim, options.image_cache_size)
     elif name == "snacks.nvim":
-        return SnacksCanvas(nvim)
+        return SnacksCanvas(nvim, options.image_cache_size)
     elif name == "wezterm":
         if options.auto_open_output:
             raise MoltenException(
@@ -36,6 +36,7 @@ def create_info_window(nvim, molten_kernels, buffers, initialized):
             draw_kernel_info(
                 info_buf, running, m_kernel.kernel_id, spec.language, spec.argv, spec.resource_dir
             )
+            draw_heartbeat(info_buf, m_kernel)
 
     if len(other_buf_kernels) > 0:
         info_buf.append(
@@ -49,6 +50,7 @@ def create_info_window(nvim, molten_kernels, buffers, initialized):
             draw_kernel_info(
                 info_buf, running, m_kernel.kernel_id, spec.language, spec.argv, spec.resource_dir
             )
+            draw_heartbeat(info_buf, m_kernel)
 
     if len(other_kernels) > 0:
         info_buf.append([f" {len(other_kernels)} inactive kernel(s):", ""])
@@ -97,3 +99,19 @@ def draw_kernel_info(buf, running, kernel_name, language, argv, resource_dir):
     buf.append(f"   cmd:          {' '.join(argv)}")
     buf.api.add_highlight(-1, "String", len(buf) - 1, 16, -1)
     buf.append([f"   resource_dir: {resource_dir}", ""])
+
+
+def draw_heartbeat(buf, m_kernel):
+    if m_kernel.heartbeat is None:
+        return
+    # replaces the blank line after the kernel info
+    buf[-1] = f"   latency:      {m_kernel.heartbeat.describe()}"
+    highlight = "String" if m_kernel.heartbeat.alive else "Error"
+    buf.api.add_highlight(-1, highlight, len(buf) - 1, 16, -1)
+    if len(m_kernel.heartbeat.latencies) > 0:
+        histogram = "  ".join(
+            f"{label}: {count}" for label, count in m_kernel.heartbeat.histogram()
+        )
+        buf.append(f"                 {histogram}")
+        buf.api.add_highlight(-1, "Comment", len(buf) - 1, 16, -1)
+    buf.append("")
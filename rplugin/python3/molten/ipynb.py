@@ -1,15 +1,41 @@
-from typing import Dict
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Dict, List, Optional, Tuple
 from pynvim.api import Buffer, Nvim
+from molten.alignment import LineIndex, LooseLineIndex, line_hash
+from molten.background import BackgroundTask
 from molten.code_cell import CodeCell
 from molten.moltenbuffer import MoltenKernel
+from molten.notebook import (
+    NOTEBOOK_VERSION,
+    NotebookDocument,
+    join_output_lines,
+    parse_cells,
+    random_cell_id,
+    render_cells,
+)
+import base64
 import os
+import tempfile
 from molten.outputbuffer import OutputBuffer
-from molten.outputchunks import ErrorOutputChunk, Output, OutputStatus, to_outputchunk
+from molten.outputchunks import (
+    ErrorOutputChunk,
+    Output,
+    OutputStatus,
+    payload_digest,
+    to_outputchunk,
+)
 from molten.position import DynamicPosition
 
 from molten.utils import MoltenException, notify_error, notify_info, notify_warn
 
-NOTEBOOK_VERSION = 4
+# bytes of base64 image data above which images are decoded in worker processes
+PROCESS_DECODE_THRESHOLD = 16_000_000
+
+# notebook cells, the buffer lines they were matched against, the placed cells (start, end, cell),
+# the numbers of the unplaced cells, and the decoded images
+ImportResult = Tuple[List[Any], List[str], List[Tuple[int, int, Any]], List[int], Dict[str, str]]
 
 
 def get_default_import_export_file(nvim: Nvim, buffer: Buffer) -> str:
@@ -23,8 +49,87 @@ def get_default_import_export_file(nvim: Nvim, buffer: Buffer) -> str:
     return f"{os.path.splitext(full_path)[0]}.ipynb"
 
 
-def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str):
-    """Import outputs from an .ipynb file with the given name"""
+def _align_cells(
+    buffer_contents: List[str], cells: List[Any]
+) -> Tuple[List[Tuple[int, int, Any]], List[int]]:
+    """Find the lines of the buffer that hold the code of each notebook code cell with outputs.
+    Cells are matched in order, each one after the last one that was placed.
+    Returns: the (start, end, cell) of the placed cells, and the numbers of the cells that weren't
+    found"""
+    placed = []
+    unplaced: List[int] = []
+
+    index = LineIndex.from_lines(buffer_contents)
+    loose_index: Optional[LooseLineIndex] = None
+    min_start = 0
+    for cell_number, cell in enumerate(cells, 1):
+        if cell["cell_type"] != "code" or "outputs" not in cell:
+            continue
+
+        nb_contents = cell["source"].split("\n")
+        if cell["source"].strip() == "":
+            unplaced.append(cell_number)
+            continue
+
+        start = index.find([line_hash(line) for line in nb_contents], min_start, min_start)
+        if start is not None:
+            end = start + len(nb_contents) - 1
+        else:
+            # fall back to ignoring whitespace, for reformatted code or trimmed blank lines
+            if loose_index is None:
+                loose_index = LooseLineIndex(buffer_contents)
+            found = loose_index.find(LooseLineIndex.block(nb_contents), min_start)
+            if found is None:
+                unplaced.append(cell_number)
+                continue
+            start, end = found
+        min_start = end + 1
+        placed.append((start, end, cell))
+    return placed, unplaced
+
+
+def _decode_images(task: BackgroundTask, cells: List[Any], allocated: List[str]) -> Dict[str, str]:
+    """Decode the raster images in the outputs of the cells to temp files, in worker processes
+    when there is enough image data for that to pay off. Each file is added to `allocated` as soon
+    as it's written, so it's cleaned up with the kernel even if the import doesn't finish.
+    Returns: a map of payload digests to the decoded files, to seed the render cache with"""
+    payloads: Dict[str, Tuple[str, str]] = {}
+    for cell in cells:
+        for output_data in cell["outputs"]:
+            for mimetype, value in (output_data.get("data") or {}).items():
+                if mimetype.startswith("image/") and mimetype != "image/svg+xml" and value:
+                    payloads.setdefault(payload_digest(mimetype, value), (mimetype, str(value)))
+    if len(payloads) == 0:
+        return {}
+
+    task.progress(f"decoding {len(payloads)} image(s)")
+    values = [value for _, value in payloads.values()]
+    pool = None
+    if sum(map(len, values)) > PROCESS_DECODE_THRESHOLD:
+        pool = ProcessPoolExecutor(mp_context=get_context("spawn"))
+        decoded = pool.map(base64.b64decode, values, chunksize=8)
+    else:
+        decoded = map(base64.b64decode, values)
+
+    paths = {}
+    try:
+        for (digest, (mimetype, _)), raw in zip(payloads.items(), decoded):
+            task.check()
+            extension = mimetype.split("/")[1]
+            with tempfile.NamedTemporaryFile(suffix="." + extension, delete=False) as file:
+                allocated.append(file.name)
+                file.write(raw)
+            paths[digest] = file.name
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    return paths
+
+
+def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, task: BackgroundTask):
+    """Import outputs from an .ipynb file with the given name. The notebook is read, matched
+    against the buffer, and its images are decoded in the background, the outputs are installed
+    once that's done."""
     import nbformat
 
     if not filepath.endswith(".ipynb"):
@@ -34,61 +139,61 @@ def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str):
         notify_warn(nvim, f"Cannot import from file: {filepath} because it does not exist.")
         return
 
-    buf_line = 0
     buf = nvim.current.buffer
     buffer_contents = buf[:]
-    nb = nbformat.read(filepath, as_version=NOTEBOOK_VERSION)
-
+    changedtick = buf.api.get_changedtick()
+
+    def read() -> ImportResult:
+        nb = nbformat.read(filepath, as_version=NOTEBOOK_VERSION)
+        task.check()
+        placed, unplaced = _align_cells(buffer_contents, nb["cells"])
+        task.check()
+        images = _decode_images(
+            task, [cell for _, _, cell in placed], kernel.runtime.allocated_files
+        )
+        return nb["cells"], buffer_contents, placed, unplaced, images
+
+    def install(result: ImportResult) -> None:
+        cells, lines, placed, unplaced, images = result
+        kernel.runtime.render_cache.update(images)
+        if buf.api.get_changedtick() != changedtick:
+            # edited while the notebook was being read, aligning again is cheap
+            lines = buf[:]
+            placed, unplaced = _align_cells(lines, cells)
+        _install_outputs(nvim, kernel, buf, lines, placed, unplaced)
+
+    notify_info(nvim, f"Importing outputs from {filepath}")
+    task.run(read, install)
+
+
+def _install_outputs(
+    nvim: Nvim,
+    kernel: MoltenKernel,
+    buf: Buffer,
+    buffer_contents: List[str],
+    placed: List[Tuple[int, int, Any]],
+    unplaced: List[int],
+) -> None:
     molten_outputs: Dict[CodeCell, Output] = {}
+    for start, end, cell in placed:
+        output = Output(cell["execution_count"])
+        output.old = True
+        output.success = True
+        if output.execution_count:
+            output.status = OutputStatus.DONE
+        else:
+            output.status = OutputStatus.NEW
 
-    for cell in nb["cells"]:
-        if cell["cell_type"] != "code" or "outputs" not in cell:
-            continue
-
-        nb_contents = cell["source"].split("\n")
-        nb_line = 0
-        while buf_line < len(buffer_contents):
-            if len(nb_contents) == 0:
-                break  # out of while loop
-            if nb_contents[nb_line] != buffer_contents[buf_line]:
-                # move on to the next buffer line, but reset the nb_line
-                nb_line = 0
-                buf_line += 1
-                continue
-
-            if nb_line >= len(nb_contents) - 1:
-                # we're done. This is a match, we'll create the output
-                output = Output(cell["execution_count"])
-                output.old = True
-                output.success = True
-                if output.execution_count:
-                    output.status = OutputStatus.DONE
-                else:
-                    output.status = OutputStatus.NEW
-
-                for output_data in cell["outputs"]:
-                    m_chunk, success = handle_output_types(nvim, output_data.get("output_type"), kernel, output_data)
-                    output.chunks.append(m_chunk)
-                    output.success &= success
-
-                start = DynamicPosition(
-                    nvim,
-                    kernel.extmark_namespace,
-                    buf.number,
-                    buf_line - (len(nb_contents) - 1),
-                    0,
-                )
-                end = DynamicPosition(
-                    nvim, kernel.extmark_namespace, buf.number, buf_line, len(buf[buf_line])
-                )
-                code_cell = CodeCell(nvim, start, end)
-                molten_outputs[code_cell] = output
-                nb_line = 0
-                buf_line += 1
-                break  # out of the while loop
+        for output_data in cell["outputs"]:
+            m_chunk, success = handle_output_types(nvim, output_data.get("output_type"), kernel, output_data)
+            output.chunks.append(m_chunk)
+            output.success &= success
 
-            buf_line += 1
-            nb_line += 1
+        start_pos = DynamicPosition(nvim, kernel.extmark_namespace, buf.number, start, 0)
+        end_pos = DynamicPosition(
+            nvim, kernel.extmark_namespace, buf.number, end, len(buffer_contents[end])
+        )
+        molten_outputs[CodeCell(nvim, start_pos, end_pos)] = output
 
     failed = 0
     for span, output in molten_outputs.items():
@@ -100,9 +205,9 @@ def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str):
                 kernel.options,
             )
             kernel.outputs[span].output = output
-            kernel.update_interface()
         else:
             failed += 1
+    kernel.update_interface()
 
     loaded = len(molten_outputs) - failed
 
@@ -114,6 +219,12 @@ def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str):
         notify_error(
             nvim, f"Failed to load output for {failed} running cell that would be overridden"
         )
+    if len(unplaced) > 0:
+        notify_warn(
+            nvim,
+            f"Could not find the code of {len(unplaced)} notebook cell(s) in the buffer, their "
+            f"output wasn't imported (cell numbers: {', '.join(map(str, unplaced))})",
+        )
 
 def handle_output_types(nvim: Nvim, output_type: str, kernel: MoltenKernel, output_data):
     chunk = None
@@ -126,6 +237,7 @@ def handle_output_types(nvim: Nvim, output_type: str, kernel: MoltenKernel, outp
                 { "text/plain": output_data.get("text") },
                 output_data.get("metadata"),
                 kernel.options,
+                kernel.runtime.render_cache,
             )
         case "error":
             chunk = ErrorOutputChunk(output_data["ename"], output_data["evalue"], output_data["traceback"])
@@ -138,11 +250,16 @@ def handle_output_types(nvim: Nvim, output_type: str, kernel: MoltenKernel, outp
                 output_data.get("data"),
                 output_data.get("metadata"),
                 kernel.options,
+                kernel.runtime.render_cache,
             )
     return chunk, success
 
-def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: bool):
-    """Export outputs of the current file/kernel to a .ipynb file with the given name."""
+def export_outputs(
+    nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: bool, task: BackgroundTask
+):
+    """Export outputs of the current file/kernel to a .ipynb file with the given name. Reading,
+    building and writing the notebook happens in the background. Only the cells whose outputs
+    changed are serialized again, and the notebook is replaced atomically."""
     import nbformat
 
     if not filepath.endswith(".ipynb"):
@@ -152,51 +269,32 @@ def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: b
         notify_warn(nvim, f"Cannot export to file: {filepath} because it does not exist.")
         return
 
-    nb = nbformat.read(filepath, as_version=NOTEBOOK_VERSION)
-
     molten_cells = sorted(kernel.outputs.items(), key=lambda x: x[0])
 
     if len(molten_cells) == 0:
         notify_warn(nvim, "No cell outputs to export")
         return
 
-    nb_cells = list(filter(lambda x: x["cell_type"] == "code", nb["cells"]))
-    nb_index = 0
     lang = kernel.runtime.kernel_manager.kernel_spec.language  # type: ignore
-    for mcell in molten_cells:
-        matched = False
-        while nb_index < len(nb_cells):
-            code_cell, output = mcell
-            nb_cell = nb_cells[nb_index]
-            nb_index += 1
-
-            if compare_contents(nvim, nb_cell, code_cell, lang):
-                matched = True
-                outputs = [
-                    nbformat.v4.new_output(
-                        chunk.output_type,
-                        chunk.jupyter_data,
-                        **chunk.extras,
-                    )
-                    if chunk.jupyter_metadata is None
-                    else nbformat.v4.new_output(
-                        chunk.output_type,
-                        chunk.jupyter_data,
-                        metadata=chunk.jupyter_metadata,
-                        **chunk.extras,
-                    )
-                    for chunk in output.output.chunks
-                ]
-                nb_cell["outputs"] = outputs
-                nb_cell["execution_count"] = output.output.execution_count
-                break  # break out of the while loop
 
-        if not matched:
-            notify_error(
-                nvim,
-                f"No cell matching cell at line: {mcell[0].begin.lineno + 1} in notebook: {filepath}. Bailing.",
+    # snapshot everything the worker needs from the editor
+    buffer_lines: Dict[int, List[str]] = {}
+    molten_contents = []
+    exported = []
+    for code_cell, output in molten_cells:
+        if code_cell.bufno not in buffer_lines:
+            buffer_lines[code_cell.bufno] = nvim.buffers[code_cell.bufno][:]
+        molten_contents.append(code_cell.get_text_from(buffer_lines[code_cell.bufno]))
+        exported.append(
+            (
+                code_cell.begin.lineno,
+                output.output.execution_count,
+                [
+                    (chunk.output_type, chunk.jupyter_data, chunk.jupyter_metadata, chunk.extras)
+                    for chunk in output.output.chunks
+                ],
             )
-            return
+        )
 
     if overwrite:
         write_to = filepath
@@ -204,13 +302,176 @@ def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: b
         head, tail = os.path.split(filepath)
         write_to = f"{head}/copy-of-{tail}"
 
-    notify_info(nvim, f"Exporting {len(molten_cells)} cell output(s) to {write_to}")
-    nbformat.write(nb, write_to)
+    def read() -> NotebookDocument:
+        return NotebookDocument.open(filepath)
+
+    def normalize(document: NotebookDocument) -> None:
+        nb_cells = [i for i, cell in enumerate(document.cells) if cell["cell_type"] == "code"]
+        # strip the comments of every cell on both sides in a single call
+        clean = nvim.exec_lua(
+            "return require('remove_comments').remove_comments_batch(...)",
+            [document.source(i) + "\n" for i in nb_cells]
+            + [contents + "\n" for contents in molten_contents],
+            lang,
+        )
+        task.run(
+            lambda: write(document, nb_cells, clean[: len(nb_cells)], clean[len(nb_cells) :]),
+            done,
+        )
+
+    def write(
+        document: NotebookDocument,
+        nb_cells: List[int],
+        clean_nb: List[str],
+        clean_molten: List[str],
+    ) -> Tuple[str, int]:
+        nb_positions: Dict[str, List[int]] = {}
+        for i, contents in enumerate(clean_nb):
+            nb_positions.setdefault(contents, []).append(i)
+
+        nb_index = 0
+        changed = 0
+        for (lineno, execution_count, chunks), contents in zip(exported, clean_molten):
+            task.check()
+            # the first matching notebook cell after the last matched one
+            candidates = nb_positions.get(contents, [])
+            at = bisect_left(candidates, nb_index)
+            if at == len(candidates):
+                raise MoltenException(
+                    f"No cell matching cell at line: {lineno + 1} in notebook: {filepath}. Bailing."
+                )
 
+            nb_index = candidates[at] + 1
+            outputs = [
+                nbformat.v4.new_output(output_type, data, **extras)
+                if metadata is None
+                else nbformat.v4.new_output(output_type, data, metadata=metadata, **extras)
+                for output_type, data, metadata, extras in chunks
+            ]
+            if document.set_outputs(nb_cells[candidates[at]], outputs, execution_count):
+                changed += 1
+
+        task.check()
+        if changed > 0 or write_to != filepath:
+            # only the changed cells are serialized again, the file is replaced atomically
+            document.write(write_to)
+        return write_to, changed
+
+    def done(result: Tuple[str, int]) -> None:
+        write_to, changed = result
+        if changed == 0 and write_to == filepath:
+            notify_info(nvim, f"Outputs in {write_to} are already up to date")
+        else:
+            notify_info(
+                nvim,
+                f"Exported {len(molten_cells)} cell output(s) to {write_to} ({changed} changed)",
+            )
 
-def compare_contents(nvim: Nvim, nb_cell, code_cell: CodeCell, lang: str) -> bool:
-    molten_contents = code_cell.get_text(nvim)
-    nvim.exec_lua("_remove_comments = require('remove_comments').remove_comments")
-    clean_nb = nvim.lua._remove_comments(nb_cell["source"] + "\n", lang)
-    clean_molten = nvim.lua._remove_comments(molten_contents + "\n", lang)
-    return clean_nb == clean_molten
+    notify_info(nvim, f"Exporting {len(molten_cells)} cell output(s) to {write_to}")
+    task.run(read, normalize)
+
+
+def _comment_prefix(buf: Buffer) -> str:
+    prefix = buf.options["commentstring"].split("%s")[0].strip()
+    return prefix if prefix != "" else "#"
+
+
+def open_notebook(nvim: Nvim, kernel: MoltenKernel, buf: Buffer, document: NotebookDocument):
+    """Replace the contents of buf (an .ipynb buffer) with the cells of the notebook as editable
+    text, see notebook.render_cells, and attach the notebook's outputs to its code cells"""
+    language = document.language()
+    if language is not None:
+        buf.options["filetype"] = language
+    prefix = _comment_prefix(buf)
+    buf.vars["molten_notebook_prefix"] = prefix
+
+    lines, code_cells = render_cells(document, prefix)
+    # the json the buffer was loaded with shouldn't be part of the undo history
+    undolevels = buf.options["undolevels"]
+    buf.options["undolevels"] = -1
+    buf[:] = lines
+    buf.options["undolevels"] = undolevels
+    buf.options["modified"] = False
+
+    placed = [
+        (
+            start,
+            end,
+            {
+                **document.cells[index],
+                "outputs": [
+                    join_output_lines(output) for output in document.cells[index]["outputs"]
+                ],
+            },
+        )
+        for start, end, index in code_cells
+    ]
+    _install_outputs(nvim, kernel, buf, lines, placed, [])
+
+
+def write_notebook(
+    nvim: Nvim,
+    kernels: List[MoltenKernel],
+    buf: Buffer,
+    document: NotebookDocument,
+    path: str,
+) -> int:
+    """Write the text of a buffer opened with open_notebook back to the notebook at path. Cells are
+    tracked by their ids, only added or edited cells, and cells whose outputs changed, are
+    serialized again.
+    Returns: the number of cells that changed"""
+    import nbformat
+
+    prefix = buf.vars["molten_notebook_prefix"]
+    lines = buf[:]
+    cells = parse_cells(lines, prefix)
+
+    # the text before the first marker gets a marker line, which moves everything down a line
+    shift = 1 if any(marker == -1 for _, _, _, marker, _ in cells) else 0
+
+    # give new cells an id, and write it into their marker so they keep it
+    for i, (id, cell_type, source, marker, last) in enumerate(cells):
+        if id is None:
+            id = random_cell_id()
+            kind = "" if cell_type == "code" else f" [{cell_type}]"
+            if marker == -1:
+                buf.api.set_lines(0, 0, True, [f"{prefix} %%{kind} id={id}"])
+            else:
+                buf.api.set_lines(
+                    marker + shift, marker + shift + 1, True, [f"{prefix} %%{kind} id={id}"]
+                )
+        cells[i] = (id, cell_type, source, marker + shift, last + shift)
+
+    changed = document.sync_cells([(id, t, source) for id, t, source, _, _ in cells])  # type: ignore
+
+    outputs = {}
+    for kernel in kernels:
+        for span, output in kernel.outputs.items():
+            if span.bufno == buf.number:
+                outputs[span.begin.lineno] = output.output
+    output_starts = sorted(outputs)
+    for index, (_, cell_type, _, marker, last) in enumerate(cells):
+        if cell_type != "code":
+            continue
+        # the output of the Molten cell that starts inside this notebook cell
+        at = bisect_left(output_starts, marker + 1)
+        if at == len(output_starts) or output_starts[at] > last:
+            continue
+        output = outputs[output_starts[at]]
+        nb_outputs = [
+            nbformat.v4.new_output(chunk.output_type, chunk.jupyter_data, **chunk.extras)
+            if chunk.jupyter_metadata is None
+            else nbformat.v4.new_output(
+                chunk.output_type,
+                chunk.jupyter_data,
+                metadata=chunk.jupyter_metadata,
+                **chunk.extras,
+            )
+            for chunk in output.chunks
+        ]
+        if document.set_outputs(index, nb_outputs, output.execution_count):
+            changed += 1
+
+    document.write(path)
+    buf.options["modified"] = False
+    return changed
@@ -0,0 +1,70 @@
+from typing import Any, Callable
+import json
+
+# orjson, when molten_fast_json is set and it's installed
+_orjson: Any = None
+
+
+def use_orjson(enabled: bool) -> bool:
+    """Encode and decode kernel messages with orjson if enabled and it's installed, the json module
+    is used otherwise.
+    Returns: whether orjson is used"""
+    global _orjson
+    _orjson = None
+    if enabled:
+        try:
+            import orjson
+
+            _orjson = orjson
+        except ImportError:
+            pass
+    return _orjson is not None
+
+
+def dumps(obj: Any) -> bytes:
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj, option=_orjson.OPT_NAIVE_UTC | _orjson.OPT_UTC_Z)
+        except TypeError:
+            # types orjson doesn't know (ie. bytes), or dicts with non str keys
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def loads(data: str | bytes | bytearray | memoryview) -> Any:
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    if _orjson is not None:
+        try:
+            return _orjson.loads(data)
+        except ValueError:
+            # invalid utf-8, which json decodes with replacement characters instead
+            pass
+    if not isinstance(data, str):
+        data = data.decode("utf-8", "replace")
+    return json.loads(data)
+
+
+def configure_session(session: Any) -> None:
+    """Make a jupyter_client Session pack and unpack messages with orjson, when it's used. Anything
+    orjson can't handle goes to the session's own packer and unpacker"""
+    if _orjson is None:
+        return
+    orjson = _orjson
+    pack: Callable[[Any], bytes] = session.pack
+    unpack: Callable[[bytes], Any] = session.unpack
+
+    def fast_pack(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+        except TypeError:
+            return pack(obj)
+
+    def fast_unpack(data: bytes) -> Any:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            return unpack(data)
+
+    session.pack = fast_pack
+    session.unpack = fast_unpack
@@ -1,136 +1,604 @@
 import json
+import logging
 import time
 import uuid
+from collections import deque
+from datetime import datetime, timezone
 from queue import Empty as EmptyQueueException
-from queue import Queue
-from threading import Thread
-from typing import Any, Dict
-from urllib.parse import parse_qs, urlparse
+from queue import Full, Queue
+from threading import Event, Lock, Thread, Timer
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
 
+from molten import json_codec
 from molten.runtime_state import RuntimeState
 
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = "5.3"
+
+# size of the queue of each channel
+QUEUE_SIZES = {
+    "iopub": 10000,
+    "shell": 1000,
+    "stdin": 100,
+    "control": 100,
+}
+
+# seconds between pings while the websocket is quiet, the connection is considered dead when
+# nothing (not even a pong) arrives for two of these
+HEARTBEAT_INTERVAL = 10.
+# first and longest wait in seconds before reconnecting a dropped websocket, the wait doubles
+# with each failed attempt
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.
+
+# seconds to wait for an interrupt_reply before asking the server to interrupt the kernel
+INTERRUPT_REPLY_TIMEOUT = 1.
+
+# binary websocket protocol of jupyter_server 2, see
+# https://jupyter-server.readthedocs.io/en/latest/developers/websocket-protocols.html
+KERNEL_WS_PROTOCOL = "v1.kernel.websocket.jupyter.org"
+
+
+def serialize_ws_msg(msg: Dict[str, Any], channel: str) -> bytes:
+    """Serialize a message for the v1.kernel.websocket.jupyter.org protocol: the number of
+    offsets, the offsets, the channel, then the header, parent header, metadata, content and
+    buffers of the message"""
+    parts = [json_codec.dumps(msg[key])
+             for key in ("header", "parent_header", "metadata", "content")]
+    parts.extend(bytes(buffer) for buffer in msg.get("buffers", []))
+    parts.insert(0, channel.encode("utf-8"))
+
+    offsets = [8 * (len(parts) + 2)]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    return b"".join([len(offsets).to_bytes(8, "little"),
+                     *(offset.to_bytes(8, "little") for offset in offsets),
+                     *parts])
+
+
+def deserialize_ws_msg(data: bytes) -> Dict[str, Any]:
+    """The opposite of serialize_ws_msg. Buffers are memoryviews into data, they're not copied"""
+    view = memoryview(data)
+    count = int.from_bytes(view[:8], "little")
+    offsets = [int.from_bytes(view[8 * (i + 1):8 * (i + 2)], "little") for i in range(count)]
+    parts = [view[offsets[i]:offsets[i + 1]] for i in range(count - 1)]
+
+    msg = {key: json_codec.loads(part)
+           for key, part in zip(("header", "parent_header", "metadata", "content"), parts[1:5])}
+    msg["buffers"] = parts[5:]
+    msg["channel"] = bytes(parts[0]).decode("utf-8")
+    msg["msg_id"] = msg["header"].get("msg_id")
+    msg["msg_type"] = msg["header"].get("msg_type")
+    return msg
+
+
+def deserialize_legacy_binary_msg(data: bytes) -> Dict[str, Any]:
+    """Binary frames of the default (json) protocol, sent for messages with buffers: the number of
+    offsets and the offsets as big endian uint32, the message as json, then the buffers"""
+    view = memoryview(data)
+    count = int.from_bytes(view[:4], "big")
+    offsets = [int.from_bytes(view[4 * (i + 1):4 * (i + 2)], "big") for i in range(count)]
+    offsets.append(len(view))
+    msg = json_codec.loads(view[offsets[0]:offsets[1]])
+    msg["buffers"] = [view[offsets[i]:offsets[i + 1]] for i in range(1, count)]
+    return msg
+
+
+class JupyterServer:
+    """A Jupyter server, shared by all the kernels molten runs on it. Requests go through one
+    requests.Session, so connections are kept alive and reused instead of opening a new one (and
+    doing a new TLS handshake) for each request. Use `get_server` to get one."""
+
+    def __init__(self, base_url: str, headers: Dict[str, str], timeout: float, retries: int):
+        import requests
+
+        self.base_url = base_url
+        self.headers = headers
+        self.session = requests.Session()
+        self.retries: Optional[int] = None
+        self.configure(timeout, retries)
+
+    def configure(self, timeout: float, retries: int) -> None:
+        """Use these settings from now on, for every kernel on the server"""
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeout = timeout
+        if retries == self.retries:
+            return
+        self.retries = retries
+        # only failed connections are retried, requests like restarts aren't safe to send twice
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=8,
+                              max_retries=Retry(total=retries,
+                                                read=False,
+                                                status=False,
+                                                backoff_factor=0.2))
+        old_adapter = self.session.adapters.get("http://")
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if old_adapter is not None:
+            # closes its idle connections
+            old_adapter.close()
+
+    def request(self, method: str, path: str) -> Any:
+        response = self.session.request(method,
+                                        f"{self.base_url}{path}",
+                                        headers=self.headers,
+                                        timeout=self.timeout)
+        return json.loads(response.text) if response.text else None
+
+    def list_kernels(self) -> List[Dict[str, Any]]:
+        return self.request("GET", "/api/kernels")
+
+    def list_sessions(self) -> List[Dict[str, Any]]:
+        """Sessions tie kernels to the notebooks (or consoles) they were started for"""
+        return self.request("GET", "/api/sessions")
+
+    def running_kernels(self) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """The kernels running on the server, each with its sessions"""
+        sessions = self.list_sessions()
+        return [(kernel, [session for session in sessions
+                          if session.get("kernel", {}).get("id") == kernel["id"]])
+                for kernel in self.list_kernels()]
+
+    def find_kernel(self, name: str) -> Optional[Dict[str, Any]]:
+        """The running kernel with the given id (or id prefix), or with a session of the given name
+        or path"""
+        for kernel, sessions in self.running_kernels():
+            if kernel["id"].startswith(name):
+                return kernel
+            for session in sessions:
+                if name in (session.get("name"), session.get("path")):
+                    return kernel
+        return None
+
+
+# servers by base url and token
+_servers: Dict[Tuple[str, Optional[str]], JupyterServer] = {}
+_servers_lock = Lock()
+
+
+def parse_server_url(url: str) -> Tuple[str, Dict[str, str], Optional[str]]:
+    """Split a `MoltenInit` url into the base url of the server, the headers to talk to it, and the
+    kernel= query parameter, if any"""
+    parsed_url = urlparse(url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    query = parse_qs(parsed_url.query)
+
+    token = query.get("token")
+    if token:
+        headers = {'Authorization': f'token {token[0]}'}
+    else:
+        # Run notebook with --NotebookApp.disable_check_xsrf="True".
+        headers = {}
+
+    kernel = query.get("kernel")
+    return base_url, headers, kernel[0] if kernel else None
+
+
+def get_server(url: str, timeout: float = 10., retries: int = 3) -> JupyterServer:
+    base_url, headers, _ = parse_server_url(url)
+    key = (base_url, headers.get("Authorization"))
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is None:
+            server = JupyterServer(base_url, headers, timeout, retries)
+            _servers[key] = server
+        else:
+            # the options may have changed since the server was first used
+            server.configure(timeout, retries)
+        return server
+
+
+def with_kernel(url: str, kernel: str) -> str:
+    """url with its kernel= query parameter set to kernel"""
+    parsed_url = urlparse(url)
+    query = parse_qs(parsed_url.query)
+    query["kernel"] = [kernel]
+    return parsed_url._replace(query=urlencode(query, doseq=True)).geturl()
+
+
+def server_kernel_choices(url: str, timeout: float, retries: int) -> List[Tuple[str, str]]:
+    """The kernels running on the server at url, as (description, url to attach to the kernel)
+    pairs to pick from. Empty if there are none"""
+    choices = []
+    for kernel, sessions in get_server(url, timeout, retries).running_kernels():
+        description = f"{kernel.get('name')} {kernel['id'][:8]}"
+        paths = [session.get("path") or session.get("name") for session in sessions]
+        if len(paths) > 0:
+            description += f" ({', '.join(path for path in paths if path)})"
+        description += f" [{kernel.get('execution_state', 'unknown')}]"
+        choices.append((description, with_kernel(url, kernel["id"])))
+    if len(choices) > 0:
+        choices.insert(0, ("new kernel", with_kernel(url, "new")))
+    return choices
+
 
 class JupyterAPIClient:
     def __init__(self,
-                 url: str,
+                 server: JupyterServer,
                  kernel_info: Dict[str, Any],
-                 headers: Dict[str, str]):
-        self._base_url = url
+                 delete_on_shutdown: bool = True):
+        self._server = server
+        self._base_url = server.base_url
         self._kernel_info = kernel_info
-        self._headers = headers
+        self._headers = server.headers
+        self._delete_on_shutdown = delete_on_shutdown
 
-        self._recv_queue: Queue[Dict[str, Any]] = Queue()
+        # The channels websocket carries the messages of every channel, they're sorted into a
+        # queue per channel. Queues are bounded, when one is full its oldest message is dropped,
+        # so a channel nobody reads from (ie. shell replies) can't grow forever.
+        self._queues: Dict[str, Queue[Dict[str, Any]]] = {
+            channel: Queue(maxsize) for channel, maxsize in QUEUE_SIZES.items()
+        }
+        # All our requests belong to one session, replies to anyone else's requests (ie. another
+        # frontend connected to the same kernel) are dropped.
+        self.session_id = uuid.uuid4().hex
 
-        import requests
-        self.requests = requests
+        # Readiness and execution state come from the status messages on the websocket, the REST
+        # API is never polled for them.
+        self._ready = Event()
+        self._kernel_info_msg_id = None
+        self._interrupt_msg_id = None
+        self.execution_state = "starting"
+        # content of the kernel_info_reply the kernel became ready with
+        self.kernel_info_reply: Optional[Dict[str, Any]] = None
+        # pings in flight, and the ids of recent pings, whose status messages are still coming
+        self._pings: Dict[str, Event] = {}
+        self._ping_ids: Deque[str] = deque(maxlen=16)
 
-    def get_stdin_msg(self, **kwargs):
-        return None
+        # Messages sent while the websocket is down wait here until it's reconnected.
+        self._send_lock = Lock()
+        self._outbox: List[Tuple[Dict[str, Any], str]] = []
+        self._connected = Event()
+        self._closing = Event()
 
-    def wait_for_ready(self, timeout: float = 0.):
-        start = time.time()
-        while True:
-            response = self.requests.get(self._kernel_api_base,
-                                    headers=self._headers)
-            response = json.loads(response.text)
+        # Problems on the receiving thread, reported to the user by take_warnings.
+        self._warnings_lock = Lock()
+        self._bad_messages = 0
+        self._last_bad_message = ""
+        self._dropped_outputs = 0
 
-            if response["execution_state"] != "idle" and time.time() - start > timeout:
-                raise RuntimeError
+    def wait_for_ready(self, timeout: float = 0.):
+        # Called on every tick until the kernel is ready, so this must not block with timeout=0.
+        if not self._ready.wait(timeout):
+            raise RuntimeError
 
-            # Discard unnecessary messages.
-            while True:
-                try:
-                    response = self.get_iopub_msg()
-                except EmptyQueueException:
-                    return
+    def request_kernel_info(self) -> None:
+        """Ask the kernel for its info, the kernel is ready once it replies. Used to find out when
+        the kernel is ready after (re)starting, since an idle kernel sends no status messages on
+        its own."""
+        self._ready.clear()
+        # set before sending, the reply is handled on the receiving thread
+        self._kernel_info_msg_id = uuid.uuid1().hex
+        self._send("kernel_info_request", {}, msg_id=self._kernel_info_msg_id)
 
+    def ping(self, timeout: float) -> Optional[float]:
+        """Round trip time of a kernel_info_request on the control channel, which kernels answer
+        even while running code. None when there's no reply within timeout"""
+        msg_id = uuid.uuid1().hex
+        replied = Event()
+        self._pings[msg_id] = replied
+        self._ping_ids.append(msg_id)
+        start = time.monotonic()
+        try:
+            self._send("kernel_info_request", {}, channel="control", msg_id=msg_id)
+            if not replied.wait(timeout):
+                return None
+            return time.monotonic() - start
+        finally:
+            del self._pings[msg_id]
 
     def start_channels(self) -> None:
+        self._kernel_api_base = f"/api/kernels/{self._kernel_info['id']}"
+        self._connect()
+        self._connected.set()
+
+        self._iopub_recv_thread = Thread(target=self._recv_message, daemon=True)
+        self._iopub_recv_thread.start()
+
+        self.request_kernel_info()
+
+    def _connect(self) -> None:
         import websocket
 
         parsed_url = urlparse(self._base_url)
-        self._socket = websocket.create_connection(f"ws://{parsed_url.hostname}:{parsed_url.port}"
-                                                   f"/api/kernels/{self._kernel_info['id']}/channels",
+        scheme = "wss" if parsed_url.scheme == "https" else "ws"
+        # The session id stays the same across reconnects, so the server replays the messages it
+        # buffered while we were gone.
+        self._socket = websocket.create_connection(f"{scheme}://{parsed_url.netloc}"
+                                                   f"/api/kernels/{self._kernel_info['id']}/channels"
+                                                   f"?session_id={self.session_id}",
                                                    header=self._headers,
+                                                   subprotocols=[KERNEL_WS_PROTOCOL],
+                                                   timeout=HEARTBEAT_INTERVAL,
+                                                   enable_multithread=True,
                                                    )
-        self._kernel_api_base = f"{self._base_url}/api/kernels/{self._kernel_info['id']}"
-
-        self._iopub_recv_thread = Thread(target=self._recv_message)
-        self._iopub_recv_thread.start()
+        # older servers don't know the binary protocol and stick to json
+        self._binary = self._socket.getsubprotocol() == KERNEL_WS_PROTOCOL
 
     def _recv_message(self) -> None:
+        """Receive messages until shutdown, reconnecting with backoff whenever the connection
+        drops"""
+        import websocket
+
+        attempt = 0
+        reconnecting = False
+        while not self._closing.is_set():
+            try:
+                if reconnecting:
+                    self._connect()
+                    reconnecting = False
+                    attempt = 0
+                    self._flush_outbox()
+                self._recv_frames()
+            except (websocket.WebSocketException, OSError):
+                if self._closing.is_set():
+                    return
+                self._connected.clear()
+                # no closing handshake, the other end is probably gone
+                self._socket.shutdown()
+                reconnecting = True
+                self._closing.wait(min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt))
+                attempt += 1
+
+    def _recv_frames(self) -> None:
+        import websocket
+        from websocket import ABNF
+
+        last_seen = time.monotonic()
+        while not self._closing.is_set():
+            try:
+                opcode, frame = self._socket.recv_data_frame(True)
+            except websocket.WebSocketTimeoutException:
+                # quiet for a while, make sure the other end is still there
+                if time.monotonic() - last_seen > 2 * HEARTBEAT_INTERVAL:
+                    raise
+                self._socket.ping()
+                continue
+
+            last_seen = time.monotonic()
+            if opcode == ABNF.OPCODE_CLOSE:
+                raise websocket.WebSocketConnectionClosedException("closed by the server")
+            if opcode in (ABNF.OPCODE_PING, ABNF.OPCODE_PONG):
+                continue
+            try:
+                self._handle_message(self._decode(frame.data, opcode == ABNF.OPCODE_TEXT))
+            except Exception as err:
+                # A message that can't be decoded or handled is skipped, the connection is fine.
+                logger.exception("Skipped a kernel message")
+                with self._warnings_lock:
+                    self._bad_messages += 1
+                    self._last_bad_message = f"{type(err).__name__}: {err}"
+
+    def _handle_message(self, response: Dict[str, Any]) -> None:
+        msg_type = response.get("msg_type") or response.get("header", {}).get("msg_type")
+        if msg_type == "status":
+            # the state of the kernel, no matter whose request it's working on
+            self.execution_state = response["content"]["execution_state"]
+            if self.execution_state in ("starting", "restarting"):
+                # The kernel went away, it's ready again once it answers a kernel_info_request.
+                # These aren't the output of any cell, so they're kept out of the queue.
+                self._ready.clear()
+                return
+
+        parent = response.get("parent_header") or {}
+        if parent.get("session", self.session_id) != self.session_id:
+            return
+
+        parent_id = parent.get("msg_id")
+        if parent_id in self._ping_ids:
+            # ping() drops the event on its own thread once it stops waiting, get it only once
+            replied = self._pings.get(parent_id)
+            if msg_type == "kernel_info_reply" and replied is not None:
+                replied.set()
+            return
+        if parent_id is not None and parent_id == self._kernel_info_msg_id:
+            # The messages of our own kernel_info_request aren't anyone's output.
+            if msg_type == "kernel_info_reply":
+                self.kernel_info_reply = response.get("content")
+                self._ready.set()
+            elif msg_type == "status" and self.execution_state == "idle":
+                self._kernel_info_msg_id = None
+            return
+        if msg_type == "interrupt_reply" and parent_id == self._interrupt_msg_id:
+            self._interrupt_msg_id = None
+
+        queue = self._queues.get(response.get("channel", "iopub"), self._queues["iopub"])
         while True:
-            response = json.loads(self._socket.recv())
-            self._recv_queue.put(response)
+            try:
+                queue.put_nowait(response)
+                break
+            except Full:
+                try:
+                    queue.get_nowait()
+                except EmptyQueueException:
+                    continue
+                # nobody reads the replies on the other channels, but iopub is cell output
+                if queue is self._queues["iopub"]:
+                    with self._warnings_lock:
+                        self._dropped_outputs += 1
+
+    def take_warnings(self) -> List[str]:
+        """What went wrong on the receiving thread since the last call: messages that were
+        skipped because they couldn't be read, and output that was dropped because it arrived
+        faster than it was taken"""
+        warnings = []
+        with self._warnings_lock:
+            if self._bad_messages > 0:
+                warnings.append(f"Skipped {self._bad_messages} kernel message(s) that couldn't "
+                                f"be read. Last error: {self._last_bad_message}")
+            if self._dropped_outputs > 0:
+                warnings.append(f"Kernel output arrived faster than it could be shown, dropped "
+                                f"the oldest {self._dropped_outputs} message(s)")
+            self._bad_messages = 0
+            self._dropped_outputs = 0
+        return warnings
+
+    def _decode(self, frame: bytes, text: bool) -> Dict[str, Any]:
+        if text:
+            return json_codec.loads(frame)
+        if self._binary:
+            return deserialize_ws_msg(frame)
+        return deserialize_legacy_binary_msg(frame)
+
+    def _get_msg(self, channel: str, timeout: Optional[float]) -> Dict[str, Any]:
+        # same as jupyter_client: block with timeout=None, raise Empty right away with timeout=0
+        block = timeout is None or timeout > 0
+        return self._queues[channel].get(block, timeout)
+
+    def get_iopub_msg(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self._get_msg("iopub", timeout)
 
-    def get_iopub_msg(self, **kwargs):
-        if self._recv_queue.empty():
-            raise EmptyQueueException
+    def get_shell_msg(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self._get_msg("shell", timeout)
 
-        response = self._recv_queue.get()
+    def get_stdin_msg(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self._get_msg("stdin", timeout)
 
-        return response
+    def get_control_msg(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self._get_msg("control", timeout)
 
-    def execute(self, code: str):
+    def _send(self,
+              msg_type: str,
+              content: Dict[str, Any],
+              channel: str = "shell",
+              msg_id: Optional[str] = None) -> str:
         header = {
-            'msg_type': 'execute_request',
-            'msg_id': uuid.uuid1().hex,
-            'session': uuid.uuid1().hex
+            'msg_id': msg_id or uuid.uuid1().hex,
+            'msg_type': msg_type,
+            'session': self.session_id,
+            'username': "molten",
+            'date': datetime.now(timezone.utc).isoformat(),
+            'version': PROTOCOL_VERSION,
         }
 
-        message = json.dumps({
+        message = {
             'header': header,
-            'parent_header': header,
+            'parent_header': {},
             'metadata': {},
-            'content': {
-                'code': code,
-                'silent': False
-            }
+            'content': content,
+        }
+        with self._send_lock:
+            if self._connected.is_set():
+                try:
+                    self._write(message, channel)
+                    return header['msg_id']
+                except Exception:
+                    # the receiving thread notices too, and reconnects
+                    self._connected.clear()
+            self._outbox.append((message, channel))
+        return header['msg_id']
+
+    def _write(self, message: Dict[str, Any], channel: str) -> None:
+        if self._binary:
+            self._socket.send_binary(serialize_ws_msg(message, channel))
+        else:
+            self._socket.send(json_codec.dumps({**message, 'channel': channel}))
+
+    def _flush_outbox(self) -> None:
+        with self._send_lock:
+            while len(self._outbox) > 0:
+                self._write(*self._outbox[0])
+                self._outbox.pop(0)
+            self._connected.set()
+
+    def execute(self,
+                code: str,
+                silent: bool = False,
+                store_history: bool = True,
+                user_expressions: Optional[Dict[str, str]] = None) -> str:
+        return self._send('execute_request', {
+            'code': code,
+            'silent': silent,
+            'store_history': store_history,
+            'user_expressions': user_expressions or {},
+            'allow_stdin': True,
+            'stop_on_error': True,
         })
-        self._socket.send(message)
+
+    def input(self, string: str) -> None:
+        """Answer the kernel's last input_request"""
+        self._send('input_reply', {'value': string}, channel="stdin")
+
+    def interrupt(self) -> None:
+        """Interrupt the kernel with an interrupt_request on the control channel. Kernels that only
+        take interrupts as signals never reply, the server is asked to signal those instead."""
+        self._interrupt_msg_id = uuid.uuid1().hex
+        self._send('interrupt_request', {}, channel="control", msg_id=self._interrupt_msg_id)
+        timer = Timer(INTERRUPT_REPLY_TIMEOUT, self._interrupt_fallback, (self._interrupt_msg_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _interrupt_fallback(self, msg_id: str) -> None:
+        if self._interrupt_msg_id == msg_id:
+            self._interrupt_msg_id = None
+            self._server.request("POST", f"{self._kernel_api_base}/interrupt")
+
+    def stop_channels(self) -> None:
+        """Close the websocket and wait for the receiving thread to exit"""
+        self._closing.set()
+        self._connected.clear()
+        try:
+            self._socket.send_close()
+        except Exception:
+            pass
+        # unblocks the receiving thread
+        self._socket.shutdown()
+        self._iopub_recv_thread.join(1.)
 
     def shutdown(self):
-        self.requests.delete(self._kernel_api_base,
-                        headers=self._headers)
+        self.stop_channels()
+        if self._delete_on_shutdown:
+            self._server.request("DELETE", self._kernel_api_base)
 
     def cleanup_connection_file(self):
         pass
 
 class JupyterAPIManager:
+    """Runs one kernel on a Jupyter server. `url` is the url of the server, with a kernel= query
+    parameter to attach to a kernel that's already running: it's matched against the ids of the
+    kernels, and the names and paths of their sessions."""
+
     def __init__(self,
                  url: str,
+                 timeout: float = 10.,
+                 retries: int = 3,
+                 keep_kernel: bool = False,
                  ):
-        parsed_url = urlparse(url)
-        self._base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-
-        token = parse_qs(parsed_url.query).get("token")
-        if token:
-            self._headers = {'Authorization': f'token {token[0]}'}
-        else:
-            # Run notebook with --NotebookApp.disable_check_xsrf="True".
-            self._headers = {}
-
-        import requests
-        self.requests = requests
+        self._server = get_server(url, timeout, retries)
+        _, _, self._kernel_query = parse_server_url(url)
+        self._keep_kernel = keep_kernel
+        self.attached = False
 
     def start_kernel(self) -> None:
-        url = f"{self._base_url}/api/kernels"
-        response = self.requests.post(url,
-                                 headers=self._headers)
-        self._kernel_info = json.loads(response.text)
-        assert "id" in self._kernel_info, "Could not connect to Jupyter Server API. The URL specified may be incorrect."
-        self._kernel_api_base = f"{url}/{self._kernel_info['id']}"
+        if self._kernel_query is not None and self._kernel_query != "new":
+            kernel_info = self._server.find_kernel(self._kernel_query)
+            if kernel_info is None:
+                raise RuntimeError(f"No kernel '{self._kernel_query}' running on "
+                                   f"{self._server.base_url}")
+            self._kernel_info = kernel_info
+            self.attached = True
+        else:
+            self._kernel_info = self._server.request("POST", "/api/kernels")
+            assert "id" in self._kernel_info, "Could not connect to Jupyter Server API. The URL specified may be incorrect."
+        self._kernel_api_base = f"/api/kernels/{self._kernel_info['id']}"
 
     def client(self) -> JupyterAPIClient:
-        return JupyterAPIClient(url=self._base_url,
-                                kernel_info=self._kernel_info,
-                                headers=self._headers)
+        # kernels we attached to belong to someone else, they're left running
+        self._client = JupyterAPIClient(server=self._server,
+                                        kernel_info=self._kernel_info,
+                                        delete_on_shutdown=not (self.attached or self._keep_kernel))
+        return self._client
 
     def interrupt_kernel(self) -> None:
-        self.requests.post(f"{self._kernel_api_base}/interrupt",
-                      headers=self._headers)
+        self._client.interrupt()
 
     def restart_kernel(self) -> None:
         self.state = RuntimeState.STARTING
-        self.requests.post(f"{self._kernel_api_base}/restart",
-                      headers=self._headers)
+        self._server.request("POST", f"{self._kernel_api_base}/restart")
+        # The server answers once the kernel is back, the client finds out when it's ready.
+        self._client.request_kernel_info()
@@ -1,20 +1,23 @@
 from contextlib import AbstractContextManager
 from datetime import datetime
-from typing import IO, Callable, List, Optional, Dict, Tuple
+from typing import IO, Any, Callable, List, Optional, Dict, Tuple
 from queue import Queue
 import hashlib
 
 from pynvim import Nvim
 from pynvim.api import Buffer
 from molten.code_cell import CodeCell
+from molten.heartbeat import HeartbeatMonitor
 
 from molten.options import MoltenOptions
 from molten.images import Canvas
 from molten.position import Position
-from molten.utils import notify_error, notify_info, notify_warn
+from molten.utils import MoltenException, notify_error, notify_info, notify_warn
 from molten.outputbuffer import OutputBuffer
-from molten.outputchunks import ImageOutputChunk, OutputChunk, OutputStatus
+from molten.outputchunks import ImageOutputChunk, OutputChunk, OutputStatus, to_outputchunk
+from molten.recording import MessageReplay
 from molten.runtime import JupyterRuntime
+from molten.runtime_state import RuntimeState
 
 
 class MoltenKernel:
@@ -42,6 +45,8 @@ class MoltenKernel:
 
     options: MoltenOptions
     output_statuses: Dict[Optional[CodeCell], OutputStatus]
+    output_done_callbacks: List[Callable[["MoltenKernel", CodeCell], None]]
+    heartbeat: Optional[HeartbeatMonitor]
 
     def __init__(
         self,
@@ -73,6 +78,8 @@ class MoltenKernel:
         self.output_statuses = {}
         self.should_show_floating_win = False
         self.updating_interface = False
+        self.output_done_callbacks = []
+        self.heartbeat = None
 
         self.options = options
 
@@ -87,6 +94,8 @@ class MoltenKernel:
 
     def deinit(self) -> None:
         self._doautocmd("MoltenDeinitPre")
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
         self.runtime.deinit()
         self._doautocmd("MoltenDeinitPost")
 
@@ -108,11 +117,31 @@ class MoltenKernel:
         self.runtime.restart()
 
     def run_code(self, code: str, span: CodeCell) -> None:
+        if self.runtime.state == RuntimeState.DEAD:
+            raise MoltenException(
+                f"Kernel '{self.runtime.kernel_name}' (id: {self.kernel_id}) isn't responding. "
+                "Restart it with :MoltenRestart"
+            )
         if not self.try_delete_overlapping_cells(span):
             return
-        self.output_statuses[span] = OutputStatus.RUNNING
         self.runtime.run_code(code)
+        self._add_output(span)
+
+    def replay(self, replay: MessageReplay, span: CodeCell) -> None:
+        """Play a recording of kernel messages back into a new output for span, as if the kernel
+        was running the cell"""
+        if self.runtime.replay is not None or not self.queued_outputs.empty() or (
+            self.current_output in self.outputs
+            and self.outputs[self.current_output].output.status != OutputStatus.DONE
+        ):
+            raise MoltenException("Wait for the running cells to finish before replaying")
+        if not self.try_delete_overlapping_cells(span):
+            return
+        self.runtime.replay = replay
+        self._add_output(span)
 
+    def _add_output(self, span: CodeCell) -> None:
+        self.output_statuses[span] = OutputStatus.RUNNING
         self.outputs[span] = OutputBuffer(
             self.nvim, self.canvas, self.extmark_namespace, self.options
         )
@@ -208,6 +237,59 @@ class MoltenKernel:
 
         return True
 
+    def fetch_full_output(self) -> bool:
+        """Replace the outputs of the currently selected cell that were cut down by the output
+        governor with the full payload the kernel kept for them. The outputs are replaced as the
+        kernel's replies come in.
+        Returns: True if we're in a cell, False otherwise"""
+        self.selected_cell = self._get_selected_span()
+        if self.selected_cell is None:
+            return False
+
+        output_buffer = self.outputs[self.selected_cell]
+        requested = 0
+        for chunk in output_buffer.output.chunks:
+            key = (chunk.jupyter_metadata or {}).get("molten", {}).get("governed")
+            if key is None:
+                continue
+            self.runtime.fetch_full_payload(
+                key,
+                lambda data, metadata, chunk=chunk: self._replace_chunk(
+                    output_buffer, chunk, data, metadata
+                ),
+            )
+            requested += 1
+
+        if requested == 0:
+            notify_warn(self.nvim, "No truncated outputs to fetch in this cell")
+            return True
+
+        notify_info(self.nvim, f"Fetching {requested} full output(s)")
+        return True
+
+    def _replace_chunk(
+        self,
+        output_buffer: OutputBuffer,
+        chunk: OutputChunk,
+        data: Dict[str, Any],
+        metadata: Dict[str, Any],
+    ) -> None:
+        chunks = output_buffer.output.chunks
+        spans = [span for span, buf in self.outputs.items() if buf is output_buffer]
+        indices = [i for i, c in enumerate(chunks) if c is chunk]
+        # the cell may have been re-run or deleted while the kernel was answering
+        if len(spans) == 0 or len(indices) == 0:
+            return
+        chunks[indices[0]] = to_outputchunk(
+            self.nvim, self.runtime._alloc_file, data, metadata, self.options
+        )
+
+        # redraw the output with the new chunk, the interface is updated at the end of the tick
+        output_buffer.clear_float_win()
+        if output_buffer.virt_text_id is not None:
+            output_buffer.clear_virt_output(spans[0].bufno)
+            output_buffer.virt_hidden = False
+
     def _check_if_done_running(self) -> None:
         # TODO: refactor
         is_idle = (self.current_output is None or not self.current_output in self.outputs) or (
@@ -244,10 +326,21 @@ class MoltenKernel:
                 # Update the output status
                 self.output_statuses[self.current_output] = output.status
 
+                for callback in self.output_done_callbacks:
+                    callback(self, self.current_output)
+
         if self.options.output_show_exec_time or did_stuff:
             self.update_interface()
 
         if not was_ready and self.runtime.is_ready():
+            if self.heartbeat is None and self.options.heartbeat_interval > 0:
+                self.heartbeat = HeartbeatMonitor(
+                    self.nvim,
+                    self.runtime.kernel_client,
+                    self.options.heartbeat_interval,
+                    self.options.heartbeat_timeout,
+                    self._on_heartbeat_change,
+                )
             self._doautocmd(
                 "MoltenKernelReady",
                 opts={
@@ -261,6 +354,24 @@ class MoltenKernel:
                 f"Kernel '{self.runtime.kernel_name}' (id: {self.kernel_id}) is ready.",
             )
 
+    def _on_heartbeat_change(self, alive: bool) -> None:
+        if not alive:
+            if self.runtime.state == RuntimeState.STARTING:
+                # restarting kernels don't answer
+                return
+            self.runtime.mark_dead()
+            self._doautocmd("MoltenKernelDead", opts={"data": {"kernel_id": self.kernel_id}})
+            notify_error(
+                self.nvim,
+                f"Kernel '{self.runtime.kernel_name}' (id: {self.kernel_id}) stopped responding.",
+            )
+        elif self.runtime.state == RuntimeState.DEAD:
+            self.runtime.revive()
+            notify_info(
+                self.nvim,
+                f"Kernel '{self.runtime.kernel_name}' (id: {self.kernel_id}) is responding again.",
+            )
+
     def tick_input(self) -> None:
         self.runtime.tick_input()
 
@@ -466,10 +577,19 @@ class MoltenKernel:
             self.outputs[span].clear_float_win()
 
     def _get_content_checksum(self) -> str:
+        return self.nvim.lua._content_hash.checksum(0)
+
+    def _get_legacy_content_checksum(self) -> str:
+        """The checksum of version 1 save files"""
         return hashlib.md5(
             "\n".join(self.nvim.current.buffer.api.get_lines(0, -1, True)).encode("utf-8")
         ).hexdigest()
 
+    def get_line_hashes(self, bufnr: int, ranges: List[Tuple[int, int]]) -> List[List[str]]:
+        """Hashes of the lines in each [first, last) range of the buffer, -1 for the end of the
+        buffer. Only lines that changed since they were last hashed are sent over and hashed."""
+        return self.nvim.lua._content_hash.line_hashes(bufnr, ranges)
+
 
 def write_html_from_chunks(
     chunks: List[OutputChunk],
@@ -0,0 +1,347 @@
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import re
+import tempfile
+import uuid
+
+NOTEBOOK_VERSION = 4
+
+# mimetypes besides text/* that nbformat stores as a list of lines
+_SPLIT_MIMETYPES = {"application/javascript", "image/svg+xml"}
+
+
+def split_output_lines(output: Dict[str, Any]) -> Dict[str, Any]:
+    """Split the multiline strings of an output into lists of lines, the way nbformat writes them
+    (see nbformat.v4.rwbase.split_lines)"""
+    data = output.get("data")
+    if isinstance(data, dict):
+        for mimetype, value in data.items():
+            if isinstance(value, str) and (
+                mimetype.startswith("text/") or mimetype in _SPLIT_MIMETYPES
+            ):
+                data[mimetype] = value.splitlines(True)
+    if output.get("output_type") == "stream" and isinstance(output.get("text"), str):
+        output["text"] = output["text"].splitlines(True)
+    return output
+
+
+def join_output_lines(output: Dict[str, Any]) -> Dict[str, Any]:
+    """The opposite of split_output_lines, returns a copy of the output with its lists of lines
+    joined back into strings"""
+    output = dict(output)
+    data = output.get("data")
+    if isinstance(data, dict):
+        output["data"] = {
+            mimetype: "".join(value)
+            if isinstance(value, list) and all(isinstance(line, str) for line in value)
+            else value
+            for mimetype, value in data.items()
+        }
+    if isinstance(output.get("text"), list):
+        output["text"] = "".join(output["text"])
+    return output
+
+
+def random_cell_id() -> str:
+    # same as nbformat.corpus.words.generate_corpus_id
+    return uuid.uuid4().hex[:8]
+
+
+def _digest(value: Any) -> str:
+    raw = json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _serialize_cell(cell: Dict[str, Any]) -> str:
+    # indented to sit in the cells list of the document, same as json.dumps(nb, indent=1)
+    return "  " + json.dumps(cell, indent=1, sort_keys=True, ensure_ascii=False).replace(
+        "\n", "\n  "
+    )
+
+
+class NotebookDocument:
+    """A notebook read as plain json. Each cell remembers how it was serialized and a digest of its
+    outputs, so writing the notebook again only serializes the cells whose outputs changed. Use
+    `NotebookDocument.open` to get a document, it reuses the last document read or written at the
+    same path while the file on disk is unchanged."""
+
+    cells: List[Dict[str, Any]]
+    rest: Dict[str, Any]
+    serialized: List[Optional[str]]
+    digests: List[Optional[str]]
+
+    def __init__(self, cells: List[Dict[str, Any]], rest: Dict[str, Any]):
+        self.cells = cells
+        self.rest = rest
+        self.serialized = [None] * len(cells)
+        self.digests = [None] * len(cells)
+
+    @classmethod
+    def read(cls, path: str) -> "NotebookDocument":
+        with open(path, encoding="utf-8") as file:
+            raw = json.load(file)
+        if raw.get("nbformat") != NOTEBOOK_VERSION:
+            # let nbformat upgrade older notebooks, nothing is reused for those
+            import nbformat
+
+            raw = json.loads(json.dumps(nbformat.read(path, as_version=NOTEBOOK_VERSION)))
+            document = cls(raw.pop("cells"), raw)
+        else:
+            document = cls(raw.pop("cells"), raw)
+            # cells are serialized exactly as they were read
+            document.serialized = [_serialize_cell(cell) for cell in document.cells]
+        return document
+
+    @classmethod
+    def open(cls, path: str) -> "NotebookDocument":
+        """A copy of the document at path, cached documents are reused while the file is
+        unchanged. Changes to the copy don't affect the cache until it's written"""
+        path = os.path.abspath(path)
+        with _cache_lock:
+            cached = _cache.get(path)
+        if cached is None or cached[0] != _stat(path):
+            document = cls.read(path)
+            with _cache_lock:
+                _cache[path] = (_stat(path), document)
+        else:
+            document = cached[1]
+        return document.copy()
+
+    def copy(self) -> "NotebookDocument":
+        # cells are replaced, never modified, so a shallow copy is enough
+        document = NotebookDocument(list(self.cells), self.rest)
+        document.serialized = list(self.serialized)
+        document.digests = list(self.digests)
+        return document
+
+    def source(self, index: int) -> str:
+        source = self.cells[index].get("source", "")
+        return "".join(source) if isinstance(source, list) else source
+
+    def kernel_name(self) -> Optional[str]:
+        return self.rest.get("metadata", {}).get("kernelspec", {}).get("name")
+
+    def language(self) -> Optional[str]:
+        metadata = self.rest.get("metadata", {})
+        return metadata.get("kernelspec", {}).get("language") or metadata.get(
+            "language_info", {}
+        ).get("name")
+
+    def ensure_ids(self) -> None:
+        """Give every cell an id (added in nbformat 4.5), so cells can be tracked across edits"""
+        for i, cell in enumerate(self.cells):
+            if not cell.get("id"):
+                self.cells[i] = {**cell, "id": random_cell_id()}
+                self.serialized[i] = None
+        if self.rest.get("nbformat_minor", 0) < 5:
+            self.rest = {**self.rest, "nbformat_minor": 5}
+
+    def sync_cells(self, cells: List[Tuple[str, str, str]]) -> int:
+        """Make the cells of the document match the given (id, cell type, source) cells, in
+        order. Cells are matched by id: unchanged cells are kept as they are (along with their
+        serialization), edited cells keep their metadata and outputs, cells with unknown ids are
+        added, and cells that aren't given are dropped.
+        Returns: the number of cells that were added or changed"""
+        by_id = {cell.get("id"): i for i, cell in enumerate(self.cells)}
+        new_cells = []
+        new_serialized: List[Optional[str]] = []
+        new_digests: List[Optional[str]] = []
+        matched = set()
+        changed = 0
+        for id, cell_type, source in cells:
+            index = by_id.get(id)
+            if index is not None:
+                matched.add(index)
+            if index is not None and self.cells[index]["cell_type"] == cell_type:
+                # the text form can't hold trailing blank lines, they're not an edit
+                if trim_trailing_blank_lines(self.source(index)) == trim_trailing_blank_lines(
+                    source
+                ):
+                    new_cells.append(self.cells[index])
+                    new_serialized.append(self.serialized[index])
+                    new_digests.append(self.digests[index])
+                    continue
+                if self.source(index).endswith("\n") and not source.endswith("\n"):
+                    # keep the cell's trailing newline through the edit
+                    source += "\n"
+                cell = {**self.cells[index], "source": source.splitlines(True)}
+            else:
+                cell = {"cell_type": cell_type, "id": id, "metadata": {}}
+                if index is not None:
+                    cell["metadata"] = self.cells[index].get("metadata", {})
+                if cell_type == "code":
+                    cell["execution_count"] = None
+                    cell["outputs"] = []
+                cell["source"] = source.splitlines(True)
+            new_cells.append(cell)
+            new_serialized.append(None)
+            new_digests.append(None)
+            changed += 1
+
+        # dropped cells
+        changed += len(self.cells) - len(matched)
+        self.cells = new_cells
+        self.serialized = new_serialized
+        self.digests = new_digests
+        return changed
+
+    def outputs_digest(self, index: int) -> str:
+        if self.digests[index] is None:
+            cell = self.cells[index]
+            self.digests[index] = _digest([cell.get("execution_count"), cell.get("outputs", [])])
+        return self.digests[index]  # type: ignore
+
+    def set_outputs(
+        self, index: int, outputs: List[Dict[str, Any]], execution_count: Optional[int]
+    ) -> bool:
+        """Replace the outputs of a code cell, outputs are split into lines like nbformat does.
+        Returns: whether the cell changed"""
+        outputs = [split_output_lines(output) for output in outputs]
+        digest = _digest([execution_count, outputs])
+        if digest == self.outputs_digest(index):
+            return False
+        self.cells[index] = {**self.cells[index], "outputs": outputs}
+        self.cells[index]["execution_count"] = execution_count
+        self.serialized[index] = None
+        self.digests[index] = digest
+        return True
+
+    def write(self, path: str) -> None:
+        """Write the document to path atomically: it's streamed to a temp file next to path, which
+        then replaces path. Only cells that changed since they were read are serialized. A
+        symlinked notebook is written through the link, and keeps its permissions."""
+        path = os.path.abspath(path)
+        target = os.path.realpath(path)
+        mode = _file_mode(target)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(target), prefix=".molten-", suffix=".ipynb"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write('{\n "cells": [')
+                for i, cell in enumerate(self.cells):
+                    if self.serialized[i] is None:
+                        self.serialized[i] = _serialize_cell(cell)
+                    file.write(",\n" if i > 0 else "\n")
+                    file.write(self.serialized[i])  # type: ignore
+                file.write("\n ]" if len(self.cells) > 0 else "]")
+                rest = json.dumps(self.rest, indent=1, sort_keys=True, ensure_ascii=False)
+                # splice the remaining keys in after the cells, they all sort after "cells"
+                file.write(",\n" + rest[2:] if len(self.rest) > 0 else "\n}")
+                file.write("\n")
+                file.flush()
+                os.fsync(file.fileno())
+            # mkstemp creates the file readable by us only
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with _cache_lock:
+            _cache[path] = (_stat(path), self.copy())
+
+
+def _file_mode(path: str) -> int:
+    """The permissions of the file at path, or the ones a new file would get"""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def trim_trailing_blank_lines(source: str) -> str:
+    """The text form (see parse_cells) doesn't keep the trailing blank lines of a cell, so sources
+    are compared without them"""
+    lines = source.split("\n")
+    while len(lines) > 0 and lines[-1].strip() == "":
+        lines.pop()
+    return "\n".join(lines)
+
+
+def cell_marker_pattern(prefix: str) -> "re.Pattern[str]":
+    return re.compile(
+        "^" + re.escape(prefix) + r" %%(?: \[(?P<type>markdown|raw)\])?(?: id=(?P<id>\S+))?\s*$"
+    )
+
+
+def render_cells(
+    document: NotebookDocument, prefix: str
+) -> Tuple[List[str], List[Tuple[int, int, int]]]:
+    """Render the notebook as text in the percent format: each cell starts with a
+    `<prefix> %% id=<id>` line (`<prefix> %% [markdown] id=<id>` for markdown and raw cells), the
+    lines of markdown and raw cells are commented out with prefix.
+    Returns: the lines, and the (first line, last line, cell index) of the non empty code cells"""
+    lines: List[str] = []
+    code_cells = []
+    for i, cell in enumerate(document.cells):
+        if len(lines) > 0:
+            lines.append("")
+        source = document.source(i).split("\n")
+        if cell["cell_type"] == "code":
+            lines.append(f"{prefix} %% id={cell['id']}")
+            start = len(lines)
+            lines.extend(source)
+            if document.source(i).strip() != "":
+                code_cells.append((start, len(lines) - 1, i))
+        else:
+            lines.append(f"{prefix} %% [{cell['cell_type']}] id={cell['id']}")
+            lines.extend(f"{prefix} {line}" if line != "" else prefix for line in source)
+    return lines, code_cells
+
+
+def parse_cells(
+    lines: List[str], prefix: str
+) -> List[Tuple[Optional[str], str, str, int, int]]:
+    """Parse text in the format written by render_cells. Text before the first cell marker is a
+    code cell, trailing blank lines of a cell are dropped.
+    Returns: the (id, cell type, source, marker line, last line) of each cell. The marker line is
+    -1 for text before the first marker, and the id is None for cells added without an id"""
+    pattern = cell_marker_pattern(prefix)
+    cells: List[Tuple[Optional[str], str, str, int, int]] = []
+
+    def add(id: Optional[str], cell_type: str, marker: int, body: List[str]) -> None:
+        while len(body) > 0 and body[-1].strip() == "":
+            body.pop()
+        if cell_type != "code":
+            body = [
+                line[len(prefix) + 1 :]
+                if line.startswith(prefix + " ")
+                else "" if line == prefix else line
+                for line in body
+            ]
+        if marker == -1 and len(body) == 0:
+            return
+        cells.append((id, cell_type, "\n".join(body), marker, marker + len(body)))
+
+    id: Optional[str] = None
+    cell_type = "code"
+    marker = -1
+    body: List[str] = []
+    for lineno, line in enumerate(lines):
+        match = pattern.match(line)
+        if match is None:
+            body.append(line)
+            continue
+        add(id, cell_type, marker, body)
+        id = match.group("id")
+        cell_type = match.group("type") or "code"
+        marker = lineno
+        body = []
+    add(id, cell_type, marker, body)
+    return cells
+
+
+def _stat(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# documents last read or written, by path, with the stat of the file at the time
+_cache: Dict[str, Tuple[Tuple[int, int], NotebookDocument]] = {}
+_cache_lock = Lock()
@@ -1,7 +1,7 @@
 import os
 
 from pynvim import Nvim
-from typing import Literal, Optional, Union, List
+from typing import Any, Dict, Literal, Optional, Union, List
 from dataclasses import dataclass
 
 from molten.utils import notify_error
@@ -35,15 +35,21 @@ class MoltenOptions:
     auto_init_behavior: str
     auto_open_html_in_browser: bool
     auto_open_output: bool
+    autosave: bool
     cover_empty_lines: bool
     cover_lines_starting_with: List[str]
     copy_output: bool
     enter_output_behavior: str
+    fast_json: bool
+    heartbeat_interval: float
+    heartbeat_timeout: float
+    image_cache_size: int
     image_location: str
     image_provider: str
     limit_output_chars: int
     open_cmd: Optional[str]
     output_crop_border: bool
+    output_governor: Union[bool, Dict[str, Any]]
     output_show_exec_time: bool
     output_show_more: bool
     output_virt_lines: bool
@@ -54,7 +60,13 @@ class MoltenOptions:
     output_win_max_width: int
     output_win_style: Optional[str]
     output_win_zindex: Optional[str]
+    renderer_budgets: Dict[str, int]
+    renderer_order: List[str]
+    save_compress: bool
     save_path: str
+    server_keep_kernels: bool
+    server_retries: int
+    server_timeout: float
     split_direction: str | None
     split_size: int | None
     show_mimetype_debug: bool
@@ -78,14 +90,20 @@ class MoltenOptions:
             ("molten_auto_init_behavior", "init"), # "raise" or "init"
             ("molten_auto_open_html_in_browser", False),
             ("molten_auto_open_output", True),
+            ("molten_autosave", False),
             ("molten_cover_empty_lines", False),
             ("molten_cover_lines_starting_with", []),
             ("molten_copy_output", False),
             ("molten_enter_output_behavior", "open_then_enter"),
+            ("molten_fast_json", False),
+            ("molten_heartbeat_interval", 0),
+            ("molten_heartbeat_timeout", 3),
+            ("molten_image_cache_size", 64),
             ("molten_image_location", "both"), # "both", "float", "virt"
             ("molten_image_provider", "none"),
             ("molten_open_cmd", None),
             ("molten_output_crop_border", True),
+            ("molten_output_governor", False),
             ("molten_output_show_exec_time", True),
             ("molten_output_show_more", False),
             ("molten_output_virt_lines", False),
@@ -96,7 +114,19 @@ class MoltenOptions:
             ("molten_output_win_max_height", 999999),
             ("molten_output_win_max_width", 999999),
             ("molten_output_win_style", False),
+            ("molten_renderer_budgets", {}),
+            ("molten_renderer_order", [
+                "image/svg+xml",
+                "application/vnd.plotly.v1+json",
+                "text/latex",
+                "image/*",
+                "text/plain",
+            ]),
+            ("molten_save_compress", False),
             ("molten_save_path", os.path.join(nvim.funcs.stdpath("data"), "molten")),
+            ("molten_server_keep_kernels", False),
+            ("molten_server_retries", 3),
+            ("molten_server_timeout", 10),
             ("molten_split_direction", "right"),
             ("molten_split_size", 40),
             ("molten_show_mimetype_debug", False),
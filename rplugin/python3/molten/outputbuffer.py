@@ -174,8 +174,8 @@ class OutputBuffer:
         # clear any inline images, etc.
         redraw = False
         for chunk in self.output.chunks:
-            if isinstance(chunk, ImageOutputChunk) and chunk.img_identifier is not None:
-                self.canvas.remove_image(chunk.img_identifier)
+            if isinstance(chunk, ImageOutputChunk) and chunk.virt_img_identifier is not None:
+                self.canvas.remove_image(chunk.virt_img_identifier)
                 redraw = True
         if redraw:
             self.canvas.present()
@@ -205,6 +205,7 @@ class OutputBuffer:
         virtual_lines = 0
         if len(self.output.chunks) > 0:
             x = 0
+            placed_images = []
             for chunk in self.output.chunks:
                 y = lineno
                 if virtual:
@@ -219,11 +220,20 @@ class OutputBuffer:
                     virtual,
                     winnr=self.nvim.current.window.handle if virtual else None,
                 )
+                if isinstance(chunk, ImageOutputChunk) and chunktext != "":
+                    placed_images.append(
+                        chunk.virt_img_identifier if virtual else chunk.img_identifier
+                    )
                 lines_str += chunktext
                 lineno += chunktext.count("\n")
                 virtual_lines += virt_lines
                 x = len(lines_str) - lines_str.rfind("\n")
 
+            # send all the queued images at once, so sizing them costs a single round trip
+            self.canvas.flush()
+            for identifier in placed_images:
+                virtual_lines += self.canvas.img_size(identifier)["height"]
+
             limit = self.options.limit_output_chars
             if limit and len(lines_str) > limit:
                 lines_str = lines_str[:limit]
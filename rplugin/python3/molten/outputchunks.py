@@ -3,14 +3,22 @@ from typing import (
     Tuple,
     List,
     Dict,
+    Deque,
+    Set,
     Any,
     Callable,
     IO,
 )
+from collections import deque
 from contextlib import AbstractContextManager
 from enum import Enum
 from abc import ABC, abstractmethod
+from fnmatch import fnmatch
+import hashlib
+import itertools
+import json
 import re
+import time
 from datetime import datetime
 
 from pynvim import Nvim
@@ -18,7 +26,7 @@ from pynvim import Nvim
 
 from molten.images import Canvas
 from molten.options import MoltenOptions
-from molten.utils import notify_error
+from molten.utils import notify_error, notify_warn
 
 
 class OutputChunk(ABC):
@@ -143,10 +151,16 @@ class AbortedOutputChunk(TextLnOutputChunk):
 
 
 class ImageOutputChunk(OutputChunk):
+    # chunks showing the same (cached) file are still separate images on the canvas
+    _next_id = itertools.count()
+
     def __init__(self, img_path: str):
         self.img_path = img_path
+        self.img_id = next(ImageOutputChunk._next_id)
         self.output_type = "display_data"
+        # the same image can be placed in the floating window and in the virtual text at once
         self.img_identifier = None
+        self.virt_img_identifier = None
 
     def place(
         self,
@@ -163,17 +177,45 @@ class ImageOutputChunk(OutputChunk):
         if not (loc == "both" or (loc == "virt" and virtual) or (loc == "float" and not virtual)):
             return "", 0
 
-        self.img_identifier = canvas.add_image(
+        identifier = canvas.add_image(
             self.img_path,
-            f"{'virt-' if virtual else ''}{self.img_path}",
+            f"{'virt-' if virtual else ''}{self.img_id}:{self.img_path}",
             0,
             lineno,
             bufnr,
             winnr,
         )
+        if virtual:
+            self.virt_img_identifier = identifier
+        else:
+            self.img_identifier = identifier
         # images are rendered into virtual lines following the current line,
-        # which also needs to exist as the extmark is placed there
-        return " \n", canvas.img_size(self.img_identifier)["height"]
+        # which also needs to exist as the extmark is placed there. The height of those virtual
+        # lines is only known once the canvas is flushed, see `OutputBuffer.build_output_text`
+        return " \n", 0
+
+
+class PendingOutputChunk(OutputChunk):
+    """Data that hasn't been rendered into an output chunk yet. Rendering is deferred so that
+    outputs cleared before they're ever shown don't have to be rendered at all"""
+
+    def __init__(self, data: Dict[str, Any], metadata: Dict[str, Any]):
+        self.jupyter_data = data
+        self.jupyter_metadata = metadata
+        self.output_type = "display_data"
+
+    def place(
+        self,
+        _bufnr: int,
+        _options: MoltenOptions,
+        _col: int,
+        _lineno: int,
+        _shape: Tuple[int, int, int, int],
+        _canvas: Canvas,
+        _hard_wrap: bool,
+        winnr: int | None = None,
+    ) -> Tuple[str, int]:
+        return "", 0
 
 
 class OutputStatus(Enum):
@@ -189,13 +231,18 @@ class OutputStatus(Enum):
 
 class Output:
     execution_count: Optional[int]
-    chunks: List[OutputChunk]
     status: OutputStatus
     success: bool
     old: bool
     start_time: datetime | None
     end_time: datetime | None
+    saved_chunks: Optional[List[Dict[str, Any]]]
+    """references to the saved chunks this output was loaded from, while they're not loaded yet"""
+    saved_blob_dir: Optional[str]
+    """the blob directory saved_chunks refer to"""
 
+    _chunks: List[OutputChunk]
+    _chunk_loader: Optional[Callable[[], List[OutputChunk]]]
     _should_clear: bool
 
     def __init__(self, execution_count: Optional[int]):
@@ -210,6 +257,38 @@ class Output:
 
         self._should_clear = False
 
+    @property
+    def chunks(self) -> List[OutputChunk]:
+        if self._chunk_loader is not None:
+            loader = self._chunk_loader
+            self._chunk_loader = None
+            self.saved_chunks = None
+            self.saved_blob_dir = None
+            self._chunks = loader()
+        return self._chunks
+
+    @chunks.setter
+    def chunks(self, chunks: List[OutputChunk]) -> None:
+        self._chunks = chunks
+        self._chunk_loader = None
+        self.saved_chunks = None
+        self.saved_blob_dir = None
+
+    def load_chunks_lazily(
+        self,
+        loader: Callable[[], List[OutputChunk]],
+        saved_chunks: List[Dict[str, Any]],
+        blob_dir: str,
+    ) -> None:
+        """Defer building the chunks of this output until they're first accessed"""
+        self._chunks = []
+        self._chunk_loader = loader
+        self.saved_chunks = saved_chunks
+        self.saved_blob_dir = blob_dir
+
+    def chunks_loaded(self) -> bool:
+        return self._chunk_loader is None
+
     def merge_text_chunks(self):
         """Merge the last two chunks if they are text chunks, and text on a line before \r
         character, this is b/c outputs before a \r aren't shown, and so, should be deleted"""
@@ -226,104 +305,238 @@ class Output:
             c1.text = "\n".join([re.sub(r".*\r", "", x) for x in c1.text.split("\n")[:-1]])
 
 
-def to_outputchunk(
-    nvim: Nvim,
-    alloc_file: Callable[
-        [str, str],
-        "AbstractContextManager[Tuple[str, IO[bytes]]]",
-    ],
-    data: Dict[str, Any],
-    metadata: Dict[str, Any],
-    options: MoltenOptions,
-) -> OutputChunk:
-    def _to_image_chunk(path: str) -> OutputChunk:
-        return ImageOutputChunk(path)
+AllocFile = Callable[
+    [str, str],
+    "AbstractContextManager[Tuple[str, IO[bytes]]]",
+]
+Renderer = Callable[[Nvim, AllocFile, str, Any], Optional[OutputChunk]]
+"""Turns the data for a mimetype into an output chunk: (nvim, alloc_file, mimetype, data) -> chunk.
+Return None, or raise ImportError when an optional dependency is missing, to have the next renderer
+tried instead."""
 
-    # Output chunk functions:
-    def _from_image(extension: str, imgdata: bytes) -> OutputChunk:
-        import base64
 
-        with alloc_file(extension, "wb") as (path, file):
-            file.write(base64.b64decode(str(imgdata)))
-        return _to_image_chunk(path)
+class RendererRegistry:
+    """Maps mimetypes (or glob patterns like `image/*`) to the renderer that turns them into output
+    chunks, and keeps track of how long each renderer takes.
 
-    def _from_image_svgxml(svg: str) -> OutputChunk:
-        try:
-            import cairosvg
+    A renderer with a time budget whose recent average conversion time exceeds that budget is
+    demoted: it's skipped until `reset` is called, and the next mimetype in the preference order
+    is used."""
 
-            with alloc_file("png", "wb") as (path, file):
-                cairosvg.svg2png(svg, write_to=file)
-            return _to_image_chunk(path)
-        except ImportError:
-            with alloc_file("svg", "w") as (path, file):
-                file.write(svg)  # type: ignore
-            return _to_image_chunk(path)
+    # number of recent conversions averaged when checking a renderer against its budget
+    SAMPLES = 5
 
-    def _from_application_plotly(figure_json: Any) -> OutputChunk:
-        from plotly.io import from_json
+    renderers: Dict[str, Renderer]
+    timings: Dict[str, Deque[float]]
+    demoted: Set[str]
 
-        # NOTE: import this to cause an import exception which we catch. instead of a different
-        # error in `write_image`
-        import kaleido  # type: ignore
-        import json
+    def __init__(self) -> None:
+        self.renderers = {}
+        self.timings = {}
+        self.demoted = set()
+
+    def register(self, mimetype: str, renderer: Renderer) -> None:
+        """Register a renderer for the given mimetype or pattern, replacing any existing one"""
+        self.renderers[mimetype] = renderer
+        self.timings.pop(mimetype, None)
+        self.demoted.discard(mimetype)
+
+    def reset(self) -> None:
+        """Give demoted renderers another chance, and forget their timings"""
+        self.timings.clear()
+        self.demoted.clear()
+
+    def lookup(self, mimetype: str) -> Optional[str]:
+        """The key of the renderer to use for mimetype, exact matches win over patterns"""
+        if mimetype in self.renderers:
+            return mimetype
+        for pattern in self.renderers:
+            if fnmatch(mimetype, pattern):
+                return pattern
+        return None
+
+    def average_ms(self, key: str) -> Optional[float]:
+        timings = self.timings.get(key)
+        if not timings:
+            return None
+        return sum(timings) / len(timings) * 1000
+
+    def _record(self, nvim: Nvim, key: str, elapsed: float, budget_ms: Optional[int]) -> None:
+        timings = self.timings.setdefault(key, deque(maxlen=self.SAMPLES))
+        timings.append(elapsed)
+        average = self.average_ms(key)
+        if budget_ms is not None and average is not None and average > budget_ms:
+            self.demoted.add(key)
+            notify_warn(
+                nvim,
+                f"Rendering {key} takes {average:.0f}ms on average, over its {budget_ms}ms budget. "
+                "Falling back to cheaper representations for this mimetype until "
+                "require('molten.renderers').reset() is called.",
+            )
+
+    def render(
+        self,
+        nvim: Nvim,
+        alloc_file: AllocFile,
+        data: Dict[str, Any],
+        options: MoltenOptions,
+        cache: Optional[Dict[str, str]] = None,
+    ) -> Optional[OutputChunk]:
+        """Render the most preferred mimetype in data that has a usable renderer.
+
+        When given, `cache` maps payload digests to the image files they were already rendered to,
+        identical payloads reuse that file instead of being decoded and written again."""
+        for pattern in options.renderer_order:
+            for mimetype, value in data.items():
+                if not value or not fnmatch(mimetype, pattern):
+                    continue
+                key = self.lookup(mimetype)
+                if key is None or key in self.demoted:
+                    continue
+
+                digest = None
+                if cache is not None and mimetype != "text/plain":
+                    digest = payload_digest(mimetype, value)
+                    if digest in cache:
+                        return _to_image_chunk(cache[digest])
+
+                start = time.perf_counter()
+                try:
+                    chunk = self.renderers[key](nvim, alloc_file, mimetype, value)
+                except ImportError:
+                    continue
+                self._record(
+                    nvim, key, time.perf_counter() - start, options.renderer_budgets.get(key)
+                )
+                if chunk is None:
+                    continue
+                if digest is not None and isinstance(chunk, ImageOutputChunk):
+                    cache[digest] = chunk.img_path
+                return chunk
+        return None
+
+
+def payload_digest(mimetype: str, value: Any) -> str:
+    if not isinstance(value, (str, bytes)):
+        value = json.dumps(value, sort_keys=True)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return hashlib.blake2b(mimetype.encode("utf-8") + b"\0" + value, digest_size=16).hexdigest()
+
+
+def _to_image_chunk(path: str) -> OutputChunk:
+    return ImageOutputChunk(path)
+
+
+def _from_image(_nvim: Nvim, alloc_file: AllocFile, mimetype: str, imgdata: Any) -> OutputChunk:
+    import base64
+
+    extension = mimetype.split("/")[1]
+    with alloc_file(extension, "wb") as (path, file):
+        if isinstance(imgdata, memoryview):
+            # a raw buffer of a binary websocket message, written as is
+            file.write(imgdata)
+        else:
+            file.write(base64.b64decode(imgdata))
+    return _to_image_chunk(path)
 
-        figure = from_json(json.dumps(figure_json))
+
+def _from_image_svgxml(_nvim: Nvim, alloc_file: AllocFile, _mimetype: str, svg: Any) -> OutputChunk:
+    try:
+        import cairosvg
 
         with alloc_file("png", "wb") as (path, file):
-            figure.write_image(file, engine="kaleido")
+            cairosvg.svg2png(svg, write_to=file)
+        return _to_image_chunk(path)
+    except ImportError:
+        with alloc_file("svg", "w") as (path, file):
+            file.write(svg)  # type: ignore
         return _to_image_chunk(path)
 
-    def _from_latex(tex: str) -> OutputChunk:
-        from pnglatex import pnglatex
 
+def _from_application_plotly(
+    _nvim: Nvim, alloc_file: AllocFile, _mimetype: str, figure_json: Any
+) -> OutputChunk:
+    from plotly.io import from_json
+
+    # NOTE: import this to cause an import exception which we catch. instead of a different
+    # error in `write_image`
+    import kaleido  # type: ignore
+    import json
+
+    figure = from_json(json.dumps(figure_json))
+
+    with alloc_file("png", "wb") as (path, file):
+        figure.write_image(file, engine="kaleido")
+    return _to_image_chunk(path)
+
+
+def _from_latex(nvim: Nvim, alloc_file: AllocFile, mimetype: str, tex: Any) -> OutputChunk:
+    from pnglatex import pnglatex
+
+    try:
+        with alloc_file("png", "w") as (path, _):
+            pass
+        pnglatex(tex, path)
+        return _to_image_chunk(path)
+    except ValueError:
+        notify_error(nvim, f"pnglatex was unable to render image from LaTeX: {tex}")
+        return _from_plaintext(nvim, alloc_file, mimetype, tex)
+
+
+def _from_plaintext(_nvim: Nvim, _alloc_file: AllocFile, _mimetype: str, text: Any) -> OutputChunk:
+    return TextLnOutputChunk(text)
+
+
+def lua_renderer(key: str) -> Renderer:
+    """A renderer that hands the data to the lua function registered for key with
+    `require('molten.renderers').register`"""
+
+    def render(
+        nvim: Nvim, _alloc_file: AllocFile, mimetype: str, data: Any
+    ) -> Optional[OutputChunk]:
+        if isinstance(data, memoryview):
+            data = bytes(data)
         try:
-            with alloc_file("png", "w") as (path, _):
-                pass
-            pnglatex(tex, path)
-            return _to_image_chunk(path)
-        except ValueError:
-            notify_error(nvim, f"pnglatex was unable to render image from LaTeX: {tex}")
-            return _from_plaintext(tex)
+            result = nvim.exec_lua(
+                "return require('molten.renderers').render(...)", key, mimetype, data
+            )
+        except Exception as err:
+            notify_error(nvim, f"Renderer for {key} failed: {err}")
+            return None
+        if isinstance(result, str):
+            return TextLnOutputChunk(result)
+        if isinstance(result, dict) and isinstance(result.get("image"), str):
+            return _to_image_chunk(result["image"])
+        return None
+
+    return render
 
-    def _from_plaintext(text: str) -> OutputChunk:
-        return TextLnOutputChunk(text)
 
+RENDERERS = RendererRegistry()
+RENDERERS.register("image/svg+xml", _from_image_svgxml)
+RENDERERS.register("application/vnd.plotly.v1+json", _from_application_plotly)
+RENDERERS.register("text/latex", _from_latex)
+RENDERERS.register("image/*", _from_image)
+RENDERERS.register("text/plain", _from_plaintext)
+
+
+def to_outputchunk(
+    nvim: Nvim,
+    alloc_file: AllocFile,
+    data: Dict[str, Any],
+    metadata: Dict[str, Any],
+    options: MoltenOptions,
+    cache: Optional[Dict[str, str]] = None,
+) -> OutputChunk:
     chunk = None
-    # if options.image_provider != "none":
-    # handle these mimetypes first, since they require Molten to render them
-    special_mimetypes = [
-        ("image/svg+xml", _from_image_svgxml),
-        ("application/vnd.plotly.v1+json", _from_application_plotly),
-        ("text/latex", _from_latex),
-    ]
-
-    for mimetype, process_func in special_mimetypes:
-        try:
-            maybe_data = None
-            if data is not None:
-                maybe_data = data.get(mimetype)
-            if maybe_data is not None:
-                chunk = process_func(maybe_data)  # type: ignore
-                break
-        except ImportError:
-            continue
-
-    if chunk is None and data is not None:
-        # handle arbitrary images
-        for mimetype in data.keys():
-            match mimetype.split("/"):
-                case ["image", extension]:
-                    chunk = _from_image(extension, data[mimetype])
-                    break
+    if data is not None:
+        chunk = RENDERERS.render(nvim, alloc_file, data, options, cache)
 
     if chunk is None:
-        # fallback to plain text if there's nothing else
-        if data is not None and data.get("text/plain"):
-            chunk = _from_plaintext(data["text/plain"])
-        else:
-            if data == None:
-                data = {}
-            chunk = BadOutputChunk(list(data.keys()))
+        if data == None:
+            data = {}
+        chunk = BadOutputChunk(list(data.keys()))
 
     chunk.jupyter_data = data
     chunk.jupyter_metadata = metadata
@@ -0,0 +1,103 @@
+from typing import IO, Any, Dict, List, Optional, Tuple
+import gzip
+import json
+import time
+
+from molten import json_codec
+from molten.utils import MoltenException
+
+RECORDING_VERSION = 1
+
+# seconds since the recording started, channel, msg_type, content
+RecordedMessage = Tuple[float, str, str, Dict[str, Any]]
+
+
+def _open(path: str, mode: str) -> IO[bytes]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)  # type: ignore
+    return open(path, mode)
+
+
+class MessageRecorder:
+    """Writes the messages a kernel sends to a log, to reproduce the output of a cell later with
+    `MessageReplay`. The log is a line of json per message, gzipped if the path ends in .gz"""
+
+    path: str
+    file: IO[bytes]
+    start: float
+
+    def __init__(self, path: str, kernel_name: str):
+        self.path = path
+        self.file = _open(path, "wb")
+        self.file.write(
+            json_codec.dumps({"molten_recording": RECORDING_VERSION, "kernel": kernel_name}) + b"\n"
+        )
+        self.start = time.monotonic()
+
+    def record(self, channel: str, message: Dict[str, Any]) -> None:
+        t = round(time.monotonic() - self.start, 3)
+        self.file.write(
+            json_codec.dumps([t, channel, message["msg_type"], message["content"]]) + b"\n"
+        )
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_recording(path: str) -> List[RecordedMessage]:
+    try:
+        with _open(path, "rb") as file:
+            lines = file.read().splitlines()
+    except OSError as err:
+        raise MoltenException(f"Couldn't read recording {path}: {err}")
+
+    try:
+        header = json.loads(lines[0]) if len(lines) > 0 else {}
+    except ValueError:
+        header = {}
+    if header.get("molten_recording") != RECORDING_VERSION:
+        raise MoltenException(f"{path} is not a molten recording")
+
+    messages = []
+    for line in lines[1:]:
+        try:
+            t, channel, msg_type, content = json_codec.loads(line)
+        except ValueError:
+            # a torn last line, when the editor died while recording
+            break
+        messages.append((t, channel, msg_type, content))
+    return messages
+
+
+class MessageReplay:
+    """Plays a recording back as if the kernel was sending it. The clock starts with the first
+    message taken, and runs `speed` times faster than the recording did. With a speed of 0 messages
+    are handed out as fast as they're taken."""
+
+    messages: List[RecordedMessage]
+    speed: float
+    start: Optional[float]
+    index: int
+
+    def __init__(self, path: str, speed: float = 1.0):
+        # input requests aren't replayed, there's no one to answer them
+        self.messages = [message for message in read_recording(path) if message[1] == "iopub"]
+        self.speed = speed
+        self.start = None
+        self.index = 0
+
+    def finished(self) -> bool:
+        return self.index >= len(self.messages)
+
+    def next_message(self) -> Optional[Dict[str, Any]]:
+        """The next message, if it's due"""
+        if self.finished():
+            return None
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        t, channel, msg_type, content = self.messages[self.index]
+        if self.speed > 0 and (now - self.start) * self.speed < t:
+            return None
+        self.index += 1
+        return {"channel": channel, "msg_type": msg_type, "content": content}
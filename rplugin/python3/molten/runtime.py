@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, Tuple, List, Dict, Generator, IO, Any
+from typing import Callable, Optional, Set, Tuple, List, Dict, Generator, IO, Any
 from contextlib import contextmanager
 from queue import Empty as EmptyQueueException
 import os
@@ -9,22 +9,28 @@ import json
 import jupyter_client
 from pynvim import Nvim
 
+from molten.governor import fetch_expression, governor_code, governor_config
 from molten.options import MoltenOptions
 from molten.outputchunks import (
     Output,
     MimetypesOutputChunk,
     ErrorOutputChunk,
     TextOutputChunk,
+    PendingOutputChunk,
     OutputStatus,
     to_outputchunk,
     clean_up_text,
 )
 from molten.runtime_state import RuntimeState
 from molten.jupyter_server_api import JupyterAPIClient, JupyterAPIManager
-
+from molten import json_codec
+from molten.recording import MessageRecorder, MessageReplay
+from molten.utils import notify_error, notify_warn
 
 class JupyterRuntime:
     state: RuntimeState
+    # IDLE or RUNNING, from the kernel's last status message
+    reported_state: RuntimeState
     kernel_name: str
     kernel_id: str
 
@@ -32,20 +38,37 @@ class JupyterRuntime:
     kernel_client: jupyter_client.KernelClient | JupyterAPIClient  # type: ignore
 
     allocated_files: List[str]
+    # payload digest -> the file it was rendered to, so identical payloads are only rendered once
+    render_cache: Dict[str, str]
+    # ids of requests molten sent on its own, their messages are never shown to the user
+    silent_msg_ids: Set[str]
+    # handlers for the shell replies to requests molten sent on its own, by request msg_id
+    reply_handlers: Dict[str, Callable[[Dict[str, Any]], None]]
+    # writes the messages the kernel sends to a log, see `:MoltenRecordStart`
+    recorder: Optional[MessageRecorder]
+    # when set, messages are taken from the replay instead of the kernel, see `:MoltenReplay`
+    replay: Optional[MessageReplay]
 
     options: MoltenOptions
     nvim: Nvim
 
     def __init__(self, nvim: Nvim, kernel_name: str, kernel_id: str, options: MoltenOptions):
         self.state = RuntimeState.STARTING
+        self.reported_state = RuntimeState.IDLE
         self.kernel_name = kernel_name
         self.kernel_id = kernel_id
         self.nvim = nvim
         self.nvim.exec_lua("_prompt_stdin = require('prompt').prompt_stdin")
+        json_codec.use_orjson(options.fast_json)
 
         if kernel_name.startswith("http://") or kernel_name.startswith("https://"):
             self.external_kernel = False
-            self.kernel_manager = JupyterAPIManager(kernel_name)
+            self.kernel_manager = JupyterAPIManager(
+                kernel_name,
+                options.server_timeout,
+                options.server_retries,
+                options.server_keep_kernels,
+            )
             self.kernel_manager.start_kernel()
             self.kernel_client = self.kernel_manager.client()
             self.kernel_client.start_channels()
@@ -80,13 +103,33 @@ class JupyterRuntime:
             self.kernel_client = self.kernel_manager.client()
             self.kernel_client.load_connection_file(connection_file=kernel_file)
 
+        if isinstance(self.kernel_client, jupyter_client.KernelClient):
+            json_codec.configure_session(self.kernel_client.session)
+
         self.allocated_files = []
+        self.render_cache = {}
+        self.silent_msg_ids = set()
+        self.reply_handlers = {}
+        self.recorder = None
+        self.replay = None
         self.options = options
 
     def is_ready(self) -> bool:
-        return self.state.value > RuntimeState.STARTING.value
+        return self.state in (RuntimeState.IDLE, RuntimeState.RUNNING)
+
+    def mark_dead(self) -> None:
+        self.state = RuntimeState.DEAD
+
+    def revive(self) -> None:
+        """Back from DEAD, to the state the kernel last reported. Status messages that arrive while
+        it's marked dead are still tracked"""
+        if self.state == RuntimeState.DEAD:
+            self.state = self.reported_state
 
     def deinit(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+
         for path in self.allocated_files:
             if os.path.exists(path):
                 os.remove(path)
@@ -100,11 +143,88 @@ class JupyterRuntime:
 
     def restart(self) -> None:
         self.state = RuntimeState.STARTING
+        self.reported_state = RuntimeState.IDLE
+        # the old kernel won't answer anymore
+        self.reply_handlers.clear()
         self.kernel_manager.restart_kernel()
 
     def run_code(self, code: str) -> None:
         self.kernel_client.execute(code)
 
+    def _send_silent(
+        self, msg_id: str, on_reply: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        """Keep the messages of a request molten sent on its own out of the cell outputs, and
+        hand its shell reply to `on_reply` once it arrives (see `_tick_replies`)"""
+        self.silent_msg_ids.add(msg_id)
+        if on_reply is not None:
+            self.reply_handlers[msg_id] = on_reply
+
+    def _tick_replies(self) -> bool:
+        did_stuff = False
+        while len(self.reply_handlers) > 0:
+            try:
+                reply = self.kernel_client.get_shell_msg(timeout=0)
+            except EmptyQueueException:
+                break
+            # replies to the user's own requests aren't used anywhere, they're just dropped
+            handler = self.reply_handlers.pop(reply.get("parent_header", {}).get("msg_id"), None)
+            if handler is not None:
+                handler(reply)
+                did_stuff = True
+        return did_stuff
+
+    def _install_governor(self) -> None:
+        """Install the output size governor in the kernel, if it's enabled for this kernel"""
+        config = governor_config(self.options.output_governor, self.kernel_name)
+        if config is None:
+            return
+
+        def install(info: Optional[Dict[str, Any]]) -> None:
+            language = None if info is None else info.get("language_info", {}).get("name")
+            if language is None:
+                notify_warn(
+                    self.nvim,
+                    f"Couldn't find out the language of kernel '{self.kernel_name}', "
+                    "the output governor isn't installed",
+                )
+            if language != "python":
+                return
+            msg_id = self.kernel_client.execute(
+                governor_code(config), silent=True, store_history=False
+            )
+            self._send_silent(msg_id)
+
+        if isinstance(self.kernel_client, JupyterAPIClient):
+            install(self.kernel_client.kernel_info_reply)
+        else:
+            self._send_silent(
+                self.kernel_client.kernel_info(), lambda reply: install(reply["content"])
+            )
+
+    def fetch_full_payload(
+        self, key: str, on_done: Callable[[Dict[str, Any], Dict[str, Any]], None]
+    ) -> None:
+        """Ask the kernel for the full data and metadata of an output that was cut down by the
+        governor. The request doesn't block, `on_done` is called from `tick` with them once the
+        kernel replies."""
+
+        def on_reply(reply: Dict[str, Any]) -> None:
+            result = reply["content"].get("user_expressions", {}).get("full")
+            if result is None or result["status"] != "ok":
+                evalue = key if result is None else result.get("evalue", key)
+                notify_error(self.nvim, f"The kernel no longer has the full output: {evalue}")
+                return
+            on_done(result["data"], result["metadata"])
+
+        msg_id = self.kernel_client.execute(
+            "",
+            silent=True,
+            store_history=False,
+            user_expressions={"full": fetch_expression(key)},
+        )
+        self._send_silent(msg_id, on_reply)
+
     @contextmanager
     def _alloc_file(
         self, extension: str, mode: str
@@ -119,11 +239,35 @@ class JupyterRuntime:
             output.chunks.append(MimetypesOutputChunk(list(data.keys())))
 
         if output.success:
+            if any(mimetype != "text/plain" for mimetype in data):
+                # rendered at the end of the tick, see `_render_pending`
+                output.chunks.append(PendingOutputChunk(data, metadata))
+                return
             chunk = to_outputchunk(self.nvim, self._alloc_file, data, metadata, self.options)
             output.chunks.append(chunk)
             if isinstance(chunk, TextOutputChunk) and chunk.text.startswith("\r"):
                 output.merge_text_chunks()
 
+    def _render_pending(self, output: Output) -> None:
+        """Render the chunks that survived this tick. Outputs that were superseded by a
+        `clear_output(wait=True)` in the same tick (ie. animation frames) are never decoded."""
+        for i, chunk in enumerate(output.chunks):
+            if isinstance(chunk, PendingOutputChunk):
+                output.chunks[i] = to_outputchunk(
+                    self.nvim,
+                    self._alloc_file,
+                    chunk.jupyter_data,  # type: ignore
+                    chunk.jupyter_metadata,  # type: ignore
+                    self.options,
+                    self.render_cache,
+                )
+
+    def _set_reported_state(self, state: RuntimeState) -> None:
+        self.reported_state = state
+        # a kernel marked dead stays that way until it answers a heartbeat again
+        if self.state != RuntimeState.DEAD:
+            self.state = state
+
     def _tick_one(self, output: Output, message_type: str, content: Dict[str, Any]) -> bool:
         def copy_on_demand(content_ctor):
             if self.options.copy_output:
@@ -155,11 +299,11 @@ class JupyterRuntime:
             execution_state = content["execution_state"]
             assert execution_state != "starting"
             if execution_state == "idle":
-                self.state = RuntimeState.IDLE
+                self._set_reported_state(RuntimeState.IDLE)
                 output.status = OutputStatus.DONE
                 return True
             elif execution_state == "busy":
-                self.state = RuntimeState.RUNNING
+                self._set_reported_state(RuntimeState.RUNNING)
                 return True
             else:
                 return False
@@ -212,24 +356,52 @@ class JupyterRuntime:
             ),
         )
 
-        if not self.is_ready():
+        if self.state == RuntimeState.STARTING:
             try:
                 self.kernel_client.wait_for_ready(timeout=0)
                 self.state = RuntimeState.IDLE
                 did_stuff = True
             except RuntimeError:
                 return False
+            self._install_governor()
+
+        if isinstance(self.kernel_client, JupyterAPIClient):
+            for warning in self.kernel_client.take_warnings():
+                notify_warn(self.nvim, warning)
+
+        did_stuff = self._tick_replies() or did_stuff
 
         if output is None:
             return did_stuff
 
         while True:
             try:
-                message = self.kernel_client.get_iopub_msg(timeout=0)
+                if self.replay is not None:
+                    message = self.replay.next_message()
+                    if message is None:
+                        if self.replay.finished():
+                            self.replay = None
+                            output.status = OutputStatus.DONE
+                            did_stuff = True
+                        break
+                else:
+                    message = self.kernel_client.get_iopub_msg(timeout=0)
 
                 if "content" not in message or "msg_type" not in message:
                     continue
 
+                parent_id = message.get("parent_header", {}).get("msg_id")
+                if parent_id in self.silent_msg_ids:
+                    if (
+                        message["msg_type"] == "status"
+                        and message["content"]["execution_state"] == "idle"
+                    ):
+                        self.silent_msg_ids.discard(parent_id)
+                    continue
+
+                if self.recorder is not None:
+                    self.recorder.record("iopub", message)
+
                 did_stuff_now = self._tick_one(output, message["msg_type"], message["content"])
                 did_stuff = did_stuff or did_stuff_now
 
@@ -238,6 +410,8 @@ class JupyterRuntime:
             except EmptyQueueException:
                 break
 
+        self._render_pending(output)
+
         return did_stuff
 
     def tick_input(self):
@@ -254,6 +428,8 @@ class JupyterRuntime:
         try:
             msg = self.kernel_client.get_stdin_msg(timeout=0)
             if msg is not None:
+                if self.recorder is not None:
+                    self.recorder.record("stdin", msg)
                 self.take_input(msg)
         except EmptyQueueException:
             pass
@@ -5,3 +5,5 @@ class RuntimeState(Enum):
     STARTING = 0
     IDLE = 1
     RUNNING = 2
+    # stopped answering heartbeats, see `HeartbeatMonitor`
+    DEAD = 3
@@ -1,17 +1,32 @@
-from typing import Type, Optional, Dict, Any
+from contextlib import contextmanager
+from threading import RLock
+from typing import IO, Iterable, Iterator, List, Type, Optional, Dict, Any, Tuple
+import gzip
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 from pynvim import Nvim
 
 from pynvim.api import Buffer
 from molten.code_cell import CodeCell
 from molten.position import DynamicPosition
 
-from molten.utils import MoltenException
+from molten.alignment import LineIndex
+from molten.utils import MoltenException, notify_warn
 from molten.options import MoltenOptions
-from molten.outputchunks import OutputStatus, Output, to_outputchunk
+from molten.outputchunks import OutputChunk, OutputStatus, Output, to_outputchunk
 from molten.outputbuffer import OutputBuffer
 from molten.moltenbuffer import MoltenKernel
 
+SAVE_VERSION = 2
+
+# held while writing save files, their journals and their blob stores. The autosave thread writes
+# them too, and a save pruning the blob store mustn't run between a journal writing a blob and
+# referencing it
+store_lock = RLock()
+
 
 class MoltenIOError(Exception):
     @classmethod
@@ -39,50 +54,148 @@ def get_default_save_file(options: MoltenOptions, buffer: Buffer) -> str:
     return os.path.join(options.save_path, mangled_name + ".json")
 
 
-def load(nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, data: Dict[str, Any]) -> None:
+@contextmanager
+def _replace_atomically(path: str, mode: str = "w") -> Iterator[IO[Any]]:
+    """Write to a uniquely named temporary file next to path, which replaces path once it's
+    written. Nothing is replaced if writing fails"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_blob_dir(path: str) -> str:
+    """The directory holding the output payloads of the (version 2) save file at path"""
+    return os.path.splitext(path)[0] + ".blobs"
+
+
+def write_blob(blob_dir: str, payload: Any, compress: bool) -> str:
+    """Write the payload to the content addressed blob store, unless it's already there.
+    Returns: the name of the blob"""
+    raw = json.dumps(payload, sort_keys=True).encode("utf-8")
+    name = hashlib.blake2b(raw, digest_size=20).hexdigest() + (".json.gz" if compress else ".json")
+    blob_path = os.path.join(blob_dir, name)
+    if not os.path.exists(blob_path):
+        with _replace_atomically(blob_path, "wb") as file:
+            file.write(gzip.compress(raw) if compress else raw)
+    return name
+
+
+def copy_blob(src_dir: str, dst_dir: str, name: str) -> None:
+    """Make the blob with the given name in src_dir available in dst_dir, as a hard link when
+    possible"""
+    src = os.path.join(src_dir, name)
+    dst = os.path.join(dst_dir, name)
+    if os.path.exists(dst):
+        return
+    if not os.path.exists(src):
+        raise MoltenIOError(f"Missing output blob: {name}")
+    try:
+        os.link(src, dst)
+    except OSError:
+        # another file system, or one without hard links
+        with open(src, "rb") as src_file, _replace_atomically(dst, "wb") as dst_file:
+            shutil.copyfileobj(src_file, dst_file)
+
+
+def read_blob(blob_dir: str, name: str) -> Any:
+    with open(os.path.join(blob_dir, name), "rb") as file:
+        raw = file.read()
+    if name.endswith(".gz"):
+        raw = gzip.decompress(raw)
+    return json.loads(raw)
+
+
+def read_header(file: IO[str]) -> Dict[str, Any]:
+    """Read the header of a save file. For version 1 files, this is the entire save file, for
+    version 2 files, the cells follow, one per line."""
+    try:
+        data = json.loads(file.readline())
+    except json.JSONDecodeError as err:
+        raise MoltenIOError(f"Invalid save file: {err}")
+    if not isinstance(data, dict):
+        raise MoltenIOError("Invalid save file")
+    return data
+
+
+def _check_checksum(moltenbuffer: MoltenKernel, data: Dict[str, Any]) -> None:
     MoltenIOError.assert_has_key(data, "content_checksum", str)
 
-    if moltenbuffer._get_content_checksum() != data["content_checksum"]:
+    if moltenbuffer._get_legacy_content_checksum() != data["content_checksum"]:
         raise MoltenIOError("Buffer contents' checksum does not match!")
 
-    MoltenIOError.assert_has_key(data, "cells", list)
-    for cell in data["cells"]:
-        MoltenIOError.assert_has_key(cell, "span", dict)
-        MoltenIOError.assert_has_key(cell["span"], "begin", dict)
-        MoltenIOError.assert_has_key(cell["span"]["begin"], "lineno", int)
-        MoltenIOError.assert_has_key(cell["span"]["begin"], "colno", int)
-        MoltenIOError.assert_has_key(cell["span"], "end", dict)
-        MoltenIOError.assert_has_key(cell["span"]["end"], "lineno", int)
-        MoltenIOError.assert_has_key(cell["span"]["end"], "colno", int)
-        begin_position = DynamicPosition(
-            moltenbuffer.nvim,
-            moltenbuffer.extmark_namespace,
-            nvim_buffer.number,
-            cell["span"]["begin"]["lineno"],
-            cell["span"]["begin"]["colno"],
-        )
-        end_position = DynamicPosition(
-            moltenbuffer.nvim,
-            moltenbuffer.extmark_namespace,
-            nvim_buffer.number,
-            cell["span"]["end"]["lineno"],
-            cell["span"]["end"]["colno"],
-            right_gravity=True,
-        )
-        span = CodeCell(nvim, begin_position, end_position)
 
-        # XXX: do we really want to have the execution count here?
-        #      what happens when the counts start to overlap?
-        MoltenIOError.assert_has_key(cell, "execution_count", int)
-        output = Output(cell["execution_count"])
+def _cell_from_data(
+    nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, cell: Dict[str, Any]
+) -> Tuple[CodeCell, Output]:
+    """Build the span and the (chunkless) output of a saved cell"""
+    MoltenIOError.assert_has_key(cell, "span", dict)
+    MoltenIOError.assert_has_key(cell["span"], "begin", dict)
+    MoltenIOError.assert_has_key(cell["span"]["begin"], "lineno", int)
+    MoltenIOError.assert_has_key(cell["span"]["begin"], "colno", int)
+    MoltenIOError.assert_has_key(cell["span"], "end", dict)
+    MoltenIOError.assert_has_key(cell["span"]["end"], "lineno", int)
+    MoltenIOError.assert_has_key(cell["span"]["end"], "colno", int)
+    begin_position = DynamicPosition(
+        moltenbuffer.nvim,
+        moltenbuffer.extmark_namespace,
+        nvim_buffer.number,
+        cell["span"]["begin"]["lineno"],
+        cell["span"]["begin"]["colno"],
+    )
+    end_position = DynamicPosition(
+        moltenbuffer.nvim,
+        moltenbuffer.extmark_namespace,
+        nvim_buffer.number,
+        cell["span"]["end"]["lineno"],
+        cell["span"]["end"]["colno"],
+        right_gravity=True,
+    )
+    span = CodeCell(nvim, begin_position, end_position)
+
+    # XXX: do we really want to have the execution count here?
+    #      what happens when the counts start to overlap?
+    MoltenIOError.assert_has_key(cell, "execution_count", int)
+    output = Output(cell["execution_count"])
+
+    MoltenIOError.assert_has_key(cell, "status", int)
+    output.status = OutputStatus(cell["status"])
+
+    MoltenIOError.assert_has_key(cell, "success", bool)
+    output.success = cell["success"]
 
-        MoltenIOError.assert_has_key(cell, "status", int)
-        output.status = OutputStatus(cell["status"])
+    MoltenIOError.assert_has_key(cell, "chunks", list)
 
-        MoltenIOError.assert_has_key(cell, "success", bool)
-        output.success = cell["success"]
+    return span, output
+
+
+def _add_cell(moltenbuffer: MoltenKernel, span: CodeCell, output: Output) -> None:
+    output.old = True
+    output.status = OutputStatus.DONE
+
+    moltenbuffer.outputs[span] = OutputBuffer(
+        moltenbuffer.nvim,
+        moltenbuffer.canvas,
+        moltenbuffer.extmark_namespace,
+        moltenbuffer.options,
+    )
+    moltenbuffer.outputs[span].output = output
+
+
+def load(nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, data: Dict[str, Any]) -> None:
+    """Load a version 1 save file"""
+    _check_checksum(moltenbuffer, data)
+
+    MoltenIOError.assert_has_key(data, "cells", list)
+    for cell in data["cells"]:
+        span, output = _cell_from_data(nvim, moltenbuffer, nvim_buffer, cell)
 
-        MoltenIOError.assert_has_key(cell, "chunks", list)
         for chunk in cell["chunks"]:
             MoltenIOError.assert_has_key(chunk, "data", dict)
             MoltenIOError.assert_has_key(chunk, "metadata", dict)
@@ -93,52 +206,299 @@ def load(nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, data: Dict
                     chunk["data"],
                     chunk["metadata"],
                     moltenbuffer.options,
+                    moltenbuffer.runtime.render_cache,
                 )
             )
 
-        output.old = True
-        output.status = OutputStatus.DONE
+        _add_cell(moltenbuffer, span, output)
+
+
+def _cell_lines(cell: Dict[str, Any]) -> Tuple[int, int]:
+    MoltenIOError.assert_has_key(cell, "span", dict)
+    MoltenIOError.assert_has_key(cell["span"], "begin", dict)
+    MoltenIOError.assert_has_key(cell["span"], "end", dict)
+    return (
+        MoltenIOError.assert_has_key(cell["span"]["begin"], "lineno", int),
+        MoltenIOError.assert_has_key(cell["span"]["end"], "lineno", int),
+    )
+
+
+def realign_cells(
+    buffer_hashes: List[str], cells: List[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Find where each saved cell's code ended up in the edited buffer, by looking up the saved
+    line hashes of the cell in an index of the buffer's lines. Cells are placed in order, each one
+    after the previous, as close as possible to where the previous cells' shift predicts.
+    Returns: the cells that were found, with their spans moved, and the orphaned cells"""
+    index = LineIndex(buffer_hashes)
+    found = []
+    orphaned = []
+    min_start = 0
+    shift = 0
+    for cell in sorted(cells, key=lambda c: _cell_lines(c)[0]):
+        begin, end = _cell_lines(cell)
+        hashes = cell.get("line_hashes")
+        if not isinstance(hashes, list) or len(hashes) != end - begin + 1:
+            orphaned.append(cell)
+            continue
+
+        start = index.find(hashes, min_start, begin + shift)
+        if start is None:
+            orphaned.append(cell)
+            continue
+
+        shift = start - begin
+        cell["span"]["begin"]["lineno"] += shift
+        cell["span"]["end"]["lineno"] += shift
+        # the next cell can start on the line this one ends on
+        min_start = start + len(hashes) - 1
+        found.append(cell)
+    return found, orphaned
+
+
+def _load_v2_cell(
+    nvim: Nvim,
+    moltenbuffer: MoltenKernel,
+    nvim_buffer: Buffer,
+    cell: Dict[str, Any],
+    blob_dir: str,
+    replace: bool = False,
+) -> None:
+    span, output = _cell_from_data(nvim, moltenbuffer, nvim_buffer, cell)
+
+    saved_chunks = cell["chunks"]
+    for chunk in saved_chunks:
+        MoltenIOError.assert_has_key(chunk, "blob", str)
+        MoltenIOError.assert_has_key(chunk, "metadata", dict)
+        if not os.path.exists(os.path.join(blob_dir, chunk["blob"])):
+            raise MoltenIOError(f"Missing output blob: {chunk['blob']}")
+
+    def load_chunks() -> List[OutputChunk]:
+        return [
+            to_outputchunk(
+                nvim,
+                moltenbuffer.runtime._alloc_file,
+                read_blob(blob_dir, chunk["blob"]),
+                chunk["metadata"],
+                moltenbuffer.options,
+                moltenbuffer.runtime.render_cache,
+            )
+            for chunk in saved_chunks
+        ]
+
+    output.load_chunks_lazily(load_chunks, saved_chunks, blob_dir)
+    if replace:
+        moltenbuffer.try_delete_overlapping_cells(span)
+    _add_cell(moltenbuffer, span, output)
 
-        moltenbuffer.outputs[span] = OutputBuffer(
-            moltenbuffer.nvim,
-            moltenbuffer.canvas,
-            moltenbuffer.extmark_namespace,
-            moltenbuffer.options,
+
+def _parse_cell(line: str) -> Dict[str, Any]:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as err:
+        raise MoltenIOError(f"Invalid cell in save file: {err}")
+
+
+def load_v2(
+    nvim: Nvim,
+    moltenbuffer: MoltenKernel,
+    nvim_buffer: Buffer,
+    header: Dict[str, Any],
+    cells: Iterable[str],
+    blob_dir: str,
+) -> None:
+    """Load a version 2 save file. Cells are read one line at a time, and their chunks are only
+    read from the blob store and rendered once the output is first used.
+
+    When the buffer changed since the save, cells are re-anchored to wherever their code is now,
+    and only the cells whose code can't be found anymore are dropped."""
+    MoltenIOError.assert_has_key(header, "content_checksum", str)
+
+    if moltenbuffer._get_content_checksum() == header["content_checksum"]:
+        for line in cells:
+            if line.strip() != "":
+                _load_v2_cell(nvim, moltenbuffer, nvim_buffer, _parse_cell(line), blob_dir)
+        return
+
+    saved = [_parse_cell(line) for line in cells if line.strip() != ""]
+    buffer_hashes = moltenbuffer.get_line_hashes(nvim_buffer.number, [(0, -1)])[0]
+    found, orphaned = realign_cells(buffer_hashes, saved)
+    if len(found) == 0 and len(saved) > 0:
+        raise MoltenIOError("Buffer contents' checksum does not match, and no cells were found!")
+
+    for cell in found:
+        _load_v2_cell(nvim, moltenbuffer, nvim_buffer, cell, blob_dir)
+
+    if len(orphaned) > 0:
+        lines = ", ".join(f"{begin + 1}-{end + 1}" for begin, end in map(_cell_lines, orphaned))
+        notify_warn(
+            nvim,
+            f"The buffer changed since it was saved. Dropped the output of {len(orphaned)} "
+            f"cell(s) whose code changed (saved at lines: {lines})",
+        )
+
+
+def get_journal_file(path: str) -> str:
+    """The autosave journal of the save file at path"""
+    return os.path.splitext(path)[0] + ".journal"
+
+
+def read_journal(path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Read an autosave journal: a header line, followed by one version 2 cell per line, in the
+    order they finished running. A torn last line (from a crash mid write) is ignored.
+    Returns: the header and the cells"""
+    with open(path) as file:
+        header = read_header(file)
+        cells = []
+        for line in file:
+            try:
+                cells.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    MoltenIOError.assert_has_key(header, "kernel", str)
+    return header, cells
+
+
+def merge_cells(cells: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge cells in the order they were written, dropping cells that a later cell overlaps,
+    the same way running a cell replaces the outputs it overlaps"""
+    merged: List[Dict[str, Any]] = []
+    for cell in cells:
+        begin, end = _cell_lines(cell)
+        merged = [
+            other
+            for other in merged
+            if not (_cell_lines(other)[0] <= end and begin <= _cell_lines(other)[1])
+        ]
+        merged.append(cell)
+    return merged
+
+
+def replay_journal(
+    nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, path: str, blob_dir: str
+) -> int:
+    """Add the cells of the autosave journal at path on top of the already loaded cells.
+    Returns: the number of cells that were restored"""
+    _, cells = read_journal(path)
+    buffer_hashes = moltenbuffer.get_line_hashes(nvim_buffer.number, [(0, -1)])[0]
+    found, _ = realign_cells(buffer_hashes, merge_cells(cells))
+    restored = 0
+    for cell in found:
+        try:
+            _load_v2_cell(nvim, moltenbuffer, nvim_buffer, cell, blob_dir, replace=True)
+            restored += 1
+        except MoltenIOError:
+            # the blobs were pruned by a later save, which also saved the cell
+            continue
+    return restored
+
+
+def compact_journal(path: str) -> bool:
+    """Fold the autosave journal of the save file at path into the save file, and remove the
+    journal. Runs without access to the buffer, so the written save file has no checksum, and
+    its cells are re-anchored when it's loaded.
+
+    A save file that can't be merged with the journal (a version 1 save, or the save of another
+    kernel) is never replaced, the journal is left for MoltenLoad to replay instead.
+    Returns: whether the journal was folded into the save file"""
+    with store_lock:
+        return _compact_journal(path)
+
+
+def _compact_journal(path: str) -> bool:
+    journal_path = get_journal_file(path)
+    header, cells = read_journal(journal_path)
+
+    saved: List[Dict[str, Any]] = []
+    if os.path.exists(path):
+        with open(path) as file:
+            base = read_header(file)
+            if base.get("version") != SAVE_VERSION or base.get("kernel") != header["kernel"]:
+                return False
+            saved = [_parse_cell(line) for line in file if line.strip() != ""]
+
+    with _replace_atomically(path) as file:
+        file.write(
+            json.dumps(
+                {"version": SAVE_VERSION, "kernel": header["kernel"], "content_checksum": ""}
+            )
+            + "\n"
         )
-        moltenbuffer.outputs[span].output = output
+        for cell in merge_cells(saved + cells):
+            file.write(json.dumps(cell) + "\n")
+    os.remove(journal_path)
+    return True
+
+
+def save(molten_kernel: MoltenKernel, nvim_buffer: int, path: str, compress: bool) -> None:
+    """Save the current kernel state for the given buffer to path, in the version 2 format: a
+    header line, followed by one line per cell. Output data is written to a content addressed blob
+    directory next to the save file, blobs that are already there aren't written again."""
+    with store_lock:
+        _save(molten_kernel, nvim_buffer, path, compress)
 
 
-def save(molten_kernel: MoltenKernel, nvim_buffer: int) -> Dict[str, Any]:
-    """Save the current kernel state for the given buffer."""
-    return {
-        "version": 1,
+def _save(molten_kernel: MoltenKernel, nvim_buffer: int, path: str, compress: bool) -> None:
+    blob_dir = get_blob_dir(path)
+    os.makedirs(blob_dir, exist_ok=True)
+
+    header = {
+        "version": SAVE_VERSION,
         "kernel": molten_kernel.runtime.kernel_name,
         "content_checksum": molten_kernel._get_content_checksum(),
-        "cells": [
-            {
+    }
+
+    outputs = [
+        (span.begin.lineno, span.end.lineno, span, output)
+        for span, output in molten_kernel.outputs.items()
+        if span.begin.bufno == nvim_buffer
+    ]
+    line_hashes = molten_kernel.get_line_hashes(
+        nvim_buffer, [(begin, end + 1) for begin, end, _, _ in outputs]
+    )
+    used_blobs = set()
+    with _replace_atomically(path) as file:
+        file.write(json.dumps(header) + "\n")
+        for (begin, end, span, output), hashes in zip(outputs, line_hashes):
+            if not output.output.chunks_loaded() and output.output.saved_chunks is not None:
+                # never displayed since it was loaded, the blobs are still in the store
+                chunks = output.output.saved_chunks
+                src_dir = output.output.saved_blob_dir
+                if src_dir is not None and os.path.realpath(src_dir) != os.path.realpath(blob_dir):
+                    # loaded from another save file, its blobs live next to that one
+                    for chunk in chunks:
+                        copy_blob(src_dir, blob_dir, chunk["blob"])
+            else:
+                chunks = [
+                    {
+                        "blob": write_blob(blob_dir, chunk.jupyter_data, compress),
+                        "metadata": chunk.jupyter_metadata,
+                    }
+                    for chunk in output.output.chunks
+                    if chunk.jupyter_data is not None and chunk.jupyter_metadata is not None
+                ]
+            used_blobs.update(chunk["blob"] for chunk in chunks)
+            cell = {
                 "span": {
                     "begin": {
-                        "lineno": span.begin.lineno,
+                        "lineno": begin,
                         "colno": span.begin.colno,
                     },
                     "end": {
-                        "lineno": span.end.lineno,
+                        "lineno": end,
                         "colno": span.end.colno,
                     },
                 },
+                # used to find the cell again if the buffer is edited before it's loaded
+                "line_hashes": hashes,
                 "execution_count": output.output.execution_count,
                 "status": output.output.status.value,
                 "success": output.output.success,
-                "chunks": [
-                    {
-                        "data": chunk.jupyter_data,
-                        "metadata": chunk.jupyter_metadata,
-                    }
-                    for chunk in output.output.chunks
-                    if chunk.jupyter_data is not None and chunk.jupyter_metadata is not None
-                ],
+                "chunks": chunks,
             }
-            for span, output in molten_kernel.outputs.items()
-            if span.begin.bufno == nvim_buffer
-        ],
-    }
+            file.write(json.dumps(cell) + "\n")
+
+    # drop the blobs of outputs that no longer exist
+    for name in os.listdir(blob_dir):
+        if name not in used_blobs:
+            os.remove(os.path.join(blob_dir, name))